@@ -0,0 +1,190 @@
+#   YADT - an Augmented Deployment Tool
+#   Copyright (C) 2010-2014  Immobilien Scout GmbH
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+    The benchmark module
+    Drives the status, stop and start calls of `LB` and `LivestatusService`
+    for many simulated hosts against local fake servers (see fakeservers)
+    and reports throughput, latency percentiles and the peak memory reached
+    by the end of each phase.
+
+    Run it from the project directory:
+    PYTHONPATH=src/main/python:src/benchmark/python python src/benchmark/python/benchmark.py --hosts 200
+'''
+
+from __future__ import print_function
+
+import argparse
+import json
+import logging
+import math
+import resource
+import sys
+import time
+import types
+
+from twisted.internet import defer, task
+from twisted.python.failure import Failure
+
+import yadtshell.components
+from yadtshell_plugins import services
+
+import fakeservers
+
+PARTITION = '~Common~'
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the LB and LivestatusService plugins against fake servers.')
+    parser.add_argument('--hosts', type=int, default=100, help='number of simulated hosts')
+    parser.add_argument('--load-balancers', type=int, default=2, help='number of fake F5 load balancers in the cluster')
+    parser.add_argument('--latency', type=float, default=0.005, help='response delay of the fake servers in seconds')
+    parser.add_argument('--jitter', type=float, default=0.005, help='additional random response delay in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with HTTP 500')
+    parser.add_argument('--padding', type=int, default=0, help='bytes added to every node/status object')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=JSON',
+                        help='set a key in loadbalancerservice.py and livestatusservice.py, e.G. BULK_STATUS=true')
+    parser.add_argument('--verbose', action='store_true', help='log at debug level')
+    return parser.parse_args(argv)
+
+
+def percentile(values, percent):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, int(math.ceil(percent / 100.0 * len(ordered))) - 1)]
+
+
+def install_configuration(lb_ips, livestatus_port, settings):
+    loadbalancerservice = types.ModuleType('loadbalancerservice')
+    loadbalancerservice.IMPLEMENTATION = 'yadtshell_plugins.f5rest'
+    loadbalancerservice.RESTAPI_USERNAME = 'benchmark'
+    loadbalancerservice.RESTAPI_PASSWORD = 'benchmark'
+    loadbalancerservice.LTM_PARTITION = PARTITION
+    loadbalancerservice.CLUSTERS = {'benchmark': lb_ips}
+
+    livestatusservice = types.ModuleType('livestatusservice')
+    livestatusservice.SERVERS = {}
+    livestatusservice.LIVESTATUS_SERVICE_PORT = livestatus_port
+
+    for setting in settings:
+        key, _, value = setting.partition('=')
+        for config in (loadbalancerservice, livestatusservice):
+            setattr(config, key, json.loads(value))
+    sys.modules['loadbalancerservice'] = loadbalancerservice
+    sys.modules['livestatusservice'] = livestatusservice
+
+
+def create_services(count):
+    services.GUARD._run_guard = lambda service, guard_commands: defer.succeed(0)
+    lbs, monitorings = [], []
+    for number in range(count):
+        host = yadtshell.components.Host('devbench%04d.benchmark' % number)
+        host.interface = {'eth0': '10.0.%d.%d' % (number // 250, number % 250 + 1)}
+        lb = services.LB(host, 'loadbalancer', {'loadbalancer_clusters': ['benchmark']})
+        lb.prepare(host)
+        lbs.append(lb)
+        monitorings.append(services.LivestatusService(host, 'monitoring', {'livestatus_server': '127.0.0.1'}))
+    return lbs, monitorings
+
+
+@defer.inlineCallbacks
+def run_phase(name, operation, fakes):
+    latencies = []
+    failures = []
+    requests_before = sum(fake.behaviour.requests for fake in fakes)
+
+    def timed(started):
+        def record(result):
+            latencies.append(time.time() - started)
+            if isinstance(result, Failure):
+                failures.append(result)
+        return record
+
+    started = time.time()
+    calls = []
+    for call in operation:
+        d = defer.maybeDeferred(call)
+        d.addBoth(timed(time.time()))
+        calls.append(d)
+    yield defer.DeferredList(calls)
+    elapsed = time.time() - started
+    requests = sum(fake.behaviour.requests for fake in fakes) - requests_before
+    defer.returnValue({
+        'phase': name,
+        'calls': len(calls),
+        'failures': len(failures),
+        'requests': requests,
+        'seconds': elapsed,
+        'requests_per_second': requests / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'peak_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    })
+
+
+def print_report(results):
+    print('%-22s %7s %8s %9s %9s %12s %9s %9s %8s' %
+          ('phase', 'calls', 'failures', 'requests', 'seconds', 'requests/s', 'p50 ms', 'p99 ms', 'peak MB'))
+    for result in results:
+        print('%(phase)-22s %(calls)7d %(failures)8d %(requests)9d %(seconds)9.3f %(requests_per_second)12.1f '
+              '%(p50_ms)9.1f %(p99_ms)9.1f %(peak_mb)8.1f' % result)
+
+
+@defer.inlineCallbacks
+def run(arguments):
+    hosts = ['devbench%04d' % number for number in range(arguments.hosts)]
+    behaviour = dict(latency=arguments.latency, jitter=arguments.jitter,
+                     error_rate=arguments.error_rate, padding=arguments.padding)
+    f5_ports, fakes = [], []
+    for _ in range(arguments.load_balancers):
+        port, fake = fakeservers.listen_f5(fakeservers.Behaviour(**behaviour), hosts)
+        f5_ports.append(port)
+        fakes.append(fake)
+    livestatus_port, livestatus = fakeservers.listen_livestatus(fakeservers.Behaviour(**behaviour), hosts)
+    fakes.append(livestatus)
+
+    install_configuration(['127.0.0.1:%d' % f5_port.getHost().port for f5_port in f5_ports],
+                          livestatus_port.getHost().port, arguments.set)
+    lbs, monitorings = create_services(arguments.hosts)
+
+    phases = [('lb status', [lb.status for lb in lbs]),
+              ('lb stop', [lb.stop for lb in lbs]),
+              ('lb status (stopped)', [lb.status for lb in lbs]),
+              ('lb start', [lb.start for lb in lbs]),
+              ('monitoring status', [monitoring.status for monitoring in monitorings]),
+              ('monitoring stop', [monitoring.stop for monitoring in monitorings]),
+              ('monitoring start', [monitoring.start for monitoring in monitorings])]
+    results = []
+    for name, operation in phases:
+        result = yield run_phase(name, operation, fakes)
+        results.append(result)
+    print_report(results)
+
+    for port in f5_ports + [livestatus_port]:
+        yield port.stopListening()
+
+
+def main(argv=None):
+    arguments = parse_arguments(sys.argv[1:] if argv is None else argv)
+    logging.basicConfig(format='%(levelname)-8s %(message)s')
+    for logger_name in ('', 'yadtshell'):
+        logging.getLogger(logger_name).setLevel(logging.DEBUG if arguments.verbose else logging.WARNING)
+    task.react(lambda _: run(arguments))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+#   YADT - an Augmented Deployment Tool
+#   Copyright (C) 2010-2014  Immobilien Scout GmbH
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+    The fakeservers module
+    Local stand-ins for the F5 iControl REST API and livestatus-service,
+    used by the benchmark. Both keep the node/notification state of the
+    simulated hosts in memory and can delay, fail and pad their responses.
+'''
+
+import json
+import random
+import re
+
+from OpenSSL import crypto
+from twisted.internet import reactor, ssl
+from twisted.web import resource, server
+
+try:
+    from urllib import unquote
+except ImportError:
+    from urllib.parse import unquote
+
+NODE_URL = re.compile(r'^/mgmt/tm/ltm/node/(~[^~]*~)?(?P<host>[^/?]+)$')
+TRANSACTION_URL = re.compile(r'^/mgmt/tm/transaction(/(?P<transaction_id>\d+))?$')
+ENABLED = {'state': 'up', 'session': 'monitor-enabled'}
+DISABLED = {'state': 'user-down', 'session': 'user-disabled'}
+
+
+class Behaviour(object):
+
+    """
+    How a fake server answers: every response is delayed by *latency*
+    seconds (plus up to *jitter* seconds), fails with HTTP 500 with
+    probability *error_rate* and is padded by *padding* bytes.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, padding=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.padding = padding
+        self.requests = 0
+        self.errors = 0
+
+
+class FakeResource(resource.Resource):
+
+    isLeaf = True
+
+    def __init__(self, behaviour):
+        resource.Resource.__init__(self)
+        self.behaviour = behaviour
+
+    def render(self, request):
+        self.behaviour.requests += 1
+        delay = self.behaviour.latency + random.uniform(0, self.behaviour.jitter)
+        call = reactor.callLater(delay, self._respond, request)
+        request.notifyFinish().addErrback(lambda _: call.active() and call.cancel())
+        return server.NOT_DONE_YET
+
+    def _respond(self, request):
+        if random.random() < self.behaviour.error_rate:
+            self.behaviour.errors += 1
+            request.setResponseCode(500)
+            body = {'code': 500, 'message': 'simulated failure'}
+        else:
+            body = self.answer(request)
+        request.setHeader(b'content-type', b'application/json')
+        request.write(json.dumps(body).encode('utf-8'))
+        request.finish()
+
+    def answer(self, request):
+        raise NotImplementedError()
+
+    def pad(self, body):
+        if self.behaviour.padding and isinstance(body, dict):
+            body['padding'] = 'x' * self.behaviour.padding
+        return body
+
+
+class FakeF5(FakeResource):
+
+    """
+    Serves the node collection, single nodes (GET and PUT) and transactions
+    of `/mgmt/tm`. Unknown nodes are created enabled.
+    """
+
+    def __init__(self, behaviour, hosts):
+        FakeResource.__init__(self, behaviour)
+        self.nodes = dict((host, dict(ENABLED, name=host)) for host in hosts)
+        self.transactions = 0
+
+    def answer(self, request):
+        path = request.path.decode('utf-8')
+        if path == '/mgmt/tm/ltm/node':
+            return {'kind': 'tm:ltm:node:nodecollectionstate',
+                    'items': [self.pad(dict(node)) for _, node in sorted(self.nodes.items())]}
+        match = NODE_URL.match(path)
+        if match:
+            host = match.group('host')
+            node = self.nodes.setdefault(host, dict(ENABLED, name=host))
+            if request.method == b'PUT':
+                payload = json.loads(request.content.read().decode('utf-8'))
+                node.update(ENABLED if payload.get('state') == 'user-up' else DISABLED)
+            return self.pad(dict(node))
+        match = TRANSACTION_URL.match(path)
+        if match and match.group('transaction_id'):
+            return {'transId': int(match.group('transaction_id')), 'state': 'COMPLETED'}
+        if match:
+            self.transactions += 1
+            return {'transId': self.transactions, 'state': 'STARTED'}
+        request.setResponseCode(404)
+        return {'code': 404, 'message': 'unknown path %s' % path}
+
+
+class FakeLivestatusService(FakeResource):
+
+    """
+    Serves `/query` (GET hosts with alias/host_name filters, GET services
+    with host_name and notifications_enabled filters) and `/cmd` (ENABLE_/DISABLE_ notification commands) of
+    livestatus-service. Every host has a single service.
+    """
+
+    def __init__(self, behaviour, hosts):
+        FakeResource.__init__(self, behaviour)
+        self.notifications = dict((host, 1) for host in hosts)
+        self.service_notifications = dict((host, 1) for host in hosts)
+
+    def answer(self, request):
+        path = request.path.decode('utf-8')
+        # parsed by hand since the ';' of commands separates arguments for parse_qs
+        arguments = dict(argument.partition('=')[::2]
+                         for argument in request.uri.partition(b'?')[2].decode('utf-8').split('&'))
+        query = unquote(arguments.get('q', '')).replace('\\n', '\n')
+        if path == '/cmd':
+            command, _, host = query.partition(';')
+            states = self.service_notifications if '_SVC_' in command else self.notifications
+            states[host] = 0 if command.startswith('DISABLE') else 1
+            return 'OK'
+        if path == '/query' and query.startswith('GET services'):
+            lines = query.split('\n')
+            targets = dict((host_filter.split(' = ', 1)[1], int(state_filter.split(' != ', 1)[1]))
+                           for host_filter, state_filter in zip(lines, lines[1:])
+                           if state_filter.startswith('Filter: notifications_enabled != ')
+                           if host_filter.startswith('Filter: host_name = '))
+            states = dict((service_host, self.service_notifications.setdefault(service_host, 1)) for service_host in targets)
+            return [[service_host, 'service', states[service_host]] for service_host in sorted(targets)
+                    if states[service_host] != targets[service_host]]
+        if path == '/query':
+            hosts = [line.split(' = ', 1)[1] for line in query.split('\n')
+                     if line.startswith('Filter: alias = ') or line.startswith('Filter: host_name = ')]
+            rows = dict((host, self.pad({'alias': host, 'notifications_enabled': self.notifications.setdefault(host, 1)}))
+                        for host in hosts)
+            if 'key' in arguments:
+                return rows
+            return [[alias, row['notifications_enabled']] for alias, row in sorted(rows.items())]
+        request.setResponseCode(404)
+        return {'code': 404, 'message': 'unknown path %s' % path}
+
+
+def self_signed_certificate():
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, 2048)
+    certificate = crypto.X509()
+    certificate.get_subject().CN = 'localhost'
+    certificate.set_serial_number(1)
+    certificate.gmtime_adj_notBefore(0)
+    certificate.gmtime_adj_notAfter(24 * 60 * 60)
+    certificate.set_issuer(certificate.get_subject())
+    certificate.set_pubkey(key)
+    certificate.sign(key, 'sha256')
+    return ssl.CertificateOptions(privateKey=key, certificate=certificate)
+
+
+def listen_f5(behaviour, hosts, interface='127.0.0.1'):
+    """
+    Starts a fake F5 on a free port with TLS and returns (port, fake).
+    """
+    fake = FakeF5(behaviour, hosts)
+    port = reactor.listenSSL(0, server.Site(fake), self_signed_certificate(), interface=interface)
+    return port, fake
+
+
+def listen_livestatus(behaviour, hosts, interface='127.0.0.1'):
+    """
+    Starts a fake livestatus-service on a free port and returns (port, fake).
+    """
+    fake = FakeLivestatusService(behaviour, hosts)
+    port = reactor.listenTCP(0, server.Site(fake), interface=interface)
+    return port, fake
@@ -0,0 +1,78 @@
+#   YADT - an Augmented Deployment Tool
+#   Copyright (C) 2010-2014  Immobilien Scout GmbH
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+    The cache module
+    Provides a small in-memory cache for service status results.
+'''
+
+import time
+
+UNKNOWN_STATES = (None, 'unknown')
+
+
+class StatusCache(object):
+
+    """
+    Caches status results per key for a time-to-live given when storing them.
+    Unknown states are never cached.
+    A key is invalidated when its service is started or stopped. Until a
+    status equal to the *expected_status* of the invalidation is observed
+    (i.e. the state change has arrived at the backend) nothing is cached
+    for this key.
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.entries = {}
+        self.expected = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            expires, status = entry
+            if expires > self.clock():
+                self.hits += 1
+                return status
+            del self.entries[key]
+        self.misses += 1
+        return None
+
+    def store(self, status, key, ttl):
+        """
+        Stores *status* for *ttl* seconds and returns it, so it can be
+        used as a callback.
+        """
+        if not ttl or status in UNKNOWN_STATES:
+            return status
+        if key in self.expected:
+            if status != self.expected[key]:
+                return status
+            del self.expected[key]
+        self.entries[key] = (self.clock() + ttl, status)
+        return status
+
+    def invalidate(self, key, expected_status=None):
+        self.entries.pop(key, None)
+        if expected_status is not None:
+            self.expected[key] = expected_status
+
+    def statistics(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self.entries)}
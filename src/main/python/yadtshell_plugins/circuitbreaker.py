@@ -0,0 +1,174 @@
+#   YADT - an Augmented Deployment Tool
+#   Copyright (C) 2010-2014  Immobilien Scout GmbH
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+    The circuitbreaker module
+    Fails calls to unreachable backend endpoints fast instead of waiting
+    for the connect timeout of every single call.
+'''
+
+import logging
+import time
+
+from twisted.internet import defer
+
+from yadtshell_plugins.metrics import METRICS, is_cancelled
+
+FAILURE_THRESHOLD = 5
+COOLDOWN_IN_SECONDS = 30
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+logger = logging.getLogger('yadtshell.plugins.circuitbreaker')
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+
+    """
+    Tracks the consecutive failures of calls to one endpoint.
+    After *failure_threshold* consecutive failures the circuit opens and
+    calls fail fast with `CircuitOpenError` for *cooldown* seconds. Then a
+    single probe call is let through (half-open): its success closes the
+    circuit, its failure opens it again. Cancelled calls are not counted.
+    A *failure_threshold* of 0 disables the breaker.
+    """
+
+    def __init__(self, name, failure_threshold=FAILURE_THRESHOLD, cooldown=COOLDOWN_IN_SECONDS, clock=time.time):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.trips = 0
+        self.rejected = 0
+
+    def allow(self):
+        if self.state == OPEN and self.clock() - self.opened_at >= self.cooldown:
+            self._change_state(HALF_OPEN)
+        if self.state == CLOSED:
+            return True
+        if self.state == HALF_OPEN and not self.probing:
+            self.probing = True
+            return True
+        self.rejected += 1
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.probing = False
+        if self.state != CLOSED:
+            self._change_state(CLOSED)
+
+    def record_failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.state == HALF_OPEN or (self.failure_threshold and self.failures >= self.failure_threshold):
+            self.opened_at = self.clock()
+            if self.state != OPEN:
+                self.trips += 1
+                self._change_state(OPEN)
+
+    def call(self, f, *args, **kwargs):
+        """
+        Calls *f* unless the circuit is open and returns its deferred result.
+        """
+        if not self.failure_threshold:
+            return defer.maybeDeferred(f, *args, **kwargs)
+        if not self.allow():
+            return defer.fail(CircuitOpenError('%s is unavailable after %d consecutive failures, '
+                                               'failing fast' % (self.name, self.failures)))
+
+        def on_success(result):
+            self.record_success()
+            return result
+
+        def on_failure(failure):
+            if is_cancelled(failure):
+                self.probing = False
+            else:
+                self.record_failure()
+            return failure
+
+        d = defer.maybeDeferred(f, *args, **kwargs)
+        d.addCallbacks(on_success, on_failure)
+        return d
+
+    def _change_state(self, state):
+        if state == OPEN:
+            logger.warning('circuit for %s opened after %d consecutive failures, failing fast for %ss' %
+                           (self.name, self.failures, self.cooldown))
+        else:
+            logger.info('circuit for %s is %s' % (self.name, state))
+        self.state = state
+
+
+class CircuitBreakers(object):
+
+    """
+    Holds one `CircuitBreaker` per backend endpoint. The failure threshold
+    and cooldown are configured per backend (e.G. 'rest', 'livestatus').
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.settings = {}
+        self.breakers = {}
+
+    def configure(self, backend, failure_threshold=None, cooldown=None):
+        settings = self.settings.setdefault(backend, {'failure_threshold': FAILURE_THRESHOLD,
+                                                      'cooldown': COOLDOWN_IN_SECONDS})
+        if failure_threshold is not None:
+            settings['failure_threshold'] = failure_threshold
+        if cooldown is not None:
+            settings['cooldown'] = cooldown
+        for (breaker_backend, _), breaker in self.breakers.items():
+            if breaker_backend == backend:
+                breaker.failure_threshold = settings['failure_threshold']
+                breaker.cooldown = settings['cooldown']
+
+    def breaker(self, backend, endpoint):
+        key = (backend, endpoint)
+        if key not in self.breakers:
+            settings = self.settings.get(backend, {})
+            self.breakers[key] = CircuitBreaker('%s endpoint %s' % (backend, endpoint),
+                                                settings.get('failure_threshold', FAILURE_THRESHOLD),
+                                                settings.get('cooldown', COOLDOWN_IN_SECONDS),
+                                                self.clock)
+        return self.breakers[key]
+
+    def call(self, backend, endpoint, f, *args, **kwargs):
+        return self.breaker(backend, endpoint).call(f, *args, **kwargs)
+
+    def statistics(self):
+        return {
+            'open': sum(1 for breaker in self.breakers.values() if breaker.state != CLOSED),
+            'trips': sum(breaker.trips for breaker in self.breakers.values()),
+            'rejected': sum(breaker.rejected for breaker in self.breakers.values()),
+            'states': dict(('%s %s' % key, breaker.state) for key, breaker in self.breakers.items())
+        }
+
+
+BREAKERS = CircuitBreakers()
+METRICS.add_statistics_provider('circuit_breakers', BREAKERS.statistics)
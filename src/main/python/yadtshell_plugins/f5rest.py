@@ -14,21 +14,27 @@
 #   You should have received a copy of the GNU General Public License
 #   along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import random
 from logging import getLogger
 
-from yadtshell_plugins.rest import rest_call, new_basicauth_headers, HTTP_METHOD
+from yadtshell_plugins.circuitbreaker import BREAKERS
+from yadtshell_plugins.metrics import METRICS
+from yadtshell_plugins.rest import rest_call, basicauth_value, HEDGER, HTTP_METHOD, POOLS, SCHEDULER
+from yadtshell_plugins import timeouts
 
-from twisted.internet.defer import DeferredList
+from twisted.internet import reactor
+from twisted.internet.defer import CancelledError, Deferred, DeferredList, maybeDeferred, succeed
+from twisted.python.failure import Failure
+from twisted.web.http_headers import Headers
 
 
 logger = getLogger("yadtshell.plugins.f5rest")
 
 
-CONFIG = {
-    "username": None,
-    "password": None,
-    "ltm_partition": None
-}
+STATE_CHANGE_BATCH_WINDOW_IN_SECONDS = 0.5
+NODE_STATUS_MEMBERS = ("name", "state", "session")
+CONVERGENCE_INITIAL_DELAY_IN_SECONDS = 0.5
+CONVERGENCE_MAX_DELAY_IN_SECONDS = 8
 
 
 class State(object):
@@ -37,29 +43,191 @@ class State(object):
     DOWN = ("user-disabled", "user-down")
 
     TEMPLATE = '{"name": "%s","session": "%s","state": "%s"}'
+    UP_TEMPLATE = TEMPLATE % (("%s",) + UP)
+    DOWN_TEMPLATE = TEMPLATE % (("%s",) + DOWN)
 
     @classmethod
     def up(cls, host):
-        return cls.TEMPLATE % ((host,) + cls.UP)
+        return cls.UP_TEMPLATE % host
 
     @classmethod
     def down(cls, host):
-        return cls.TEMPLATE % ((host,) + cls.DOWN)
+        return cls.DOWN_TEMPLATE % host
 
 
-def configure(config, ltm_partition):
-    CONFIG['username'] = config.RESTAPI_USERNAME
-    CONFIG['password'] = config.RESTAPI_PASSWORD
-    if not ltm_partition:
-        raise RuntimeError("No ltm partition configured! Set it in the service definition or in the loadbalancer config")
-    CONFIG['ltm_partition'] = ltm_partition
+class RequestContext(object):
+
+    """
+    The immutable per-(load balancer, partition) state of REST calls: the
+    prebuilt request headers (which must not be modified) and URLs.
+    """
+
+    __slots__ = ("lb_ip", "ltm_partition", "headers", "node_url_prefix", "collection_url", "transaction_url")
+
+    def __init__(self, lb_ip, ltm_partition, authorization):
+        headers = Headers({"Content-Type": ["application/json"], "Host": [lb_ip]})
+        if authorization is not None:
+            headers.addRawHeader("Authorization", authorization)
+        for name, value in (("lb_ip", lb_ip),
+                            ("ltm_partition", ltm_partition),
+                            ("headers", headers),
+                            ("node_url_prefix", "https://%s/mgmt/tm/ltm/node/%s" % (lb_ip, ltm_partition)),
+                            ("collection_url", collection_url(lb_ip, ltm_partition)),
+                            ("transaction_url", "https://%s/mgmt/tm/transaction" % lb_ip)):
+            object.__setattr__(self, name, value)
 
+    def __setattr__(self, name, value):
+        raise AttributeError("RequestContext is immutable")
 
-def query_status_from_single_lb(host, lb_ip):
-    d = rest_call("https://%s/mgmt/tm/ltm/node/%s%s" % (lb_ip, CONFIG['ltm_partition'], host),
-                  HTTP_METHOD.GET,
-                  headers=new_basicauth_headers(CONFIG))
+    def node_url(self, host):
+        return self.node_url_prefix + host
 
+    def transaction_headers(self, transaction_id):
+        headers = self.headers.copy()
+        headers.addRawHeader("X-F5-REST-Coordination-Id", str(transaction_id))
+        return headers
+
+
+CLIENTS = {}
+
+
+def configure(config, ltm_partition):
+    """
+    Returns the `F5RestClient` for the credentials in *config* and
+    *ltm_partition*. Clients are created once per distinct credentials and
+    partition, the shared connection settings are applied when a client is
+    created.
+    """
+    if not ltm_partition:
+        raise RuntimeError("No ltm partition configured! Set it in the service definition or in the loadbalancer config")
+    key = (config.RESTAPI_USERNAME, config.RESTAPI_PASSWORD, ltm_partition)
+    if key not in CLIENTS:
+        CLIENTS[key] = F5RestClient(config.RESTAPI_USERNAME, config.RESTAPI_PASSWORD, ltm_partition,
+                                    bulk_status=getattr(config, "BULK_STATUS", False),
+                                    prefetch_status=getattr(config, "PREFETCH_STATUS", False),
+                                    batch_state_changes=getattr(config, "BATCH_STATE_CHANGES", False),
+                                    incremental_decoding=getattr(config, "INCREMENTAL_DECODING", False),
+                                    wait_for_convergence=getattr(config, "WAIT_FOR_CONVERGENCE", False),
+                                    convergence_timeout=getattr(config, "CONVERGENCE_TIMEOUT_IN_SECONDS", 30))
+        for lb_ips in getattr(config, "CLUSTERS", {}).values():
+            for lb_ip in lb_ips:
+                CLIENTS[key].request_context(lb_ip)
+        BATCHER.window = getattr(config, "STATE_CHANGE_BATCH_WINDOW_IN_SECONDS", STATE_CHANGE_BATCH_WINDOW_IN_SECONDS)
+        POOLS.configure(max_persistent_per_host=getattr(config, "MAX_CONNECTIONS_PER_LOADBALANCER", None),
+                        cached_connection_timeout=getattr(config, "CONNECTION_IDLE_TIMEOUT_IN_SECONDS", None))
+        SCHEDULER.configure(max_requests=getattr(config, "MAX_CONCURRENT_REQUESTS", None),
+                            max_requests_per_endpoint=getattr(config, "MAX_CONCURRENT_REQUESTS_PER_LOADBALANCER", None))
+        HEDGER.configure(enabled=getattr(config, "HEDGE_REQUESTS", None),
+                         percentile=getattr(config, "HEDGE_PERCENTILE", None),
+                         budget_percent=getattr(config, "HEDGE_BUDGET_PERCENT", None))
+        timeouts.configure("rest", config)
+        BREAKERS.configure("rest",
+                           failure_threshold=getattr(config, "CIRCUIT_BREAKER_FAILURE_THRESHOLD", None),
+                           cooldown=getattr(config, "CIRCUIT_BREAKER_COOLDOWN_IN_SECONDS", None))
+        METRICS.configure(dump_file=getattr(config, "METRICS_FILE", None),
+                          dump_format=getattr(config, "METRICS_FORMAT", None))
+    return CLIENTS[key]
+
+
+class NodeCollectionSnapshot(object):
+
+    """
+    Caches the node collection of each load balancer for the duration of a
+    yadtshell run, so that the node status of every host can be answered
+    with one request per load balancer. Every `F5RestClient` (i.e. every
+    partition) has its own snapshot.
+    A node is dropped from the snapshot when its state is changed, its
+    status is then queried with a single request.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.nodes = {}
+        self.pending = {}
+        self.changed = {}
+
+    def node(self, lb_ip, host):
+        """
+        Returns a deferred which will callback with the node *host*
+        (a dictionary) or None when the node is not in the collection.
+        """
+        if lb_ip in self.nodes:
+            return succeed(self._copy_of(self.nodes[lb_ip].get(host)))
+        d = Deferred()
+        d.addCallback(lambda nodes: self._copy_of(nodes.get(host)))
+        if lb_ip in self.pending:
+            self.pending[lb_ip].append(d)
+        else:
+            self.pending[lb_ip] = [d]
+            self._fetch(lb_ip)
+        return d
+
+    def prefetch(self, lb_ip):
+        """
+        Starts fetching the node collection of *lb_ip* in the background
+        unless it is already known or being fetched.
+        """
+        if lb_ip not in self.nodes and lb_ip not in self.pending:
+            self.pending[lb_ip] = []
+            self._fetch(lb_ip)
+
+    def invalidate(self, lb_ip, host):
+        """
+        Drops the node *host* of *lb_ip*, also from the collection currently
+        being fetched.
+        """
+        if lb_ip in self.nodes:
+            self.nodes[lb_ip].pop(host, None)
+        if lb_ip in self.pending:
+            self.changed.setdefault(lb_ip, set()).add(host)
+
+    def _fetch(self, lb_ip):
+        waiting = self.pending[lb_ip]
+        logger.debug("fetching node collection of LB(%s)" % lb_ip)
+
+        def index_nodes(collection):
+            return dict((node["name"], node) for node in collection.get("items", []) if "name" in node)
+
+        def store_and_notify(nodes):
+            for host in self.changed.pop(lb_ip, ()):
+                nodes.pop(host, None)
+            if self.pending.get(lb_ip) is waiting:
+                del self.pending[lb_ip]
+                self.nodes[lb_ip] = nodes
+            for waiting_deferred in waiting:
+                waiting_deferred.callback(nodes)
+
+        def notify_failure(failure):
+            self.changed.pop(lb_ip, None)
+            if self.pending.get(lb_ip) is waiting:
+                del self.pending[lb_ip]
+            if not waiting:
+                logger.warning("prefetching node collection of LB(%s) failed: %s" % (lb_ip, failure.getErrorMessage()))
+            for waiting_deferred in waiting:
+                waiting_deferred.errback(failure)
+
+        context = self.client.request_context(lb_ip)
+        d = rest_call(context.collection_url,
+                      HTTP_METHOD.GET,
+                      headers=context.headers,
+                      kind="rest-collection")
+        d.addCallback(index_nodes)
+        d.addCallbacks(store_and_notify, notify_failure)
+        return d
+
+    @staticmethod
+    def _copy_of(node):
+        return dict(node) if node is not None else None
+
+
+def collection_url(lb_ip, ltm_partition):
+    partition_name = (ltm_partition or "").strip("~")
+    if not partition_name:
+        return "https://%s/mgmt/tm/ltm/node" % lb_ip
+    return "https://%s/mgmt/tm/ltm/node?$filter=partition%%20eq%%20%s" % (lb_ip, partition_name)
+
+
+def add_lb_ip(d, lb_ip):
     def add_lb_ip_to_result(result):
         result['lb_ip'] = lb_ip
         return result
@@ -70,37 +238,37 @@ def query_status_from_single_lb(host, lb_ip):
 
     d.addCallback(add_lb_ip_to_result)
     d.addErrback(add_lb_ip_to_failure)
-
     return d
 
 
+def evaluate_lb_response(ok, lb_response):
+    """
+    Returns True if the node is enabled, False if it is disabled and None
+    for bad responses or an inconsistent node state on this load balancer.
+    """
+    if not ok:
+        logger.error("Bad LB(%s) response/inconsistency : %s" % (lb_response.lb_ip, lb_response.value))
+        return None
+
+    if "state" not in lb_response:
+        logger.error("Malformed LB(%s) response (missing 'state' key): %s" % (lb_response["lb_ip"], lb_response))
+        return None
+
+    if "session" not in lb_response:
+        logger.error("Malformed LB(%s) response (missing monitor 'session' key): %s" % (lb_response["lb_ip"], lb_response))
+        return None
+
+    enabled = (lb_response["state"] == "up" and lb_response["session"] == "monitor-enabled")
+    disabled = (lb_response["state"] == "user-down" and lb_response["session"] == "user-disabled")
+
+    if not enabled and not disabled:
+        logger.debug("host://%s : inconsistent state on LB %s: %s" % (lb_response["name"], lb_response["lb_ip"], lb_response))
+        return None
+    return enabled
+
+
 def check_status_responses(responses):
-    enabled_results = []
-
-    for ok, lb_response in responses:
-        if not ok:
-            logger.error("Bad LB(%s) response/inconsistency : %s" % (lb_response.lb_ip, lb_response.value))
-            enabled_results.append(None)
-            continue
-
-        if "state" not in lb_response:
-            logger.error("Malformed LB(%s) response (missing 'state' key): %s" % (lb_response["lb_ip"], lb_response))
-            enabled_results.append(None)
-            continue
-
-        if "session" not in lb_response:
-            logger.error("Malformed LB(%s) response (missing monitor 'session' key): %s" % (lb_response["lb_ip"], lb_response))
-            enabled_results.append(None)
-            continue
-
-        enabled = (lb_response["state"] == "up" and lb_response["session"] == "monitor-enabled")
-        disabled = (lb_response["state"] == "user-down" and lb_response["session"] == "user-disabled")
-
-        if not enabled and not disabled:
-            logger.debug("host://%s : inconsistent state on LB %s: %s" % (lb_response["name"], lb_response["lb_ip"], lb_response))
-            enabled_results.append(None)
-        else:
-            enabled_results.append(enabled)
+    enabled_results = [evaluate_lb_response(ok, lb_response) for ok, lb_response in responses]
 
     enabled = enabled_results[0]
 
@@ -114,57 +282,343 @@ def check_status_responses(responses):
     return 0 if enabled else 3
 
 
-def query_status(host, loadbalancer_ips):
-    ds = [query_status_from_single_lb(host, lb_ip) for lb_ip in loadbalancer_ips]
-    dl = DeferredList(ds, consumeErrors=True)
-    dl.addCallback(check_status_responses)
-    return dl
-
-
-def set_state_single_loadbalancer(host, lb_ip, payload):
-    d = rest_call("https://%s/mgmt/tm/ltm/node/%s%s" % (lb_ip, CONFIG['ltm_partition'], host),
-                  HTTP_METHOD.PUT,
-                  headers=new_basicauth_headers(CONFIG),
-                  data=payload)
-
-    def add_lb_ip_to_result(result):
-        result['lb_ip'] = lb_ip
-        return result
-
-    def add_lb_ip_to_failure(failure):
-        failure.lb_ip = lb_ip
-        return failure
-
-    d.addCallback(add_lb_ip_to_result)
-    d.addErrback(add_lb_ip_to_failure)
-
-    return d
-
-
-def set_state_multiple_loadbalancer(host, lb_ips, state):
-    payload = state(host)
-    ds = [set_state_single_loadbalancer(host, lb_ip, payload)
-          for lb_ip in lb_ips]
-    dl = DeferredList(ds, consumeErrors=True)
-
-    def verify_change_successful(results):
-        ok = True
-        for success, response in results:
-            if not success:
-                logger.error('Unable to change state in LB(%s): %s' % (response.lb_ip, response.value))
-                ok = False
-            elif 'errorStack' in response:
-                logger.error('Unable to change state in LB(%s): %s' % (response['lb_ip'], response))
-                ok = False
-        return 0 if ok else 1
+class StatusResponseEvaluator(object):
+
+    """
+    Evaluates the node status responses of the load balancers as they
+    arrive, with the same result as `check_status_responses`. As soon as
+    one load balancer fails or disagrees with another one the status is
+    inconsistent (None) and the requests still in flight are cancelled.
+    """
+
+    def __init__(self, deferreds):
+        self.deferreds = list(deferreds)
+        self.responses = []
+        self.enabled = None
+        self.finished = Deferred()
+        for d in self.deferreds:
+            d.addBoth(self._receive)
+
+    def evaluate(self):
+        if not self.deferreds:
+            return maybeDeferred(check_status_responses, [])
+        return self.finished
+
+    def _receive(self, result):
+        if self.finished.called:
+            if isinstance(result, Failure) and not result.check(CancelledError):
+                logger.debug("ignoring LB response after the status was decided: %s" % result.getErrorMessage())
+            return None
+        ok = not isinstance(result, Failure)
+        enabled = evaluate_lb_response(ok, result)
+        self.responses.append(result)
+        if enabled is None:
+            self._finish(None)  # bad lb response / inconsistency on the lb
+        elif len(self.responses) > 1 and enabled != self.enabled:
+            logger.debug("inconsistency in LB cluster : %s" % self.responses)
+            self._finish(None)  # cluster inconsistency
+        elif len(self.responses) == len(self.deferreds):
+            self._finish(0 if enabled else 3)
+        self.enabled = enabled
+        return None
+
+    def _finish(self, result):
+        self.finished.callback(result)
+        for d in self.deferreds:
+            if not d.called:
+                d.cancel()
+
+
+class ConvergenceWaiter(object):
+
+    """
+    Waits until every load balancer reports the node *host* as *enabled*
+    (True) or disabled (False), or until *timeout* seconds have passed.
+    Only the load balancers which did not yet report the target state are
+    polled again (with *client*), with exponentially growing delays plus
+    jitter.
+    `wait` returns a deferred which callbacks with True if the cluster
+    converged.
+    """
+
+    def __init__(self, client, host, lb_ips, enabled, timeout, clock=None):
+        self.client = client
+        self.host = host
+        self.pending_lb_ips = list(lb_ips)
+        self.enabled = enabled
+        self.clock = clock or reactor
+        self.deadline = self.clock.seconds() + timeout
+        self.delay = CONVERGENCE_INITIAL_DELAY_IN_SECONDS
+        self.finished = Deferred()
+
+    def wait(self):
+        self._poll()
+        return self.finished
+
+    def _poll(self):
+        ds = [self.client.query_status_from_single_lb(self.host, lb_ip, from_snapshot=False)
+              for lb_ip in self.pending_lb_ips]
+        dl = DeferredList(ds, consumeErrors=True)
+        dl.addCallback(self._evaluate)
+
+    def _evaluate(self, responses):
+        self.pending_lb_ips = [lb_ip for lb_ip, (ok, lb_response) in zip(self.pending_lb_ips, responses)
+                               if evaluate_lb_response(ok, lb_response) != self.enabled]
+        if not self.pending_lb_ips:
+            self.finished.callback(True)
+            return
+        remaining = self.deadline - self.clock.seconds()
+        if remaining <= 0:
+            logger.warning("host://%s : LB(s) %s did not converge to the new state" % (self.host, ", ".join(self.pending_lb_ips)))
+            self.finished.callback(False)
+            return
+        delay = min(self.delay * random.uniform(0.5, 1.0), remaining)
+        self.delay = min(self.delay * 2, CONVERGENCE_MAX_DELAY_IN_SECONDS)
+        self.clock.callLater(delay, self._poll)
+
+
+def verify_change_successful(results):
+    ok = True
+    for success, response in results:
+        if not success:
+            logger.error('Unable to change state in LB(%s): %s' % (response.lb_ip, response.value))
+            ok = False
+        elif 'errorStack' in response:
+            logger.error('Unable to change state in LB(%s): %s' % (response['lb_ip'], response))
+            ok = False
+    return 0 if ok else 1
+
+
+class F5RestClient(object):
+
+    """
+    Talks to the iControl REST API of the load balancers with one set of
+    credentials and one *ltm_partition*. Use `configure` to get the client
+    shared by all services with the same credentials and partition; its
+    settings never change afterwards.
+    """
+
+    def __init__(self, username, password, ltm_partition, bulk_status=False, prefetch_status=False,
+                 batch_state_changes=False, incremental_decoding=False, wait_for_convergence=False,
+                 convergence_timeout=30):
+        self.ltm_partition = ltm_partition
+        self.authorization = basicauth_value(username, password)
+        self.bulk_status = bulk_status
+        self.prefetch = prefetch_status
+        self.batch_state_changes = batch_state_changes
+        self.incremental_decoding = incremental_decoding
+        self.wait_for_convergence_enabled = wait_for_convergence
+        self.convergence_timeout = convergence_timeout
+        self.contexts = {}
+        self.snapshot = NodeCollectionSnapshot(self)
+
+    def request_context(self, lb_ip):
+        if lb_ip not in self.contexts:
+            self.contexts[lb_ip] = RequestContext(lb_ip, self.ltm_partition, self.authorization)
+        return self.contexts[lb_ip]
+
+    def prefetch_status(self, lb_ips):
+        """
+        Starts fetching the node collections of all *lb_ips* so that later
+        status queries are answered from the snapshot.
+        """
+        for lb_ip in sorted(set(lb_ips)):
+            self.snapshot.prefetch(lb_ip)
+
+    def query_node_from_single_lb(self, host, lb_ip):
+        context = self.request_context(lb_ip)
+        return rest_call(context.node_url(host),
+                         HTTP_METHOD.GET,
+                         headers=context.headers,
+                         required_members=NODE_STATUS_MEMBERS if self.incremental_decoding else None)
+
+    def query_status_from_single_lb(self, host, lb_ip, from_snapshot=None):
+        if from_snapshot is None:
+            from_snapshot = self.bulk_status or self.prefetch
+        if from_snapshot:
+            d = self.snapshot.node(lb_ip, host)
+            d.addCallback(lambda node: node if node is not None else self.query_node_from_single_lb(host, lb_ip))
+        else:
+            d = self.query_node_from_single_lb(host, lb_ip)
+        return add_lb_ip(d, lb_ip)
+
+    def query_status(self, host, loadbalancer_ips):
+        ds = [self.query_status_from_single_lb(host, lb_ip) for lb_ip in loadbalancer_ips]
+        return StatusResponseEvaluator(ds).evaluate()
+
+    def wait_for_convergence(self, result, host, loadbalancer_ips, enabled):
+        """
+        Callback for a state change *result*: waits for the cluster to
+        converge after a successful change and passes the result on.
+        """
+        if result != 0 or not self.wait_for_convergence_enabled:
+            return result
+        d = ConvergenceWaiter(self, host, loadbalancer_ips, enabled, self.convergence_timeout).wait()
+        d.addCallback(lambda converged: result)
+        return d
+
+    def set_state_single_loadbalancer(self, host, lb_ip, payload, transaction_id=None):
+        self.snapshot.invalidate(lb_ip, host)
+        context = self.request_context(lb_ip)
+        if transaction_id is not None:
+            headers = context.transaction_headers(transaction_id)
+        else:
+            headers = context.headers
+        d = rest_call(context.node_url(host),
+                      HTTP_METHOD.PUT,
+                      headers=headers,
+                      data=payload)
+        return add_lb_ip(d, lb_ip)
+
+    def set_state_multiple_loadbalancer(self, host, lb_ips, state):
+        payload = state(host)
+        ds = [self.set_state_single_loadbalancer(host, lb_ip, payload)
+              for lb_ip in lb_ips]
+        dl = DeferredList(ds, consumeErrors=True)
+        dl.addCallback(verify_change_successful)
+        return dl
+
+    def set_state_in_transaction(self, hosts, lb_ip, state):
+        """
+        Changes the state of all *hosts* on the load balancer *lb_ip* with
+        one iControl REST transaction.
+        Returns a deferred which will callback with a dictionary host =>
+        (success, response) like the results of
+        `set_state_single_loadbalancer`.
+        """
+        context = self.request_context(lb_ip)
+
+        def start_failed(failure):
+            failure.lb_ip = lb_ip
+            return dict((host, (False, failure)) for host in hosts)
+
+        def add_commands(transaction):
+            if "transId" not in transaction:
+                raise RuntimeError("Unable to start transaction in LB(%s): %s" % (lb_ip, transaction))
+            transaction_id = transaction["transId"]
+            ds = [self.set_state_single_loadbalancer(host, lb_ip, state(host), transaction_id)
+                  for host in hosts]
+            dl = DeferredList(ds, consumeErrors=True)
+            dl.addCallback(commit, transaction_id)
+            return dl
+
+        def commit(queued, transaction_id):
+            results = dict(zip(hosts, queued))
+            d = rest_call("%s/%s" % (context.transaction_url, transaction_id),
+                          HTTP_METHOD.PATCH,
+                          headers=context.headers,
+                          data='{"state": "VALIDATING"}')
+
+            def apply_commit_result(response):
+                if response.get("state") == "COMPLETED" and "errorStack" not in response:
+                    return results
+                response = dict(response, lb_ip=lb_ip)
+                response.setdefault("errorStack", [response.get("failureReason", "transaction %s not completed" % transaction_id)])
+                return dict((host, (True, response) if success else (success, result))
+                            for host, (success, result) in results.items())
+
+            def commit_failed(failure):
+                failure.lb_ip = lb_ip
+                return dict((host, (False, failure) if success else (success, result))
+                            for host, (success, result) in results.items())
+
+            d.addCallbacks(apply_commit_result, commit_failed)
+            return d
+
+        d = rest_call(context.transaction_url,
+                      HTTP_METHOD.POST,
+                      headers=context.headers,
+                      data="{}")
+        d.addCallback(add_commands)
+        d.addErrback(start_failed)
+        return d
+
+    def set_state_many(self, hosts, lb_ips, state):
+        """
+        Changes the state of all *hosts* with one transaction per load
+        balancer. Returns a deferred which will callback with a dictionary
+        host => 0 (state changed on every load balancer) or 1 (failed on at
+        least one).
+        """
+        ds = [self.set_state_in_transaction(hosts, lb_ip, state) for lb_ip in lb_ips]
+        dl = DeferredList(ds, consumeErrors=True)
+
+        def verify_changes_successful(results_per_lb):
+            results_per_host = dict((host, []) for host in hosts)
+            for success, results in results_per_lb:
+                for host in hosts:
+                    results_per_host[host].append(results[host] if success else (False, results))
+            return dict((host, verify_change_successful(results))
+                        for host, results in results_per_host.items())
+
+        dl.addCallback(verify_changes_successful)
+        return dl
+
+    def set_status_up_many(self, hosts, loadbalancer_ips):
+        return self.set_state_many(hosts, loadbalancer_ips, State.up)
+
+    def set_status_down_many(self, hosts, loadbalancer_ips):
+        return self.set_state_many(hosts, loadbalancer_ips, State.down)
+
+    def set_status_up(self, host, loadbalancer_ips):
+        return self._set_status(host, loadbalancer_ips, State.up, True)
+
+    def set_status_down(self, host, loadbalancer_ips):
+        return self._set_status(host, loadbalancer_ips, State.down, False)
+
+    def _set_status(self, host, loadbalancer_ips, state, enabled):
+        if self.batch_state_changes:
+            d = BATCHER.set_state(self, host, loadbalancer_ips, state)
+        else:
+            d = self.set_state_multiple_loadbalancer(host, loadbalancer_ips, state)
+        d.addCallback(self.wait_for_convergence, host, loadbalancer_ips, enabled)
+        return d
+
+
+class StateChangeBatcher(object):
+
+    """
+    Collects the state changes requested within *window* seconds for the same
+    client, load balancers and target state and applies them with
+    `F5RestClient.set_state_many`.
+    """
+
+    def __init__(self, window=STATE_CHANGE_BATCH_WINDOW_IN_SECONDS):
+        self.window = window
+        self.pending = {}
+
+    def set_state(self, client, host, lb_ips, state):
+        key = (client, state, tuple(lb_ips))
+        if key not in self.pending:
+            self.pending[key] = {}
+            reactor.callLater(self.window, self.flush, key)
+        d = Deferred()
+        self.pending[key].setdefault(host, []).append(d)
+        return d
+
+    def flush(self, key):
+        waiting = self.pending.pop(key)
+        client, state, lb_ips = key
+        hosts = sorted(waiting)
+        if len(hosts) == 1:
+            d = client.set_state_multiple_loadbalancer(hosts[0], lb_ips, state)
+            d.addCallback(lambda result: {hosts[0]: result})
+        else:
+            logger.debug("changing state of %d hosts in one transaction per LB" % len(hosts))
+            d = client.set_state_many(hosts, lb_ips, state)
 
-    dl.addCallback(verify_change_successful)
-    return dl
+        def notify(results):
+            for host in hosts:
+                for waiting_deferred in waiting[host]:
+                    waiting_deferred.callback(results[host])
 
+        def notify_failure(failure):
+            for host in hosts:
+                for waiting_deferred in waiting[host]:
+                    waiting_deferred.errback(failure)
 
-def set_status_up(host, loadbalancer_ips):
-    return set_state_multiple_loadbalancer(host, loadbalancer_ips, State.up)
+        d.addCallbacks(notify, notify_failure)
+        return d
 
 
-def set_status_down(host, loadbalancer_ips):
-    return set_state_multiple_loadbalancer(host, loadbalancer_ips, State.down)
+BATCHER = StateChangeBatcher()
@@ -0,0 +1,107 @@
+#   YADT - an Augmented Deployment Tool
+#   Copyright (C) 2010-2014  Immobilien Scout GmbH
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+    The jsonstream module
+    Decodes the members of a JSON object while the document arrives in chunks.
+'''
+
+import codecs
+import json
+import re
+
+STRUCTURAL_CHARACTERS = re.compile(r'["{}\[\],]')
+STRING_CHARACTERS = re.compile(r'["\\]')
+
+
+class IncrementalObjectDecoder(object):
+
+    """
+    Feed the text of a JSON object chunk by chunk with `feed`.
+    Every top-level member of the object is decoded as soon as it is complete
+    and stored in `members`, so callers can look at the members which already
+    arrived (`has_members`) before the whole document was received.
+    Only the text of the member currently being received is buffered.
+    """
+
+    def __init__(self):
+        self.members = {}
+        self.finished = False
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._pieces = []
+        self._text_decoder = codecs.getincrementaldecoder('utf-8')()
+
+    def has_members(self, keys):
+        return all(key in self.members for key in keys)
+
+    def feed(self, data):
+        if self.finished:
+            return
+        text = self._text_decoder.decode(data)
+        member_start = 0
+        position = 0
+        if self._escaped and text:
+            self._escaped = False
+            position = 1
+
+        while position < len(text):
+            if self._in_string:
+                match = STRING_CHARACTERS.search(text, position)
+                if match is None:
+                    break
+                position = match.end()
+                if match.group() == '"':
+                    self._in_string = False
+                elif position == len(text):
+                    self._escaped = True
+                else:
+                    position += 1
+                continue
+
+            match = STRUCTURAL_CHARACTERS.search(text, position)
+            if match is None:
+                break
+            position = match.end()
+            character = match.group()
+            if character == '"':
+                self._in_string = True
+            elif character in '{[':
+                if self._depth == 0:
+                    if character != '{':
+                        raise ValueError('JSON document is not an object')
+                    member_start = position
+                self._depth += 1
+            elif character in '}]':
+                self._depth -= 1
+                if self._depth == 0:
+                    self._complete_member(text[member_start:position - 1])
+                    self.finished = True
+                    return
+            elif self._depth == 1:
+                self._complete_member(text[member_start:position - 1])
+                member_start = position
+
+        if self._depth > 0:
+            self._pieces.append(text[member_start:])
+
+    def _complete_member(self, tail):
+        self._pieces.append(tail)
+        member = ''.join(self._pieces)
+        self._pieces = []
+        if member.strip():
+            self.members.update(json.loads('{%s}' % member))
@@ -16,12 +16,33 @@
 
 __author__ = 'Maximilien Riehl'
 
-from twisted.web.client import Agent, HTTPConnectionPool
-from twisted.internet import reactor
+from twisted.web.client import Agent
+from twisted.internet import reactor, defer
+from twisted.internet.defer import DeferredSemaphore
+from twisted.internet.error import TimeoutError
+from twisted.internet.protocol import Protocol
 import logging
 import simplejson as json
 
+from yadtshell_plugins.circuitbreaker import BREAKERS
+from yadtshell_plugins.jsonstream import IncrementalObjectDecoder
+from yadtshell_plugins.metrics import METRICS, CONNECT, LATENCY, TIME_TO_FIRST_BYTE
+from yadtshell_plugins.rest import BodyConsumer, ConnectionPools, ResponseTooLargeError, resize_semaphore
+from yadtshell_plugins import timeouts
+from yadtshell_plugins.timeouts import TIMEOUTS
+
+LIVESTATUS_SERVICE_PORT = 8080
 HTTP_CONNECT_TIMEOUT_IN_SECONDS = 120
+HTTP_FIRST_BYTE_TIMEOUT_IN_SECONDS = 30
+HTTP_MAX_CONNECTIONS_PER_SERVER = 10
+HTTP_MAX_LONG_POLLS_PER_SERVER = 10
+MAX_HOSTS_PER_STATUS_QUERY = 100
+MAX_RESPONSE_SIZE_IN_BYTES = 16 * 1024 * 1024
+RESPONSE_HEAD_SIZE_IN_BYTES = 256
+NOTIFICATIONS_WAIT_TIMEOUT_IN_SECONDS = 20
+SUBSCRIBE_NOTIFICATION_STATE = False
+SUBSCRIPTION_WAIT_TRIGGER = 'command'
+SUBSCRIPTION_WAIT_TIMEOUT_IN_SECONDS = 10
 
 '''
     The livestatus_service module
@@ -32,6 +53,88 @@ HTTP_CONNECT_TIMEOUT_IN_SECONDS = 120
 
 logger = logging.getLogger('yadtshell.plugins.livestatus_service')
 
+POOLS = ConnectionPools(max_persistent_per_host=HTTP_MAX_CONNECTIONS_PER_SERVER, backend='livestatus')
+METRICS.add_statistics_provider('livestatus_connections', POOLS.statistics)
+TIMEOUTS.configure('livestatus', timeouts={CONNECT: HTTP_CONNECT_TIMEOUT_IN_SECONDS,
+                                           TIME_TO_FIRST_BYTE: HTTP_FIRST_BYTE_TIMEOUT_IN_SECONDS})
+TIMEOUTS.configure('livestatus-wait', timeouts={TIME_TO_FIRST_BYTE: HTTP_FIRST_BYTE_TIMEOUT_IN_SECONDS})
+CONNECTION_LIMITS = {}
+LONG_POLL_LIMITS = {}
+STATUS_COALESCERS = {}
+SUBSCRIPTIONS = {}
+
+
+def configure(config):
+    """
+    Applies the optional connection settings from the livestatusservice
+    configuration module *config* to the shared connection pools.
+    """
+    global HTTP_MAX_CONNECTIONS_PER_SERVER, HTTP_MAX_LONG_POLLS_PER_SERVER, LIVESTATUS_SERVICE_PORT
+    global MAX_RESPONSE_SIZE_IN_BYTES, SUBSCRIBE_NOTIFICATION_STATE
+    max_connections = getattr(config, 'MAX_CONNECTIONS_PER_SERVER', None)
+    if max_connections is not None and max_connections != HTTP_MAX_CONNECTIONS_PER_SERVER:
+        for limit in CONNECTION_LIMITS.values():
+            resize_semaphore(limit, max_connections)
+        HTTP_MAX_CONNECTIONS_PER_SERVER = max_connections
+    max_long_polls = getattr(config, 'MAX_LONG_POLLS_PER_SERVER', None)
+    if max_long_polls is not None and max_long_polls != HTTP_MAX_LONG_POLLS_PER_SERVER:
+        for limit in LONG_POLL_LIMITS.values():
+            resize_semaphore(limit, max_long_polls)
+        HTTP_MAX_LONG_POLLS_PER_SERVER = max_long_polls
+    LIVESTATUS_SERVICE_PORT = getattr(config, 'LIVESTATUS_SERVICE_PORT', LIVESTATUS_SERVICE_PORT)
+    MAX_RESPONSE_SIZE_IN_BYTES = getattr(config, 'MAX_RESPONSE_SIZE_IN_BYTES', MAX_RESPONSE_SIZE_IN_BYTES)
+    SUBSCRIBE_NOTIFICATION_STATE = getattr(config, 'SUBSCRIBE_NOTIFICATION_STATE', SUBSCRIBE_NOTIFICATION_STATE)
+    POOLS.configure(max_persistent_per_host=max_connections,
+                    cached_connection_timeout=getattr(config, 'CONNECTION_IDLE_TIMEOUT_IN_SECONDS', None))
+    timeouts.configure('livestatus', config)
+    BREAKERS.configure('livestatus',
+                       failure_threshold=getattr(config, 'CIRCUIT_BREAKER_FAILURE_THRESHOLD', None),
+                       cooldown=getattr(config, 'CIRCUIT_BREAKER_COOLDOWN_IN_SECONDS', None))
+    METRICS.configure(dump_file=getattr(config, 'METRICS_FILE', None),
+                      dump_format=getattr(config, 'METRICS_FORMAT', None))
+
+
+def connection_limit(livestatus_server):
+    if livestatus_server not in CONNECTION_LIMITS:
+        CONNECTION_LIMITS[livestatus_server] = DeferredSemaphore(HTTP_MAX_CONNECTIONS_PER_SERVER)
+    return CONNECTION_LIMITS[livestatus_server]
+
+
+def long_poll_limit(livestatus_server):
+    if livestatus_server not in LONG_POLL_LIMITS:
+        LONG_POLL_LIMITS[livestatus_server] = DeferredSemaphore(HTTP_MAX_LONG_POLLS_PER_SERVER)
+    return LONG_POLL_LIMITS[livestatus_server]
+
+
+def status_coalescer(livestatus_server):
+    if livestatus_server not in STATUS_COALESCERS:
+        STATUS_COALESCERS[livestatus_server] = StatusQueryCoalescer(livestatus_server)
+    return STATUS_COALESCERS[livestatus_server]
+
+
+def subscription(livestatus_server):
+    if livestatus_server not in SUBSCRIPTIONS:
+        SUBSCRIPTIONS[livestatus_server] = NotificationStateSubscription(livestatus_server)
+    return SUBSCRIPTIONS[livestatus_server]
+
+
+def read_body(response, timer=None):
+    d = defer.Deferred(lambda _: consumer.abort())
+    consumer = BodyConsumer(d, max_size=MAX_RESPONSE_SIZE_IN_BYTES, timer=timer)
+    response.deliverBody(consumer)
+    return d
+
+
+def read_status_page(response, timer=None):
+    """
+    Returns a deferred which will callback with the `StatusPage` decoded
+    from the body of a status query keyed by host.
+    """
+    d = defer.Deferred(lambda _: consumer.abort())
+    consumer = StatusPageConsumer(d, max_size=MAX_RESPONSE_SIZE_IN_BYTES, timer=timer)
+    response.deliverBody(consumer)
+    return d
+
 
 class LivestatusServiceHandler(object):
 
@@ -45,58 +148,459 @@ class LivestatusServiceHandler(object):
         url = url.replace('\n', '\\n')
         return url
 
-    def _encode_and_defer_url_call(self, url, callback):
+    def _encode_and_defer_url_call(self, url, reader=read_body, long_poll=False):
+        """
+        Returns a deferred which will callback with the body of the response
+        as returned by *reader*. The connection slot of the server is released
+        once the body was read, before the callbacks of the caller run, so
+        that these may call the server again. Long polling queries hold slots
+        of their own (`HTTP_MAX_LONG_POLLS_PER_SERVER`) while they wait, so
+        that they cannot starve the other calls.
+        The circuit breaker of the server counts failures to answer only, not
+        responses which cannot be read (see `ResponseContentFailure`).
+        """
         url = self._encode(url)
-        d = self._get_page(url)
-        timeout_call = reactor.callLater(30, d.cancel)
+        if long_poll:
+            limit = long_poll_limit(self.livestatus_server)
+        else:
+            limit = connection_limit(self.livestatus_server)
 
-        def success_or_failure(passthrough):
-            if timeout_call.active():
-                timeout_call.cancel()
-            else:
-                logger.error('Connected to livestatus server, but timed out waiting for an answer.')
-            return passthrough
-        d.addBoth(success_or_failure)
-        d.addCallback(callback)
+        def call():
+            d = self._defer_url_call(url, reader, long_poll)
+            d.addErrback(ResponseContentFailure.wrap)
+            return d
+
+        d = limit.run(BREAKERS.call, 'livestatus', self.livestatus_server, call)
+        d.addCallback(ResponseContentFailure.unwrap)
         return d
 
+    def _defer_url_call(self, url, reader, long_poll=False):
+        """
+        Long polling queries are measured and timed out as backend
+        'livestatus-wait', which never adapts its timeouts, so that their
+        waiting does not inflate the latencies of the other calls.
+        """
+        backend = 'livestatus-wait' if long_poll else 'livestatus'
+        timer = METRICS.call(backend, self.livestatus_server)
+        d = self._get_page(url)
+        TIMEOUTS.expire(d, backend, TIME_TO_FIRST_BYTE, self.livestatus_server)
+        d.addCallback(timer.first_byte)
+        d.addCallback(reader, timer)
+        TIMEOUTS.expire(d, backend, LATENCY, self.livestatus_server)
+        return timer.track(d)
+
     def _get_page(self, url):
         agent = Agent(reactor,
-                      connectTimeout=HTTP_CONNECT_TIMEOUT_IN_SECONDS,
-                      pool=HTTPConnectionPool(reactor))
+                      connectTimeout=TIMEOUTS.timeout('livestatus', CONNECT, self.livestatus_server),
+                      pool=POOLS.pool(self.livestatus_server))
         deferred = agent.request('GET', url)
         return deferred
 
     def build_deferred_for_service_notification_status(self, callback):
-        url = '''http://%s:8080/query?q=GET hosts
-Columns: alias notifications_enabled
-Filter: alias = %s&key=alias''' % (self.livestatus_server, self.host)
-        return self._encode_and_defer_url_call(url, callback)
+        d = self.build_deferred_for_hosts_notification_status([self.host])
+        d.addCallback(lambda page: page.response_for(self.host))
+        d.addCallback(callback)
+        return d
+
+    def build_deferred_for_hosts_notification_status(self, hosts, wait_timeout=None):
+        """
+        Returns a deferred which will callback with the `StatusPage` of
+        *hosts*. With *wait_timeout* (in seconds) livestatus answers after
+        the next `SUBSCRIPTION_WAIT_TRIGGER` event or when the timeout
+        elapsed.
+        """
+        filters = ''.join('\nFilter: alias = %s' % host for host in hosts)
+        if len(hosts) > 1:
+            filters += '\nOr: %d' % len(hosts)
+        if wait_timeout is not None:
+            filters += '\nWaitTrigger: %s\nWaitTimeout: %d' % (SUBSCRIPTION_WAIT_TRIGGER, wait_timeout * 1000)
+        url = '''http://%s:%d/query?q=GET hosts
+Columns: alias notifications_enabled%s&key=alias''' % (self.livestatus_server, LIVESTATUS_SERVICE_PORT, filters)
+        return self._encode_and_defer_url_call(url, read_status_page, long_poll=wait_timeout is not None)
+
+    def build_deferred_for_batched_service_notification_status(self):
+        """
+        Returns a deferred which will callback with the
+        `LivestatusServiceStatusResponse` for this host.
+        The query is merged with the status queries of all other hosts
+        on the same livestatus server issued during this reactor iteration.
+        With `SUBSCRIBE_NOTIFICATION_STATE` a host which is currently watched
+        is answered from the subscription's view.
+        """
+        if SUBSCRIBE_NOTIFICATION_STATE:
+            return subscription(self.livestatus_server).status(self.host)
+        return status_coalescer(self.livestatus_server).query(self.host)
 
     def build_deferred_livestatus_command(self, command, callback):
-        url = 'http://%s:8080/cmd?q=%s;%s' % (
-            self.livestatus_server, command, self.host)
-        return self._encode_and_defer_url_call(url, callback)
+        url = 'http://%s:%d/cmd?q=%s;%s' % (
+            self.livestatus_server, LIVESTATUS_SERVICE_PORT, command, self.host)
+        d = self._encode_and_defer_url_call(url)
+        d.addCallback(callback)
+        return d
+
+    def build_deferred_for_pending_services(self, targets, wait_for=None, wait_timeout=None):
+        """
+        Returns a deferred which will callback with the rows (host, service,
+        notifications state) of the services of the hosts in *targets* whose
+        notification state differs from the target state of their host.
+        With *wait_for* (such a row) livestatus answers once this service
+        reached the target state or when *wait_timeout* (in seconds)
+        elapsed.
+        """
+        hosts = sorted(targets)
+        filters = ''.join('\nFilter: host_name = %s\nFilter: notifications_enabled != %d\nAnd: 2' % (host, targets[host])
+                          for host in hosts)
+        if len(hosts) > 1:
+            filters += '\nOr: %d' % len(hosts)
+        if wait_for is not None:
+            host, service = wait_for[0], wait_for[1]
+            filters += '\nWaitObject: %s;%s\nWaitCondition: notifications_enabled = %d\nWaitTimeout: %d' % (
+                host, service, targets[host], wait_timeout * 1000)
+        url = '''http://%s:%d/query?q=GET services
+Columns: host_name description notifications_enabled%s''' % (self.livestatus_server, LIVESTATUS_SERVICE_PORT, filters)
+        d = self._encode_and_defer_url_call(url, long_poll=wait_for is not None)
+        d.addCallback(json.loads)
+        return d
 
     def build_deferred_livestatus_wait_for_notifications_state(self, callback):
+        """
+        Waits until the host and all of its services reached the notification
+        state implied by `is_starting`, then calls *callback* with the result
+        of the host wait. With `SUBSCRIBE_NOTIFICATION_STATE` both are
+        awaited by the subscription of the livestatus server.
+        """
         target_notifications_state = 1 if self.is_starting else 0
-        url = '''http://{0}:8080/query?q=GET hosts
+        if SUBSCRIBE_NOTIFICATION_STATE:
+            d = subscription(self.livestatus_server).wait_for(self.host, target_notifications_state)
+        else:
+            d = defer.DeferredList([self._wait_for_host_notifications_state(target_notifications_state),
+                                    self.wait_for_services_notifications_state({self.host: target_notifications_state})],
+                                   fireOnOneErrback=True, consumeErrors=True)
+            d.addCallbacks(lambda results: results[0][1], lambda failure: failure.value.subFailure)
+        d.addCallback(callback)
+        return d
+
+    def _wait_for_host_notifications_state(self, target_notifications_state):
+        url = '''http://{0}:{3}/query?q=GET hosts
 Columns: host_name notifications_enabled
 Filter: host_name = {1}
 WaitObject: {1}
 WaitCondition: notifications_enabled = {2}
-WaitTimeout: 20000'''.format(self.livestatus_server, self.host, target_notifications_state)
-        return self._encode_and_defer_url_call(url, callback)
+WaitTimeout: {4}'''.format(self.livestatus_server, self.host, target_notifications_state,
+                           LIVESTATUS_SERVICE_PORT, NOTIFICATIONS_WAIT_TIMEOUT_IN_SECONDS * 1000)
+        return self._encode_and_defer_url_call(url, long_poll=True)
+
+    def wait_for_services_notifications_state(self, targets):
+        """
+        Returns a deferred which will callback with the rows of the services
+        which are still pending (see `build_deferred_for_pending_services`)
+        once there are none left or `NOTIFICATIONS_WAIT_TIMEOUT_IN_SECONDS`
+        elapsed. Livestatus can wait for the condition of a single service
+        only, so each query long-polls until the first pending service
+        reached its target state and returns the services still pending
+        then. A service which reached its state already answers at once.
+        """
+        deadline = reactor.seconds() + NOTIFICATIONS_WAIT_TIMEOUT_IN_SECONDS
+
+        def check(pending_services):
+            remaining = deadline - reactor.seconds()
+            if not pending_services:
+                return pending_services
+            if remaining <= 0:
+                logger.warning('Timed out waiting for the notification state of services %s on %s' %
+                               (', '.join('%s;%s' % (row[0], row[1]) for row in pending_services), self.livestatus_server))
+                return pending_services
+            pending_targets = dict((row[0], targets[row[0]]) for row in pending_services)
+            d = self.build_deferred_for_pending_services(pending_targets, pending_services[0], remaining)
+            d.addCallback(check)
+            return d
+
+        d = self.build_deferred_for_pending_services(targets)
+        d.addCallback(check)
+        return d
+
+
+class ResponseContentFailure(object):
+
+    """
+    Carries a failure caused by the content of a response (an unexpected or
+    too large body) past the circuit breaker as a result, see `wrap` and
+    `unwrap`.
+    """
+
+    CONTENT_ERRORS = (ValueError, ResponseTooLargeError)
+
+    def __init__(self, failure):
+        self.failure = failure
+
+    @classmethod
+    def wrap(cls, failure):
+        if failure.check(*cls.CONTENT_ERRORS):
+            return cls(failure)
+        return failure
+
+    @staticmethod
+    def unwrap(result):
+        if isinstance(result, ResponseContentFailure):
+            return result.failure
+        return result
+
+
+class StatusQueryCoalescer(object):
+
+    """
+    Collects the status queries for one livestatus server during a reactor
+    iteration and sends them as one query with OR-combined host filters.
+    The per-host responses are fanned out to the waiting deferreds.
+    """
+
+    def __init__(self, livestatus_server):
+        self.livestatus_server = livestatus_server
+        self.pending = {}
+        self.flush_call = None
+
+    def query(self, host):
+        d = defer.Deferred()
+        self.pending.setdefault(host, []).append(d)
+        if self.flush_call is None:
+            self.flush_call = reactor.callLater(0, self.flush)
+        return d
+
+    def flush(self):
+        self.flush_call = None
+        pending, self.pending = self.pending, {}
+        hosts = sorted(pending)
+        for start in range(0, len(hosts), MAX_HOSTS_PER_STATUS_QUERY):
+            self._query_hosts(hosts[start:start + MAX_HOSTS_PER_STATUS_QUERY], pending)
+
+    def _query_hosts(self, hosts, pending):
+        logger.debug('querying notification status of %d hosts from %s' % (len(hosts), self.livestatus_server))
+        handler = LivestatusServiceHandler(self.livestatus_server, None)
+
+        def fan_out_responses(page):
+            for host in hosts:
+                response = page.response_for(host)
+                for waiting in pending[host]:
+                    waiting.callback(response)
+
+        def fan_out_failure(failure):
+            for host in hosts:
+                for waiting in pending[host]:
+                    waiting.errback(failure)
+
+        d = handler.build_deferred_for_hosts_notification_status(hosts)
+        d.addCallbacks(fan_out_responses, fan_out_failure)
+        return d
+
+
+class NotificationStateSubscription(object):
+
+    """
+    Keeps an in-memory view of the notification state of the hosts on one
+    livestatus server. While deferreds wait for hosts to reach a state, one
+    query for all of these hosts is kept pending on the server: it
+    long-polls with `WaitTrigger` and is issued again as soon as it
+    returned. Livestatus can wait for the condition of a single object
+    only, hence the trigger. The services of all hosts which reached their
+    target state in a response are then awaited together (see
+    `LivestatusServiceHandler.wait_for_services_notifications_state`), and
+    each waiting deferred is resolved with the response of its host.
+    Hosts without a target state reached after
+    `NOTIFICATIONS_WAIT_TIMEOUT_IN_SECONDS` are resolved with their last
+    known response, or fail with a `TimeoutError` if none was received.
+    """
+
+    def __init__(self, livestatus_server, clock=reactor):
+        self.livestatus_server = livestatus_server
+        self.clock = clock
+        self.view = {}
+        self.waiting = {}
+        self.confirming = set()
+        self.polling = False
+        self.unconfirmed = False
+
+    def status(self, host):
+        if self.polling and host in self.waiting and host in self.view:
+            return defer.succeed(self._response_for(host))
+
+        def observe(response):
+            if isinstance(response.parsed_response, dict) and host in response.parsed_response:
+                self.view[host] = response.parsed_response[host]
+            return response
+
+        d = status_coalescer(self.livestatus_server).query(host)
+        d.addCallback(observe)
+        return d
+
+    def wait_for(self, host, target_notifications_state):
+        d = defer.Deferred()
+        timeout_call = self.clock.callLater(NOTIFICATIONS_WAIT_TIMEOUT_IN_SECONDS, self._time_out, host, d)
+        self.waiting.setdefault(host, []).append((target_notifications_state, d, timeout_call))
+        self.unconfirmed = True
+        if not self.polling:
+            self.polling = True
+            self.clock.callLater(0, self._poll)
+        return d
+
+    def _poll(self):
+        hosts = sorted(self.waiting)
+        if not hosts:
+            self.polling = False
+            return
+        wait_timeout = None if self.unconfirmed else SUBSCRIPTION_WAIT_TIMEOUT_IN_SECONDS
+        self.unconfirmed = False
+        handler = LivestatusServiceHandler(self.livestatus_server, None)
+        queries = []
+        for start in range(0, len(hosts), MAX_HOSTS_PER_STATUS_QUERY):
+            chunk = hosts[start:start + MAX_HOSTS_PER_STATUS_QUERY]
+            d = handler.build_deferred_for_hosts_notification_status(chunk, wait_timeout=wait_timeout)
+            d.addCallbacks(self._observe, self._fail, errbackArgs=(chunk,))
+            queries.append(d)
+        defer.DeferredList(queries).addCallback(lambda _: self._poll())
+
+    def _observe(self, page):
+        self.view.update(page.rows)
+        reached = {}
+        for host, waiters in self.waiting.items():
+            row = page.rows.get(host)
+            state = row.get('notifications_enabled') if isinstance(row, dict) else None
+            if host not in self.confirming and any(waiter[0] == state for waiter in waiters):
+                reached[host] = state
+        if reached:
+            self._confirm_services(reached)
+
+    def _confirm_services(self, reached):
+        self.confirming.update(reached)
+        handler = LivestatusServiceHandler(self.livestatus_server, None)
+        d = handler.wait_for_services_notifications_state(reached)
+        d.addCallbacks(self._confirmed, self._fail, callbackArgs=(reached,), errbackArgs=(sorted(reached),))
+        d.addBoth(lambda _: self.confirming.difference_update(reached))
+
+    def _confirmed(self, pending_services, reached):
+        for host, state in reached.items():
+            for waiter in [waiter for waiter in self.waiting.get(host, []) if waiter[0] == state]:
+                self._resolve(host, waiter, self._response_for(host))
+
+    def _time_out(self, host, d):
+        logger.warning('Timed out waiting for the notification state of %s on %s' % (host, self.livestatus_server))
+        for waiter in [waiter for waiter in self.waiting.get(host, []) if waiter[1] is d]:
+            if host in self.view:
+                self._resolve(host, waiter, self._response_for(host))
+            else:
+                self._remove(host, waiter).errback(TimeoutError(
+                    'notification state of %s' % host,
+                    'no response from %s within %ds' % (self.livestatus_server, NOTIFICATIONS_WAIT_TIMEOUT_IN_SECONDS)))
+
+    def _resolve(self, host, waiter, response):
+        self._remove(host, waiter).callback(response)
+
+    def _fail(self, failure, hosts):
+        for host in hosts:
+            for waiter in list(self.waiting.get(host, [])):
+                self._remove(host, waiter).errback(failure)
+
+    def _remove(self, host, waiter):
+        target_notifications_state, d, timeout_call = waiter
+        self.waiting[host].remove(waiter)
+        if not self.waiting[host]:
+            del self.waiting[host]
+        if timeout_call.active():
+            timeout_call.cancel()
+        return d
+
+    def _response_for(self, host):
+        return StatusPage({host: self.view[host]} if host in self.view else {}).response_for(host)
+
+
+class StatusPage(object):
+
+    """
+    The rows of a status query keyed by host (`&key=alias`).
+    Single hosts are looked up with `row` or `response_for`.
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def row(self, host):
+        return self.rows.get(host)
+
+    def response_for(self, host):
+        return LivestatusServiceStatusResponse(json.dumps(self.row(host)), host, self.rows)
+
+
+class StatusPageConsumer(Protocol):
+
+    """
+    Decodes the body of a status query while it arrives, so that the raw
+    body is neither buffered nor joined. The decoded rows of all hosts are
+    kept until the page is complete. Bodies larger than *max_size* bytes and
+    bodies which are no status page are aborted. *finished* callbacks with
+    the `StatusPage`, cancelling it aborts the transfer.
+    """
+
+    def __init__(self, finished, max_size, timer=None):
+        self.finished = finished
+        self.max_size = max_size
+        self.timer = timer
+        self.decoder = IncrementalObjectDecoder()
+        self.head = []
+        self.head_size = 0
+        self.size = 0
+        self.done = False
+
+    def abort(self):
+        self.done = True
+        if self.transport is not None:
+            self.transport.stopProducing()
+
+    def dataReceived(self, data):
+        if self.timer is not None:
+            self.timer.received(len(data))
+        if self.done:
+            return
+        self.size += len(data)
+        if self.size > self.max_size:
+            self._finish_with_failure(ResponseTooLargeError('Livestatus response exceeds %d bytes' % self.max_size))
+            self.transport.stopProducing()
+            return
+        if self.head_size < RESPONSE_HEAD_SIZE_IN_BYTES:
+            self.head.append(data[:RESPONSE_HEAD_SIZE_IN_BYTES - self.head_size])
+            self.head_size += len(self.head[-1])
+        try:
+            if b''.join(self.head).lstrip()[:1] not in (b'', b'{'):
+                raise ValueError('livestatus response is not a JSON object')
+            self.decoder.feed(data)
+        except ValueError:
+            self._finish_with_failure(ValueError('Unexpected livestatus response: %r' % b''.join(self.head)))
+            self.transport.stopProducing()
+
+    def connectionLost(self, reason):
+        if self.done:
+            return
+        if self.decoder.finished:
+            self.done = True
+            self.finished.callback(StatusPage(self.decoder.members))
+        else:
+            self._finish_with_failure(ValueError('Incomplete livestatus response: %r' % b''.join(self.head)))
+
+    def _finish_with_failure(self, exception):
+        self.done = True
+        self.finished.errback(exception)
 
 
 class LivestatusServiceStatusResponse(object):
 
-    def __init__(self, response, host):
+    def __init__(self, response, host, parsed_response=None):
         self.response = response
         self.host = host
+        self.parsed_response = parsed_response
 
     def notifications_are_enabled(self):
-        response = json.loads(self.response)
+        if self.parsed_response is not None:
+            response = self.parsed_response
+        else:
+            response = json.loads(self.response)
         host_state = response[self.host]
         host_notifications_state = host_state['notifications_enabled']
         if host_notifications_state == 1:
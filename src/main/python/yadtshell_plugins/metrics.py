@@ -0,0 +1,239 @@
+#   YADT - an Augmented Deployment Tool
+#   Copyright (C) 2010-2014  Immobilien Scout GmbH
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+    The metrics module
+    Records the latency of every backend call (load balancer REST API,
+    livestatus-service, yadt-service-checkaccess) in in-process histograms
+    and dumps them as JSON or Prometheus text when the reactor shuts down.
+'''
+
+import json
+import logging
+import math
+import time
+from collections import deque
+
+from twisted.internet import reactor
+from twisted.internet.defer import CancelledError
+from twisted.web.client import ResponseFailed
+
+logger = logging.getLogger('yadtshell.plugins.metrics')
+
+LATENCY_BUCKETS_IN_SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS_IN_BYTES = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+RECENT_SAMPLES = 256
+
+CONNECT = 'connect_seconds'
+TIME_TO_FIRST_BYTE = 'time_to_first_byte_seconds'
+LATENCY = 'latency_seconds'
+RESPONSE_SIZE = 'response_bytes'
+
+BUCKETS = {
+    CONNECT: LATENCY_BUCKETS_IN_SECONDS,
+    TIME_TO_FIRST_BYTE: LATENCY_BUCKETS_IN_SECONDS,
+    LATENCY: LATENCY_BUCKETS_IN_SECONDS,
+    RESPONSE_SIZE: SIZE_BUCKETS_IN_BYTES
+}
+
+
+class Histogram(object):
+
+    """
+    A cumulative histogram with fixed bucket bounds which additionally keeps
+    the most recent samples to compute percentiles.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=RECENT_SAMPLES)
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.recent.append(value)
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+
+    def percentile(self, percent):
+        """
+        Returns the *percent* percentile of the recent samples or None if
+        nothing was observed yet.
+        """
+        if not self.recent:
+            return None
+        samples = sorted(self.recent)
+        index = int(math.ceil(percent / 100.0 * len(samples))) - 1
+        return samples[max(index, 0)]
+
+    def to_dict(self):
+        return {'count': self.count,
+                'sum': self.sum,
+                'buckets': dict(('%g' % bound, count) for bound, count in zip(self.buckets, self.counts)),
+                'p50': self.percentile(50),
+                'p99': self.percentile(99)}
+
+
+def is_cancelled(failure):
+    """
+    Returns True if *failure* was caused by cancelling a call, also when
+    the HTTP client wrapped the `CancelledError` in a `ResponseFailed`.
+    """
+    if failure.check(CancelledError):
+        return True
+    return bool(failure.check(ResponseFailed)) and any(is_cancelled(reason) for reason in failure.value.reasons)
+
+
+class CallTimer(object):
+
+    """
+    Measures one backend call. Call `first_byte` when the response headers
+    arrived, `received` for every chunk of the body and `finish` (or use
+    `track` on the deferred of the call) when it is done. The latency of
+    cancelled calls is not observed, only their outcome is counted.
+    """
+
+    def __init__(self, metrics, backend, endpoint):
+        self.metrics = metrics
+        self.backend = backend
+        self.endpoint = endpoint
+        self.started = metrics.clock()
+        self.response_size = 0
+
+    def first_byte(self, passthrough=None):
+        self.metrics.observe(self.backend, TIME_TO_FIRST_BYTE, self.endpoint, self.metrics.clock() - self.started)
+        return passthrough
+
+    def received(self, size):
+        self.response_size += size
+
+    def finish(self, outcome):
+        self.metrics.observe(self.backend, LATENCY, self.endpoint, self.metrics.clock() - self.started)
+        if self.response_size:
+            self.metrics.observe(self.backend, RESPONSE_SIZE, self.endpoint, self.response_size)
+        self.metrics.count_outcome(self.backend, self.endpoint, outcome)
+
+    def track(self, deferred):
+        def finish(result):
+            if hasattr(result, 'check') and is_cancelled(result):
+                self.metrics.count_outcome(self.backend, self.endpoint, result.type.__name__)
+            elif hasattr(result, 'check'):
+                self.finish(result.type.__name__)
+            else:
+                self.finish('success')
+            return result
+        deferred.addBoth(finish)
+        return deferred
+
+
+class Metrics(object):
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.histograms = {}
+        self.outcomes = {}
+        self.statistics_providers = {}
+        self.dump_file = None
+        self.dump_format = 'json'
+        self._shutdown_hook_installed = False
+
+    def configure(self, dump_file=None, dump_format=None):
+        """
+        Dumps the metrics to *dump_file* in *dump_format* ('json' or
+        'prometheus') when the reactor shuts down.
+        """
+        if dump_format:
+            self.dump_format = dump_format
+        if dump_file:
+            self.dump_file = dump_file
+            if not self._shutdown_hook_installed:
+                reactor.addSystemEventTrigger('before', 'shutdown', self.dump)
+                self._shutdown_hook_installed = True
+
+    def add_statistics_provider(self, name, statistics):
+        """
+        Includes the dictionary returned by the callable *statistics* in the
+        dump (e.G. the statistics of the connection pools).
+        """
+        self.statistics_providers[name] = statistics
+
+    def call(self, backend, endpoint):
+        return CallTimer(self, backend, endpoint)
+
+    def histogram(self, backend, name, endpoint):
+        key = (backend, name, endpoint)
+        if key not in self.histograms:
+            self.histograms[key] = Histogram(BUCKETS[name])
+        return self.histograms[key]
+
+    def observe(self, backend, name, endpoint, value):
+        self.histogram(backend, name, endpoint).observe(value)
+
+    def count_outcome(self, backend, endpoint, outcome):
+        key = (backend, endpoint, outcome)
+        self.outcomes[key] = self.outcomes.get(key, 0) + 1
+
+    def statistics(self):
+        return dict((name, statistics()) for name, statistics in self.statistics_providers.items())
+
+    def to_json(self):
+        return json.dumps({
+            'histograms': [dict(backend=backend, name=name, endpoint=endpoint, **histogram.to_dict())
+                           for (backend, name, endpoint), histogram in sorted(self.histograms.items())],
+            'outcomes': [{'backend': backend, 'endpoint': endpoint, 'outcome': outcome, 'count': count}
+                         for (backend, endpoint, outcome), count in sorted(self.outcomes.items())],
+            'statistics': self.statistics()
+        }, indent=2, sort_keys=True)
+
+    def to_prometheus(self):
+        lines = []
+        for name in sorted(set(key[1] for key in self.histograms)):
+            metric = 'yadtshell_plugins_%s' % name
+            lines.append('# TYPE %s histogram' % metric)
+            for (backend, histogram_name, endpoint), histogram in sorted(self.histograms.items()):
+                if histogram_name != name:
+                    continue
+                labels = 'backend="%s",endpoint="%s"' % (backend, endpoint)
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    lines.append('%s_bucket{%s,le="%g"} %d' % (metric, labels, bound, count))
+                lines.append('%s_bucket{%s,le="+Inf"} %d' % (metric, labels, histogram.count))
+                lines.append('%s_sum{%s} %s' % (metric, labels, repr(histogram.sum)))
+                lines.append('%s_count{%s} %d' % (metric, labels, histogram.count))
+        if self.outcomes:
+            lines.append('# TYPE yadtshell_plugins_calls_total counter')
+            for (backend, endpoint, outcome), count in sorted(self.outcomes.items()):
+                lines.append('yadtshell_plugins_calls_total{backend="%s",endpoint="%s",outcome="%s"} %d' %
+                             (backend, endpoint, outcome, count))
+        for provider, statistics in sorted(self.statistics().items()):
+            for key, value in sorted(statistics.items()):
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append('yadtshell_plugins_%s_%s %s' % (provider, key, repr(value)))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self):
+        output = self.to_prometheus() if self.dump_format == 'prometheus' else self.to_json()
+        try:
+            with open(self.dump_file, 'w') as dump_file:
+                dump_file.write(output)
+        except (IOError, OSError) as e:
+            logger.warning('Cannot write metrics to %s: %s' % (self.dump_file, e))
+
+
+METRICS = Metrics()
@@ -18,6 +18,7 @@ __author__ = 'Maximilien Riehl'
 
 import json
 import base64
+import time
 from logging import getLogger
 
 try:
@@ -25,23 +26,43 @@ try:
 except ImportError:
     from io import StringIO  # py3
 
+try:
+    from urlparse import urlparse  # py2
+except ImportError:
+    from urllib.parse import urlparse  # py3
+
 from twisted.internet import defer, reactor
 from twisted.internet.protocol import Protocol
-from twisted.web.client import Agent, FileBodyProducer
+from twisted.web.client import Agent, FileBodyProducer, HTTPConnectionPool
 from twisted.web.http_headers import Headers
 from twisted.internet.ssl import ClientContextFactory
+from twisted.python.failure import Failure
+
+from yadtshell_plugins.circuitbreaker import BREAKERS
+from yadtshell_plugins.jsonstream import IncrementalObjectDecoder
+from yadtshell_plugins.metrics import METRICS, CONNECT, LATENCY, TIME_TO_FIRST_BYTE
+from yadtshell_plugins.timeouts import TIMEOUTS
 
 
 logger = getLogger("yadtshell.plugins.rest_library")
 
 
 HTTP_CONNECT_TIMEOUT_IN_SECONDS = 30
+HTTP_MAX_REQUESTS_IN_FLIGHT = 64
+HTTP_MAX_REQUESTS_IN_FLIGHT_PER_HOST = 8
+HTTP_MAX_PERSISTENT_CONNECTIONS_PER_HOST = HTTP_MAX_REQUESTS_IN_FLIGHT_PER_HOST
+HTTP_CACHED_CONNECTION_TIMEOUT_IN_SECONDS = 240
+HTTP_MAX_BODY_SIZE_IN_BYTES = 64 * 1024 * 1024
+HTTP_HEDGE_PERCENTILE = 95
+HTTP_HEDGE_BUDGET_PERCENT = 10
+HTTP_HEDGE_MIN_SAMPLES = 20
 
 
 class HTTP_METHOD(object):
     GET = "GET"
     POST = "POST"
     PUT = "PUT"
+    PATCH = "PATCH"
 
 
 def new_basicauth_headers(config):
@@ -51,12 +72,22 @@ def new_basicauth_headers(config):
     *config* must be a dictionary with "username" and "password" set.
     """
 
-    creds = base64.b64encode('{0}:{1}'.format(config["username"], config["password"]))
-    headers = Headers({'Authorization': ['Basic {0}'.format(creds)]})
+    headers = Headers({'Authorization': [basicauth_value(config["username"], config["password"])]})
     return headers
 
 
-def rest_call(url, http_method, headers=Headers(), data=""):
+def basicauth_value(username, password):
+    creds = '{0}:{1}'.format(username, password)
+    if not isinstance(creds, bytes):
+        creds = creds.encode('utf-8')
+    return 'Basic {0}'.format(base64.b64encode(creds).decode('ascii'))
+
+
+class ResponseTooLargeError(Exception):
+    pass
+
+
+def rest_call(url, http_method, headers=None, data="", required_members=None, kind=None):
     """
     Returns a deferred that will callback with the response to a rest call.
 
@@ -73,36 +104,368 @@ def rest_call(url, http_method, headers=Headers(), data=""):
     -----------------
 
       * headers
-        an instance of twisted.web.http_headers.Headers
+        an instance of twisted.web.http_headers.Headers. It is not modified,
+        a copy with the JSON content type is used if it does not set one.
       * data
         string with data to submit - no special treatment (e.G. no URL encoding!)
+      * required_members
+        the names of the top-level members of the JSON response the caller
+        needs. If given, the response is decoded while it arrives and the
+        deferred callbacks as soon as these members were received.
+      * kind
+        the kind of request. Latencies are measured, and timeouts and hedge
+        delays derived, per kind. Defaults to "rest" for GET requests (of
+        single nodes) and "rest-mutation" for all other methods, use
+        "rest-collection" for GET requests of large collections.
     """
 
-    headers.addRawHeader("Content-Type", "application/json")
-
-    agent = Agent(reactor, WebClientContextFactory(), connectTimeout=HTTP_CONNECT_TIMEOUT_IN_SECONDS)
-
-    deferred = agent.request(http_method,
-                             url,
-                             headers,
-                             FileBodyProducer(StringIO(data)) if data else None)
-    deferred.addCallback(read_response)
+    if headers is None or not headers.hasHeader("Content-Type"):
+        headers = headers.copy() if headers is not None else Headers()
+        headers.addRawHeader("Content-Type", "application/json")
+
+    endpoint = urlparse(url).netloc
+    if kind is None:
+        kind = "rest" if http_method == HTTP_METHOD.GET else "rest-mutation"
+    agent = Agent(reactor,
+                  POOLS.context_factory(endpoint),
+                  connectTimeout=TIMEOUTS.timeout("rest", CONNECT, endpoint),
+                  pool=POOLS.pool(endpoint))
+
+    def request():
+        timer = METRICS.call(kind, endpoint)
+        d = agent.request(http_method,
+                          url,
+                          headers,
+                          FileBodyProducer(StringIO(data)) if data else None)
+        TIMEOUTS.expire(d, "rest", TIME_TO_FIRST_BYTE, endpoint, kind)
+        d.addCallback(timer.first_byte)
+        d.addCallback(read_response, required_members, timer)
+        TIMEOUTS.expire(d, "rest", LATENCY, endpoint, kind)
+        return timer.track(d)
+
+    if http_method == HTTP_METHOD.GET:
+        deferred = SCHEDULER.run(endpoint, BREAKERS.call, "rest", endpoint, HEDGER.run, endpoint, request, kind)
+    else:
+        deferred = SCHEDULER.run(endpoint, BREAKERS.call, "rest", endpoint, request)
     deferred.addCallback(deserialize_response)
     return deferred
 
 
 class WebClientContextFactory(ClientContextFactory):
-    def getContext(self, hostname, port):
-        return ClientContextFactory.getContext(self)
+    """
+    Builds the SSL context once and hands it out for every connection
+    to the endpoint instead of building a new one per connection.
+    """
+
+    def __init__(self):
+        self._context = None
+
+    def getContext(self, hostname=None, port=None):
+        if self._context is None:
+            self._context = ClientContextFactory.getContext(self)
+        return self._context
+
+
+class CountingHTTPConnectionPool(HTTPConnectionPool):
+    """
+    A persistent HTTPConnectionPool which counts how many connections were
+    requested and how many of them had to be newly established.
+    """
+
+    def __init__(self, reactor, persistent=True, backend="rest", endpoint=None):
+        HTTPConnectionPool.__init__(self, reactor, persistent)
+        self.backend = backend
+        self.endpoint = endpoint
+        self.requested_connections = 0
+        self.new_connections = 0
 
+    def getConnection(self, key, endpoint):
+        self.requested_connections += 1
+        return HTTPConnectionPool.getConnection(self, key, endpoint)
 
-def read_response(response):
-    d = defer.Deferred()
-    response.deliverBody(BodyConsumer(d))
+    def _newConnection(self, key, endpoint):
+        self.new_connections += 1
+        started = METRICS.clock()
+
+        def connected(protocol):
+            METRICS.observe(self.backend, CONNECT, self.endpoint, METRICS.clock() - started)
+            return protocol
+
+        d = HTTPConnectionPool._newConnection(self, key, endpoint)
+        d.addCallback(connected)
+        return d
+
+    @property
+    def reused_connections(self):
+        return self.requested_connections - self.new_connections
+
+
+class ConnectionPools(object):
+    """
+    Process-wide registry of persistent connection pools, one per endpoint
+    (e.G. "1.3.3.7" or "icinga.domain:8080").
+    All pools are closed when the reactor shuts down.
+    """
+
+    def __init__(self,
+                 max_persistent_per_host=HTTP_MAX_PERSISTENT_CONNECTIONS_PER_HOST,
+                 cached_connection_timeout=HTTP_CACHED_CONNECTION_TIMEOUT_IN_SECONDS,
+                 backend="rest"):
+        self.backend = backend
+        self.max_persistent_per_host = max_persistent_per_host
+        self.cached_connection_timeout = cached_connection_timeout
+        self.pools = {}
+        self.context_factories = {}
+        self._shutdown_hook_installed = False
+
+    def configure(self, max_persistent_per_host=None, cached_connection_timeout=None):
+        if max_persistent_per_host is not None:
+            self.max_persistent_per_host = max_persistent_per_host
+        if cached_connection_timeout is not None:
+            self.cached_connection_timeout = cached_connection_timeout
+        for pool in self.pools.values():
+            pool.maxPersistentPerHost = self.max_persistent_per_host
+            pool.cachedConnectionTimeout = self.cached_connection_timeout
+
+    def pool(self, endpoint):
+        if endpoint not in self.pools:
+            pool = CountingHTTPConnectionPool(reactor, persistent=True, backend=self.backend, endpoint=endpoint)
+            pool.maxPersistentPerHost = self.max_persistent_per_host
+            pool.cachedConnectionTimeout = self.cached_connection_timeout
+            self.pools[endpoint] = pool
+            self._install_shutdown_hook()
+        return self.pools[endpoint]
+
+    def context_factory(self, endpoint):
+        if endpoint not in self.context_factories:
+            self.context_factories[endpoint] = WebClientContextFactory()
+        return self.context_factories[endpoint]
+
+    def statistics(self):
+        return dict((endpoint, {"requested": pool.requested_connections,
+                                "new": pool.new_connections,
+                                "reused": pool.reused_connections})
+                    for endpoint, pool in self.pools.items())
+
+    def close(self):
+        logger.debug("Closing persistent connections, statistics: %s" % self.statistics())
+        return defer.DeferredList([pool.closeCachedConnections() for pool in self.pools.values()])
+
+    def _install_shutdown_hook(self):
+        if not self._shutdown_hook_installed:
+            reactor.addSystemEventTrigger("before", "shutdown", self.close)
+            self._shutdown_hook_installed = True
+
+
+POOLS = ConnectionPools()
+
+
+def resize_semaphore(semaphore, limit):
+    semaphore.tokens += limit - semaphore.limit
+    semaphore.limit = limit
+    while semaphore.tokens > 0 and semaphore.waiting:
+        semaphore.tokens -= 1
+        semaphore.waiting.pop(0).callback(semaphore)
+
+
+class RequestScheduler(object):
+    """
+    Limits the number of requests in flight, overall and per endpoint.
+    Requests exceeding a limit are queued and started in FIFO order.
+    The queue depth and the time requests spent waiting are recorded.
+    """
+
+    def __init__(self,
+                 max_requests=HTTP_MAX_REQUESTS_IN_FLIGHT,
+                 max_requests_per_endpoint=HTTP_MAX_REQUESTS_IN_FLIGHT_PER_HOST,
+                 clock=time.time):
+        self.max_requests_per_endpoint = max_requests_per_endpoint
+        self.overall_limit = defer.DeferredSemaphore(max_requests)
+        self.endpoint_limits = {}
+        self.clock = clock
+        self.queued = 0
+        self.max_queued = 0
+        self.started = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def configure(self, max_requests=None, max_requests_per_endpoint=None):
+        if max_requests is not None:
+            resize_semaphore(self.overall_limit, max_requests)
+        if max_requests_per_endpoint is not None:
+            self.max_requests_per_endpoint = max_requests_per_endpoint
+            for limit in self.endpoint_limits.values():
+                resize_semaphore(limit, max_requests_per_endpoint)
+
+    def endpoint_limit(self, endpoint):
+        if endpoint not in self.endpoint_limits:
+            self.endpoint_limits[endpoint] = defer.DeferredSemaphore(self.max_requests_per_endpoint)
+        return self.endpoint_limits[endpoint]
+
+    def run(self, endpoint, f, *args, **kwargs):
+        """
+        Calls *f* as soon as a request to *endpoint* may be started and
+        returns a deferred which fires with its result. The limits are held
+        until the deferred returned by *f* has fired.
+        """
+        endpoint_limit = self.endpoint_limit(endpoint)
+        enqueued_at = self.clock()
+        acquired = []
+        self.queued += 1
+        self.max_queued = max(self.max_queued, self.queued)
+
+        def acquire_overall_limit(_):
+            acquired.append(endpoint_limit)
+            return self.overall_limit.acquire()
+
+        def start(_):
+            acquired.append(self.overall_limit)
+            self._started(enqueued_at)
+            return f(*args, **kwargs)
+
+        def release(result):
+            if len(acquired) < 2:
+                self.queued -= 1
+            for limit in acquired:
+                limit.release()
+            return result
+
+        d = endpoint_limit.acquire()
+        d.addCallback(acquire_overall_limit)
+        d.addCallback(start)
+        d.addBoth(release)
+        return d
+
+    def _started(self, enqueued_at):
+        wait_time = self.clock() - enqueued_at
+        self.queued -= 1
+        self.started += 1
+        self.total_wait_time += wait_time
+        self.max_wait_time = max(self.max_wait_time, wait_time)
+
+    def statistics(self):
+        return {"queued": self.queued,
+                "max_queued": self.max_queued,
+                "queued_per_endpoint": dict((endpoint, len(limit.waiting))
+                                            for endpoint, limit in self.endpoint_limits.items()),
+                "started": self.started,
+                "average_wait_time": self.total_wait_time / self.started if self.started else 0.0,
+                "max_wait_time": self.max_wait_time}
+
+
+SCHEDULER = RequestScheduler()
+
+
+class RequestHedger(object):
+    """
+    Sends a second (hedged) request when the response to an idempotent
+    request takes longer than the *percentile* of the recent latencies of
+    its endpoint for requests of the same kind. The first response wins and the other request is
+    cancelled. Hedging starts after `HTTP_HEDGE_MIN_SAMPLES` latencies of
+    the endpoint were observed, and at most *budget_percent* percent of
+    the requests are hedged. The hedged request shares the scheduler slot
+    of the original one, so that it is not queued behind the requests it
+    should overtake.
+    """
+
+    def __init__(self, enabled=False, percentile=HTTP_HEDGE_PERCENTILE, budget_percent=HTTP_HEDGE_BUDGET_PERCENT,
+                 clock=reactor):
+        self.enabled = enabled
+        self.percentile = percentile
+        self.budget_percent = budget_percent
+        self.clock = clock
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def configure(self, enabled=None, percentile=None, budget_percent=None):
+        if enabled is not None:
+            self.enabled = enabled
+        if percentile is not None:
+            self.percentile = percentile
+        if budget_percent is not None:
+            self.budget_percent = budget_percent
+
+    def delay(self, endpoint, kind="rest"):
+        histogram = METRICS.histogram(kind, LATENCY, endpoint)
+        if len(histogram.recent) < HTTP_HEDGE_MIN_SAMPLES:
+            return None
+        return histogram.percentile(self.percentile)
+
+    def run(self, endpoint, attempt, kind="rest"):
+        """
+        Calls *attempt*, which returns the deferred result of one request
+        of *kind* to *endpoint*, and calls it once more if the result is late.
+        """
+        delay = self.delay(endpoint, kind) if self.enabled else None
+        if delay is None:
+            return attempt()
+        self.requests += 1
+        attempts = []
+        cancelled = []
+
+        def settle(result, current, hedged):
+            attempts.remove(current)
+            if cancelled or finished.called:
+                return None
+            if isinstance(result, Failure) and attempts:
+                return None  # the other request may still succeed
+            if hedge_call.active():
+                hedge_call.cancel()
+            if hedged:
+                self.hedge_wins += 1
+            finished.callback(result)
+            for other in list(attempts):
+                other.cancel()
+            return None
+
+        def hedge():
+            if self.hedges >= self.budget_percent / 100.0 * self.requests:
+                return
+            self.hedges += 1
+            logger.debug("no response from %s after %.3fs, hedging request" % (endpoint, delay))
+            start(attempt(), hedged=True)
+
+        def cancel(_):
+            cancelled.append(True)
+            if hedge_call.active():
+                hedge_call.cancel()
+            for other in list(attempts):
+                other.cancel()
+
+        def start(d, hedged=False):
+            attempts.append(d)
+            d.addBoth(settle, d, hedged)
+
+        finished = defer.Deferred(cancel)
+        hedge_call = self.clock.callLater(delay, hedge)
+        start(attempt())
+        return finished
+
+    def statistics(self):
+        return {"requests": self.requests,
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins}
+
+
+HEDGER = RequestHedger()
+
+METRICS.add_statistics_provider("rest_connections", POOLS.statistics)
+METRICS.add_statistics_provider("rest_scheduler", SCHEDULER.statistics)
+METRICS.add_statistics_provider("rest_hedging", HEDGER.statistics)
+TIMEOUTS.configure("rest", timeouts={CONNECT: HTTP_CONNECT_TIMEOUT_IN_SECONDS})
+
+
+def read_response(response, required_members=None, timer=None):
+    d = defer.Deferred(lambda _: consumer.abort())
+    consumer = BodyConsumer(d, required_members=required_members, timer=timer)
+    response.deliverBody(consumer)
     return d
 
 
 def deserialize_response(response):
+    if isinstance(response, dict):
+        return response
     try:
         return json.loads(response)
     except Exception:
@@ -112,15 +475,75 @@ def deserialize_response(response):
 
 class BodyConsumer(Protocol):
 
-    def __init__(self, finished):
+    """
+    Collects the chunks of a response body and joins them once the body is
+    complete. Bodies larger than *max_size* bytes are aborted.
+    With *required_members* the body is decoded incrementally instead, and
+    *finished* callbacks with the decoded members as soon as all required
+    members were received. The rest of the body is read (and discarded) so
+    that the connection can go back to the pool.
+    Cancelling *finished* aborts the transfer, see `abort`.
+    """
+
+    def __init__(self, finished, max_size=None, required_members=None, timer=None):
         self.finished = finished
-        self.data = ""
+        self.timer = timer
+        self.max_size = max_size or HTTP_MAX_BODY_SIZE_IN_BYTES
+        self.required_members = required_members
+        self.decoder = IncrementalObjectDecoder() if required_members else None
+        self.chunks = []
+        self.size = 0
+        self.done = False
 
     def connectionMade(self, *args, **kwargs):
         pass
 
+    def abort(self):
+        """
+        Stops receiving the body, e.G. when the request was cancelled.
+        The connection is closed instead of going back to the pool.
+        """
+        self.done = True
+        if self.transport is not None:
+            self.transport.stopProducing()
+
     def dataReceived(self, data):
-        self.data += data
+        if self.timer is not None:
+            self.timer.received(len(data))
+        if self.done:
+            return
+        self.size += len(data)
+        if self.size > self.max_size:
+            self._finish_with_failure(ResponseTooLargeError("Response body exceeds %d bytes" % self.max_size))
+            self.transport.stopProducing()
+            return
+        if self.decoder is None:
+            self.chunks.append(data)
+            return
+        try:
+            self.decoder.feed(data)
+        except ValueError as e:
+            self._finish_with_failure(e)
+            return
+        if self.decoder.has_members(self.required_members):
+            self._finish(dict(self.decoder.members))
 
     def connectionLost(self, reason):
-        self.finished.callback(self.data)
+        if self.done:
+            return
+        if self.decoder is None:
+            self._finish(b"".join(self.chunks))
+        elif self.decoder.finished:
+            self._finish(dict(self.decoder.members))
+        else:
+            self._finish_with_failure(ValueError("Incomplete JSON response, got members %s" % sorted(self.decoder.members)))
+
+    def _finish(self, result):
+        self.done = True
+        self.chunks = []
+        self.finished.callback(result)
+
+    def _finish_with_failure(self, exception):
+        self.done = True
+        self.chunks = []
+        self.finished.errback(exception)
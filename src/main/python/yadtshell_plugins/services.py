@@ -17,26 +17,162 @@
 from __future__ import absolute_import
 
 import logging
+import os
+import pipes
 import shlex
 import sys
 
 import twisted
 from twisted.internet import reactor, defer
-from twisted.internet.protocol import Protocol
+from twisted.python.failure import Failure
 
 import yadtshell.settings
 import yadtshell.components
 import yadtshell.util
 import yadtshell.twisted
 
-from yadtshell_plugins.livestatus_service import (LivestatusServiceHandler,
-                                                  LivestatusServiceStatusResponse)
+from yadtshell_plugins import livestatus_service
+from yadtshell_plugins.cache import StatusCache
+from yadtshell_plugins.metrics import METRICS
+from yadtshell_plugins.livestatus_service import LivestatusServiceHandler
+from yadtshell_plugins.snapshot import SnapshotStore
 
 logger = logging.getLogger('yadtshell.plugins.services')
 
 DISABLE_COMMAND = 'disable'
 ENABLE_COMMAND = 'enable'
 
+STATUS_CACHE = StatusCache()
+METRICS.add_statistics_provider('status_cache', STATUS_CACHE.statistics)
+SNAPSHOT = SnapshotStore()
+METRICS.add_statistics_provider('status_snapshot', SNAPSHOT.statistics)
+PREFETCHED_STATUS = {}
+PREFETCHED_CLIENTS = set()
+RESOLVED_CLUSTERS = {}
+
+
+class GuardChecker(object):
+
+    """
+    Runs the guard `yadt-service-checkaccess SERVICE` for guarded services.
+    Granted access is cached per host and service for a short time.
+    With batching and caching, the first check for a host checks all
+    guarded services registered for that host in one remote call, so that
+    the other services of the host are answered from the cache afterwards.
+    If the combined check fails, the requested service is checked on its
+    own so that its failure is reported exactly as before.
+    """
+
+    def __init__(self):
+        self.cache = StatusCache()
+        self.services = {}
+        self.in_flight = {}
+
+    def register(self, service):
+        self.services.setdefault(service.host, {})[service.name] = service
+
+    def check(self, service, ttl=0, batch=False):
+        key = (service.host, service.name)
+        granted = self.cache.get(key)
+        if granted is not None:
+            logger.debug('access to %s granted from cache' % service.uri)
+            return defer.succeed(granted)
+        if key in self.in_flight:
+            d = defer.Deferred()
+            self.in_flight[key].append(d)
+            return d
+        if batch and ttl:
+            services = [other for name, other in sorted(self.services.get(service.host, {}).items())
+                        if name != service.name and self._needs_check((service.host, name))]
+            if services:
+                return self._check_batch(service, [service] + services, ttl)
+        return self._check_single(service, ttl)
+
+    def _needs_check(self, key):
+        return key not in self.in_flight and self.cache.get(key) is None
+
+    def _check_single(self, service, ttl):
+        key = (service.host, service.name)
+        self.in_flight[key] = []
+        d = self._run_guard(service, [('yadt-service-checkaccess', service.name)])
+
+        def done(result):
+            if not isinstance(result, Failure):
+                self.cache.store(result, key, ttl)
+            notify(self.in_flight.pop(key, []), result)
+            return result
+
+        d.addBoth(done)
+        return d
+
+    def _check_batch(self, service, services, ttl):
+        keys = [(other.host, other.name) for other in services]
+        for key in keys:
+            self.in_flight[key] = []
+        logger.debug('checking access to %s in one remote call' % ', '.join(other.name for other in services))
+        d = self._run_guard(service, [('yadt-service-checkaccess', other.name) for other in services])
+
+        def granted(result):
+            for key in keys:
+                self.cache.store(result, key, ttl)
+                notify(self.in_flight.pop(key, []), result)
+            return result
+
+        def check_separately(failure):
+            logger.debug('combined access check on %s failed, checking separately' % service.host)
+            for other, key in zip(services, keys):
+                waiting = self.in_flight.pop(key, [])
+                if other is service:
+                    d = self._check_single(other, ttl)
+                    d.addBoth(notify_and_pass, waiting)
+                elif waiting:
+                    self._check_single(other, ttl).addBoth(notify_and_pass, waiting)
+            return d
+
+        d.addCallbacks(granted, check_separately)
+        return d
+
+    def _run_guard(self, service, guard_commands):
+        guard_cmd = chain_remote_calls(service, guard_commands)
+        p = yadtshell.twisted.YadtProcessProtocol(service, ' '.join(guard_cmd))
+        p.deferred = defer.Deferred()
+        reactor.spawnProcess(p, guard_cmd[0], guard_cmd, None)
+        return METRICS.call('guard', service.host).track(p.deferred)
+
+
+def notify(waiting, result):
+    for waiting_deferred in waiting:
+        if isinstance(result, Failure):
+            waiting_deferred.errback(result)
+        else:
+            waiting_deferred.callback(result)
+
+
+def notify_and_pass(result, waiting):
+    notify(waiting, result)
+    return result
+
+
+def chain_remote_calls(service, commands):
+    """
+    Returns the arguments of one ssh call which runs *commands* (sequences
+    of arguments) on the host of *service* one after another with `&&`.
+    Every command keeps the `WHO` and `YADT_LOG_FILE` prefix of its own
+    `remote_call`, which wraps the command in double quotes, so each
+    argument is quoted for the remote shell and escaped for those quotes.
+    """
+    ssh_arguments = len(shlex.split(yadtshell.settings.SSH)) + 1
+    arguments = []
+    for command in commands:
+        command = ' '.join(pipes.quote(argument) for argument in command)
+        remote_call = shlex.split(service.remote_call(command.replace('\\', '\\\\').replace('"', '\\"')))
+        arguments.extend(['&&'] + remote_call[ssh_arguments:] if arguments else remote_call)
+    return arguments
+
+
+GUARD = GuardChecker()
+METRICS.add_statistics_provider('guard_cache', GUARD.cache.statistics)
+
 
 class GuardedService(yadtshell.components.Service):
 
@@ -56,19 +192,29 @@ class GuardedService(yadtshell.components.Service):
     to `_service_call` in their start|stop implementation.
     """
 
+    status_cache_ttl = 0
+    guard_cache_ttl = 0
+    batch_guard_checks = False
+
+    def _configure_guard(self, config):
+        self.guard_cache_ttl = getattr(config, 'GUARD_CACHE_TTL_IN_SECONDS', 0)
+        self.batch_guard_checks = getattr(config, 'BATCH_GUARD_CHECKS', False)
+        GUARD.register(self)
+
+    def _configure_snapshot(self, config):
+        path = getattr(config, 'STATUS_SNAPSHOT_FILE', None) \
+            or os.path.join(yadtshell.settings.OUTPUT_DIR, 'status-snapshot')
+        SNAPSHOT.configure(path, getattr(config, 'STATUS_SNAPSHOT_MAX_AGE_IN_SECONDS', 0))
+
     def _service_call(self, cmd):
         """
         Make a service call with `cmd` and return a deferred.
         If we have write access to the service (`self.name`), the deferred will
         callback on `self._guarded_service_call` with the parameter `cmd`.
         """
-        guard_cmd = self.remote_call('yadt-service-checkaccess %s' % self.name)
-        p = yadtshell.twisted.YadtProcessProtocol(self, guard_cmd)
-        p.deferred = defer.Deferred()
-        guard_cmd = shlex.split(guard_cmd)
-        reactor.spawnProcess(p, guard_cmd[0], guard_cmd, None)
-        p.deferred.addCallback(self._guarded_service_call, cmd)
-        return p.deferred
+        d = GUARD.check(self, self.guard_cache_ttl, self.batch_guard_checks)
+        d.addCallback(self._guarded_service_call, cmd)
+        return d
 
     def _create_service_ignored_failure(self):
         failure = lambda: None
@@ -86,6 +232,27 @@ def handle_connection_error(failure, host, livestatus_server, fail=False):
     return 'unknown'
 
 
+def answer_from_snapshot(service, snapshot_status, refreshed):
+    """
+    Answers the status of *service* with *snapshot_status* while the
+    *refreshed* status query continues in the background. Only a refreshed
+    status differing from the snapshot is reported.
+    """
+    logger.debug('status for %s from snapshot: %s' % (service.uri, snapshot_status))
+
+    def report_change(status):
+        if status != snapshot_status:
+            logger.info('status of %s changed from %s to %s since the last snapshot' %
+                        (service.uri, snapshot_status, status))
+        return status
+
+    def report_failure(failure):
+        logger.warning('refreshing status of %s failed: %s' % (service.uri, failure.getErrorMessage()))
+
+    refreshed.addCallbacks(report_change, report_failure)
+    return defer.succeed(snapshot_status)
+
+
 class LivestatusService(GuardedService):
 
     def __init__(self, host, name, settings):
@@ -103,45 +270,74 @@ class LivestatusService(GuardedService):
         if not hasattr(self, "livestatus_server"):
             self.livestatus_server = self.config.SERVERS[loc_type['loc']]
 
+        livestatus_service.configure(self.config)
+        self._configure_guard(self.config)
+        self._configure_snapshot(self.config)
+        self.status_cache_ttl = getattr(self.config, 'STATUS_CACHE_TTL_IN_SECONDS', 0)
+
         self.livestatus = LivestatusServiceHandler(
             self.livestatus_server, self.host)
+        if getattr(self.config, 'PREFETCH_STATUS', False):
+            self._prefetch_status()
+
+    def _prefetch_status(self):
+        """
+        Starts querying the notification status in the background, merged
+        with the queries of all other services constructed in the meantime.
+        The next call to `status` is answered from this query.
+        """
+        d = self.livestatus.build_deferred_for_batched_service_notification_status()
+        d.addErrback(handle_connection_error, self.host, self.livestatus_server)
+        PREFETCHED_STATUS[self._status_cache_key()] = d
+
+    def _status_cache_key(self):
+        return (self.__class__.__name__, self.host, self.livestatus_server)
 
     def _guarded_service_call(self, ignored, cmd):
+        """
+        Sends the service and host notification commands concurrently and
+        then waits until the host and its services have changed their
+        notification state.
+        """
+
+        def on_notifications_modified(page):
+            logger.debug('on notifications modified : %s' % page)
+            if isinstance(page, twisted.internet.error.TimeoutError):
+                logger.error(
+                    "Could not enable/disable notifications due to timeout after %d seconds", page._timeout)
 
         def on_host_notifications_successfully_modified(page):
             logger.debug(
                 'on host notifications successfully modified : %s' % page)
 
-        def on_host_notifications_modified(page):
-            logger.debug('on host notifications modified : %s' % page)
+        def wait_for_notifications_state(ignored):
             return self.livestatus.build_deferred_livestatus_wait_for_notifications_state(on_host_notifications_successfully_modified)
 
-        def on_service_notifications_modified(page):
-            logger.debug('on service notifications modified : %s' % page)
-            if isinstance(page, twisted.internet.error.TimeoutError):
-                logger.error(
-                    "Could not enable/disable service notifications due to timeout after %d seconds", page._timeout)
-            if cmd == DISABLE_COMMAND:
-                modify_host_notifications = 'DISABLE_HOST_NOTIFICATIONS'
-            else:
-                modify_host_notifications = 'ENABLE_HOST_NOTIFICATIONS'
-            return self.livestatus.build_deferred_livestatus_command(modify_host_notifications, on_host_notifications_modified)
-
         if cmd == DISABLE_COMMAND:
-            modify_service_notifications = 'DISABLE_HOST_SVC_NOTIFICATIONS'
+            commands = ('DISABLE_HOST_SVC_NOTIFICATIONS', 'DISABLE_HOST_NOTIFICATIONS')
         else:
-            modify_service_notifications = 'ENABLE_HOST_SVC_NOTIFICATIONS'
+            commands = ('ENABLE_HOST_SVC_NOTIFICATIONS', 'ENABLE_HOST_NOTIFICATIONS')
 
-        d = self.livestatus.build_deferred_livestatus_command(modify_service_notifications, on_service_notifications_modified)
+        d = defer.DeferredList([self.livestatus.build_deferred_livestatus_command(command, on_notifications_modified)
+                                for command in commands],
+                               fireOnOneErrback=True, consumeErrors=True)
+        d.addErrback(lambda failure: failure.value.subFailure)
+        d.addCallback(wait_for_notifications_state)
         d.addErrback(handle_connection_error, self.host, self.livestatus_server, fail=True)
         return d
 
     def start(self):
+        PREFETCHED_STATUS.pop(self._status_cache_key(), None)
         self.livestatus.is_starting = True
+        STATUS_CACHE.invalidate(self._status_cache_key(), expected_status=0)
+        SNAPSHOT.invalidate(self._status_cache_key())
         return self._service_call(ENABLE_COMMAND)
 
     def stop(self):
+        PREFETCHED_STATUS.pop(self._status_cache_key(), None)
         self.livestatus.is_starting = False
+        STATUS_CACHE.invalidate(self._status_cache_key(), expected_status=1)
+        SNAPSHOT.invalidate(self._status_cache_key())
         return self._service_call(DISABLE_COMMAND)
 
     def _create_service_ignored_failure(self):
@@ -152,15 +348,15 @@ class LivestatusService(GuardedService):
     def status(self):
         if hasattr(self, 'ignored'):
             return defer.succeed(None)
+        cache_key = self._status_cache_key()
+        cached_status = STATUS_CACHE.get(cache_key)
+        if cached_status is not None:
+            logger.debug('status for %s from cache: %s' % (self.uri, cached_status))
+            self.state = cached_status
+            return defer.succeed(cached_status)
         logger.debug('requesting status for %s' % self.uri)
 
-        def read_body(response):
-            d = defer.Deferred()
-            response.deliverBody(BodyConsumer(d, self.host))
-            return d
-
-        def parse_page(page):
-            response = LivestatusServiceStatusResponse(page, self.host)
+        def parse_response(response):
             try:
                 notifications_enabled = response.notifications_are_enabled()
                 if notifications_enabled:
@@ -170,37 +366,44 @@ class LivestatusService(GuardedService):
             except:  # NOQA
                 logger.warning(
                     'Monitoring state for %s unknown, response from %s was %s' %
-                    (self.host, self.livestatus_server, page))
+                    (self.host, self.livestatus_server, getattr(response, 'response', response)))
                 self.state = 'unknown'
             return self.state
 
-        body_deferred = self.livestatus.build_deferred_for_service_notification_status(
-            read_body)
-        body_deferred.addErrback(
-            handle_connection_error, self.host, self.livestatus_server)
-        body_deferred.addCallback(parse_page)
-        return body_deferred
-
-
-class BodyConsumer(Protocol):
-
-    def __init__(self, finished, host):
-        self.finished = finished
-        self.host = host
-        self.data = ""
-
-    def connectionMade(self, *args, **kwargs):
-        logger.debug("Livestatus connection made for %s" % self.host)
-
-    def dataReceived(self, data):
-        self.data += data
-
-    def connectionLost(self, reason):
-        self.finished.callback(self.data)
+        response_deferred = PREFETCHED_STATUS.pop(cache_key, None)
+        if response_deferred is None:
+            response_deferred = self.livestatus.build_deferred_for_batched_service_notification_status()
+            response_deferred.addErrback(
+                handle_connection_error, self.host, self.livestatus_server)
+        response_deferred.addCallback(parse_response)
+        response_deferred.addCallback(STATUS_CACHE.store, cache_key, self.status_cache_ttl)
+        response_deferred.addCallback(SNAPSHOT.record, cache_key)
+        snapshot_status = SNAPSHOT.get(cache_key)
+        if snapshot_status is not None:
+            self.state = snapshot_status
+            return answer_from_snapshot(self, snapshot_status, response_deferred)
+        return response_deferred
+
+
+def resolve_clusters(clusters, cluster_ips):
+    """
+    Returns the IPs of the load balancer *clusters* (names in *cluster_ips*)
+    as a tuple without duplicates. The result for each list of clusters is
+    computed once and shared by all services.
+    """
+    key = tuple(clusters)
+    if key not in RESOLVED_CLUSTERS:
+        lb_ips = []
+        for cluster in key:
+            lb_ips.extend(lb_ip for lb_ip in cluster_ips[cluster] if lb_ip not in lb_ips)
+        RESOLVED_CLUSTERS[key] = tuple(lb_ips)
+    return RESOLVED_CLUSTERS[key]
 
 
 class LB(GuardedService):
 
+    client = None
+
     def __init__(self, host, name, settings):
         yadtshell.components.Service.__init__(self, host, name, settings)
         try:
@@ -217,37 +420,85 @@ class LB(GuardedService):
             raise RuntimeError('Configuration problem : no loadbalancer api implementation found.')
         __import__(module_name)
         self.implementation = sys.modules[module_name]
+        self._configure_guard(self.config)
+        self._configure_snapshot(self.config)
+        self.status_cache_ttl = getattr(self.config, 'STATUS_CACHE_TTL_IN_SECONDS', 0)
+        if getattr(self.config, 'PREFETCH_STATUS', False):
+            self._prefetch_status()
+
+    def _client(self):
+        """
+        Returns the client of the loadbalancer api implementation, which is
+        shared by all services with the same credentials and partition.
+        Implementations without clients are used directly.
+        """
+        if self.client is None:
+            self.client = self.implementation.configure(self.config, getattr(self, "ltm_partition", None)) \
+                or self.implementation
+        return self.client
+
+    def _prefetch_status(self):
+        """
+        Starts fetching the node collections of all load balancers in
+        `CLUSTERS` in the background, once per client.
+        """
+        client = self._client()
+        if client in PREFETCHED_CLIENTS or not hasattr(client, 'prefetch_status'):
+            return
+        PREFETCHED_CLIENTS.add(client)
+        client.prefetch_status(
+            [lb_ip for cluster_ips in self.config.CLUSTERS.values() for lb_ip in cluster_ips])
+
+    def _status_cache_key(self):
+        return (self.__class__.__name__, self.host, tuple(self.loadbalancer_ips), getattr(self, "ltm_partition", None))
+
+    @property
+    def ip_list(self):
+        return [ip for ip in self.interfaces.values() if ip]
 
     def prepare(self, host):
-        self.ip_list = filter(None, host.interface.values())
+        self.interfaces = host.interface
         if hasattr(self, 'loadbalancer_clusters'):
-            self.loadbalancer_ips = []
-            logger.debug('%s clusters: %s' %
-                         (self.uri, ', '.join(self.loadbalancer_clusters)))
-            for cluster in self.loadbalancer_clusters:
-                self.loadbalancer_ips.extend(self.config.CLUSTERS[cluster])
-        logger.debug('%s ips: %s' %
-                     (self.uri, ', '.join(self.loadbalancer_ips)))
-        logger.debug('%s ips: %s' % (self.host, ', '.join(self.ip_list)))
+            self.loadbalancer_ips = resolve_clusters(self.loadbalancer_clusters, self.config.CLUSTERS)
+        if logger.isEnabledFor(logging.DEBUG):
+            if hasattr(self, 'loadbalancer_clusters'):
+                logger.debug('%s clusters: %s', self.uri, ', '.join(self.loadbalancer_clusters))
+            logger.debug('%s ips: %s', self.uri, ', '.join(self.loadbalancer_ips))
+            logger.debug('%s ips: %s', self.host, ', '.join(self.ip_list))
 
     def status(self):
-        self.implementation.configure(self.config, getattr(self, "ltm_partition", None))
+        client = self._client()
         if hasattr(self, 'ignored'):
             logger.debug('%s is ignored' % self.uri)
             return defer.succeed(None)
+        cache_key = self._status_cache_key()
+        cached_status = STATUS_CACHE.get(cache_key)
+        if cached_status is not None:
+            logger.debug('status for %s from cache: %s' % (self.uri, cached_status))
+            return defer.succeed(cached_status)
         logger.debug('requesting status for %s' % self.uri)
 
-        return self.implementation.query_status(self.host, self.loadbalancer_ips)
+        d = client.query_status(self.host, self.loadbalancer_ips)
+        d.addCallback(STATUS_CACHE.store, cache_key, self.status_cache_ttl)
+        d.addCallback(SNAPSHOT.record, cache_key)
+        snapshot_status = SNAPSHOT.get(cache_key)
+        if snapshot_status is not None:
+            return answer_from_snapshot(self, snapshot_status, d)
+        return d
 
     def stop(self):
+        STATUS_CACHE.invalidate(self._status_cache_key(), expected_status=3)
+        SNAPSHOT.invalidate(self._status_cache_key())
         return self._service_call("stop")
 
     def start(self):
+        STATUS_CACHE.invalidate(self._status_cache_key(), expected_status=0)
+        SNAPSHOT.invalidate(self._status_cache_key())
         return self._service_call("start")
 
     def _guarded_service_call(self, ignored, cmd):
-        self.implementation.configure(self.config, getattr(self, "ltm_partition", None))
+        client = self._client()
         return {
-            "start": self.implementation.set_status_up,
-            "stop": self.implementation.set_status_down
+            "start": client.set_status_up,
+            "stop": client.set_status_down
         }[cmd](self.host, self.loadbalancer_ips)
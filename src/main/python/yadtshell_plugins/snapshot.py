@@ -0,0 +1,191 @@
+#   YADT - an Augmented Deployment Tool
+#   Copyright (C) 2010-2014  Immobilien Scout GmbH
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+    The snapshot module
+    Keeps the last known service states on disk, so that the next yadtshell
+    run can answer status requests before the backends have been queried.
+'''
+
+import errno
+import fcntl
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+from yadtshell_plugins.cache import UNKNOWN_STATES
+
+COMPACT_THRESHOLD = 1000
+
+logger = logging.getLogger('yadtshell.plugins.snapshot')
+
+
+class SnapshotStore(object):
+
+    """
+    Stores status results per key in an append-only file of JSON lines.
+    Each line holds the key, the status, the time it was observed and a
+    generation counter which is increased whenever the status of the key
+    changes. The last line of a key wins when the file is loaded, so lines
+    truncated by an interrupted run are simply ignored. The file is
+    rewritten with one line per key once it holds more than
+    `COMPACT_THRESHOLD` superseded lines. Appending and compacting hold an
+    exclusive lock on *path*.lock, so concurrent runs never append to a
+    file which was already replaced by a compaction.
+    A status is only answered from the snapshot if it is at most *max_age*
+    seconds old. The store is disabled without *path* or *max_age*.
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.path = None
+        self.max_age = 0
+        self.records = None
+        self.lines = 0
+        self.snapshot_file = None
+        self.lock_file = None
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, path, max_age):
+        if path != self.path:
+            self.close()
+            self.records = None
+        self.path = path
+        self.max_age = max_age
+
+    @property
+    def enabled(self):
+        return bool(self.path and self.max_age)
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        record = self._records().get(json.dumps(key))
+        if record is None or record['status'] is None or self.clock() - record['time'] > self.max_age:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return record['status']
+
+    def record(self, status, key):
+        """
+        Appends *status* for *key* and returns it, so it can be used as a
+        callback. Unknown states are not recorded.
+        """
+        if self.enabled and status not in UNKNOWN_STATES:
+            self._append(json.dumps(key), status)
+        return status
+
+    def invalidate(self, key):
+        if not self.enabled:
+            return
+        serialized_key = json.dumps(key)
+        record = self._records().get(serialized_key)
+        if record is not None and record['status'] is not None:
+            self._append(serialized_key, None)
+
+    def close(self):
+        if self.snapshot_file is not None:
+            self.snapshot_file.close()
+            self.snapshot_file = None
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+
+    def statistics(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self.records or {})}
+
+    def _records(self):
+        if self.records is None:
+            self._load()
+            if self.lines - len(self.records) > COMPACT_THRESHOLD:
+                self._compact()
+        return self.records
+
+    def _load(self):
+        self.records = {}
+        self.lines = 0
+        try:
+            with open(self.path) as snapshot_file:
+                for line in snapshot_file:
+                    self.lines += 1
+                    try:
+                        record = json.loads(line)
+                        self.records[record['key']] = record
+                    except (ValueError, KeyError, TypeError):
+                        logger.debug('ignoring malformed line %d of %s' % (self.lines, self.path))
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                logger.warning('cannot read status snapshot %s: %s' % (self.path, e))
+
+    @contextmanager
+    def _locked(self):
+        if self.lock_file is None:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            self.lock_file = open(self.path + '.lock', 'a')
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+    def _replaced(self):
+        try:
+            return os.fstat(self.snapshot_file.fileno()).st_ino != os.stat(self.path).st_ino
+        except OSError:
+            return True
+
+    def _append(self, serialized_key, status):
+        previous = self._records().get(serialized_key)
+        generation = previous['generation'] if previous else 0
+        if previous is None or previous['status'] != status:
+            generation += 1
+        record = {'key': serialized_key, 'status': status, 'time': self.clock(), 'generation': generation}
+        self.records[serialized_key] = record
+        try:
+            with self._locked():
+                if self.snapshot_file is not None and self._replaced():
+                    self.snapshot_file.close()
+                    self.snapshot_file = None
+                if self.snapshot_file is None:
+                    self.snapshot_file = open(self.path, 'a')
+                self.snapshot_file.write(json.dumps(record) + '\n')
+                self.snapshot_file.flush()
+            self.lines += 1
+        except (IOError, OSError) as e:
+            logger.warning('cannot write status snapshot %s, disabling it: %s' % (self.path, e))
+            self.close()
+            self.path = None
+
+    def _compact(self):
+        temporary_path = self.path + '.tmp'
+        try:
+            with self._locked():
+                self._load()
+                with open(temporary_path, 'w') as snapshot_file:
+                    for serialized_key in sorted(self.records):
+                        snapshot_file.write(json.dumps(self.records[serialized_key]) + '\n')
+                os.rename(temporary_path, self.path)
+            self.lines = len(self.records)
+        except (IOError, OSError) as e:
+            logger.warning('cannot compact status snapshot %s: %s' % (self.path, e))
@@ -0,0 +1,154 @@
+#   YADT - an Augmented Deployment Tool
+#   Copyright (C) 2010-2014  Immobilien Scout GmbH
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+    The timeouts module
+    Derives the connect, first byte and total timeouts of backend calls
+    from the latencies observed per endpoint.
+'''
+
+import logging
+
+from twisted.internet import reactor
+from twisted.internet.error import TimeoutError
+
+from yadtshell_plugins.metrics import METRICS, CONNECT, TIME_TO_FIRST_BYTE, LATENCY
+
+TIMEOUT_FACTOR = 3
+TIMEOUT_FLOOR_IN_SECONDS = 1
+MIN_SAMPLES = 20
+
+PHASES = {
+    CONNECT: 'connect',
+    TIME_TO_FIRST_BYTE: 'first byte',
+    LATENCY: 'total'
+}
+
+logger = logging.getLogger('yadtshell.plugins.timeouts')
+
+
+class AdaptiveTimeouts(object):
+
+    """
+    Holds the timeouts of every backend (e.G. 'rest', 'livestatus') for the
+    phases `CONNECT`, `TIME_TO_FIRST_BYTE` and `LATENCY` (total duration) of
+    a call. The configured timeout of a phase (None for no timeout) is used
+    as long as adaptive timeouts are disabled. With adaptive timeouts, the
+    timeout for an endpoint is the p99 of its recent latencies times
+    *factor*, at least *floor* and at most the configured timeout, once
+    `MIN_SAMPLES` latencies were observed.
+    Calls of a different *kind* than the usual calls of the backend (e.G.
+    'rest-collection' for large responses) use the settings of the backend
+    but only learn from the latencies observed for their kind.
+    """
+
+    def __init__(self, metrics=METRICS, clock=reactor):
+        self.metrics = metrics
+        self.clock = clock
+        self.settings = {}
+        self.adapted = {}
+        self.expired = 0
+
+    def configure(self, backend, timeouts=None, adaptive=None, factor=None, floor=None):
+        settings = self.settings.setdefault(backend, {'timeouts': {},
+                                                      'adaptive': False,
+                                                      'factor': TIMEOUT_FACTOR,
+                                                      'floor': TIMEOUT_FLOOR_IN_SECONDS})
+        for phase, timeout in (timeouts or {}).items():
+            if timeout is not None:
+                settings['timeouts'][phase] = timeout
+        if adaptive is not None:
+            settings['adaptive'] = adaptive
+        if factor is not None:
+            settings['factor'] = factor
+        if floor is not None:
+            settings['floor'] = floor
+
+    def timeout(self, backend, phase, endpoint, kind=None):
+        """
+        Returns the timeout in seconds for *phase* of a call to *endpoint*
+        or None if the phase has no timeout.
+        """
+        kind = kind or backend
+        settings = self.settings.get(backend, {'timeouts': {}, 'adaptive': False})
+        configured = settings['timeouts'].get(phase)
+        if not settings['adaptive']:
+            return configured
+        histogram = self.metrics.histogram(kind, phase, endpoint)
+        if len(histogram.recent) < MIN_SAMPLES:
+            return configured
+        timeout = max(histogram.percentile(99) * settings['factor'], settings['floor'])
+        if configured is not None:
+            timeout = min(timeout, configured)
+        self._adapted(kind, phase, endpoint, timeout)
+        return timeout
+
+    def expire(self, d, backend, phase, endpoint, kind=None):
+        """
+        Cancels *d* unless it fired within the timeout for *phase*, and
+        fails it with a `TimeoutError` instead of the failure caused by the
+        cancellation then. Returns *d*.
+        """
+        timeout = self.timeout(backend, phase, endpoint, kind)
+        if timeout is None:
+            return d
+        expired = []
+
+        def expire_call():
+            expired.append(True)
+            self.expired += 1
+            logger.warning('%s call to %s timed out after %.2fs (%s timeout)' % (backend, endpoint, timeout, PHASES[phase]))
+            d.cancel()
+
+        def stop(result):
+            if timeout_call.active():
+                timeout_call.cancel()
+            if expired and hasattr(result, 'check'):
+                raise TimeoutError('%s call to %s' % (backend, endpoint), '%s timeout of %.2fs' % (PHASES[phase], timeout))
+            return result
+
+        timeout_call = self.clock.callLater(timeout, expire_call)
+        d.addBoth(stop)
+        return d
+
+    def statistics(self):
+        return {'expired': self.expired,
+                'adapted': dict(('%s %s %s' % key, timeout) for key, timeout in self.adapted.items())}
+
+    def _adapted(self, kind, phase, endpoint, timeout):
+        key = (kind, PHASES[phase], endpoint)
+        previous = self.adapted.get(key)
+        if previous is None or abs(timeout - previous) > previous / 4:
+            logger.debug('%s timeout for %s calls to %s is now %.2fs' % (PHASES[phase], kind, endpoint, timeout))
+            self.adapted[key] = timeout
+
+
+def configure(backend, config):
+    """
+    Applies the optional timeout settings from the configuration module
+    *config* to *backend*.
+    """
+    TIMEOUTS.configure(backend,
+                       timeouts={CONNECT: getattr(config, 'CONNECT_TIMEOUT_IN_SECONDS', None),
+                                 TIME_TO_FIRST_BYTE: getattr(config, 'FIRST_BYTE_TIMEOUT_IN_SECONDS', None),
+                                 LATENCY: getattr(config, 'TOTAL_TIMEOUT_IN_SECONDS', None)},
+                       adaptive=getattr(config, 'ADAPTIVE_TIMEOUTS', None),
+                       factor=getattr(config, 'TIMEOUT_FACTOR', None),
+                       floor=getattr(config, 'TIMEOUT_FLOOR_IN_SECONDS', None))
+
+
+TIMEOUTS = AdaptiveTimeouts()
+METRICS.add_statistics_provider('timeouts', TIMEOUTS.statistics)
@@ -0,0 +1,68 @@
+#   YADT - an Augmented Deployment Tool
+#   Copyright (C) 2010-2014  Immobilien Scout GmbH
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from unittest import TestCase
+
+from yadtshell_plugins.cache import StatusCache
+
+
+class StatusCacheTest(TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.cache = StatusCache(clock=lambda: self.now)
+
+    def test_should_return_stored_status_until_ttl_expires(self):
+        self.cache.store(0, 'key', 5)
+
+        self.assertEqual(0, self.cache.get('key'))
+        self.now += 5
+        self.assertEqual(None, self.cache.get('key'))
+        self.assertEqual({'hits': 1, 'misses': 1, 'entries': 0}, self.cache.statistics())
+
+    def test_should_return_status_when_storing(self):
+        self.assertEqual(3, self.cache.store(3, 'key', 5))
+
+    def test_should_not_store_without_ttl(self):
+        self.cache.store(0, 'key', 0)
+
+        self.assertEqual(None, self.cache.get('key'))
+
+    def test_should_not_store_unknown_status(self):
+        self.cache.store('unknown', 'key', 5)
+        self.cache.store(None, 'other-key', 5)
+
+        self.assertEqual({}, self.cache.entries)
+
+    def test_should_forget_status_when_invalidated(self):
+        self.cache.store(0, 'key', 5)
+
+        self.cache.invalidate('key')
+
+        self.assertEqual(None, self.cache.get('key'))
+
+    def test_should_not_store_status_until_expected_status_is_observed(self):
+        self.cache.store(0, 'key', 5)
+        self.cache.invalidate('key', expected_status=3)
+
+        self.cache.store(0, 'key', 5)
+        self.assertEqual(None, self.cache.get('key'))
+
+        self.cache.store(3, 'key', 5)
+        self.assertEqual(3, self.cache.get('key'))
+
+        self.cache.store(0, 'key', 5)
+        self.assertEqual(0, self.cache.get('key'))
@@ -0,0 +1,118 @@
+#   YADT - an Augmented Deployment Tool
+#   Copyright (C) 2010-2014  Immobilien Scout GmbH
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from unittest import TestCase
+
+from mock import patch
+from twisted.internet import defer
+from twisted.python.failure import Failure
+from twisted.web.client import ResponseNeverReceived
+
+from yadtshell_plugins.circuitbreaker import CircuitBreakers, CircuitOpenError, CLOSED, HALF_OPEN, OPEN
+
+
+@patch('yadtshell_plugins.circuitbreaker.logger')
+class CircuitBreakerTest(TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.breakers = CircuitBreakers(clock=lambda: self.now)
+        self.breakers.configure('rest', failure_threshold=2, cooldown=30)
+        self.calls = 0
+
+    def call(self, result):
+        def f():
+            self.calls += 1
+            return result
+        outcomes = []
+        self.breakers.call('rest', '1.2.3.4', f).addBoth(outcomes.append)
+        return outcomes[0]
+
+    def fail(self):
+        return self.call(defer.fail(RuntimeError('connection refused')))
+
+    def test_should_open_after_consecutive_failures(self, _):
+        self.fail()
+        self.assertEqual(CLOSED, self.breakers.breaker('rest', '1.2.3.4').state)
+        self.fail()
+
+        outcome = self.call('ok')
+
+        self.assertEqual(OPEN, self.breakers.breaker('rest', '1.2.3.4').state)
+        self.assertTrue(outcome.check(CircuitOpenError))
+        self.assertEqual(2, self.calls)
+
+    def test_success_should_reset_failure_count(self, _):
+        self.fail()
+        self.call('ok')
+        self.fail()
+
+        self.assertEqual(CLOSED, self.breakers.breaker('rest', '1.2.3.4').state)
+
+    def test_should_not_count_cancelled_calls(self, _):
+        self.call(defer.fail(defer.CancelledError()))
+        self.call(defer.fail(defer.CancelledError()))
+
+        self.assertEqual(CLOSED, self.breakers.breaker('rest', '1.2.3.4').state)
+        self.assertEqual(0, self.breakers.breaker('rest', '1.2.3.4').failures)
+
+    def test_should_not_count_cancelled_http_requests(self, _):
+        self.call(defer.fail(ResponseNeverReceived([Failure(defer.CancelledError())])))
+
+        self.assertEqual(0, self.breakers.breaker('rest', '1.2.3.4').failures)
+
+    def test_should_let_one_probe_through_after_cooldown(self, _):
+        self.fail()
+        self.fail()
+        self.now += 30
+        probe = defer.Deferred()
+
+        self.breakers.call('rest', '1.2.3.4', lambda: probe)
+        rejected = self.call('ok')
+
+        self.assertEqual(HALF_OPEN, self.breakers.breaker('rest', '1.2.3.4').state)
+        self.assertTrue(rejected.check(CircuitOpenError))
+
+        probe.callback('ok')
+
+        self.assertEqual(CLOSED, self.breakers.breaker('rest', '1.2.3.4').state)
+        self.assertEqual('ok', self.call('ok'))
+
+    def test_failed_probe_should_open_again(self, _):
+        self.fail()
+        self.fail()
+        self.now += 30
+
+        self.fail()
+
+        self.assertEqual(OPEN, self.breakers.breaker('rest', '1.2.3.4').state)
+        self.assertEqual(2, self.breakers.statistics()['trips'])
+
+    def test_should_never_open_when_disabled(self, _):
+        self.breakers.configure('rest', failure_threshold=0)
+        for attempt in range(5):
+            self.fail()
+
+        self.assertEqual('ok', self.call('ok'))
+
+    def test_should_report_state_per_endpoint(self, _):
+        self.fail()
+        self.fail()
+
+        statistics = self.breakers.statistics()
+
+        self.assertEqual(1, statistics['open'])
+        self.assertEqual({'rest 1.2.3.4': OPEN}, statistics['states'])
@@ -16,10 +16,21 @@
 
 from unittest import TestCase
 
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.task import Clock
 from twisted.python.failure import Failure
-from mock import patch
+from mock import Mock, patch
 
-from yadtshell_plugins.f5rest import check_status_responses
+from yadtshell_plugins.f5rest import (check_status_responses,
+                                      collection_url,
+                                      configure,
+                                      ConvergenceWaiter,
+                                      F5RestClient,
+                                      NodeCollectionSnapshot,
+                                      RequestContext,
+                                      StateChangeBatcher,
+                                      State,
+                                      StatusResponseEvaluator)
 
 
 class CheckStatusResponsesForOneLbTest(TestCase):
@@ -83,3 +94,297 @@ class CheckStatusResponsesForXLbsTest(TestCase):
                      (False, failure)]
 
         self.assertEquals(None, check_status_responses(responses))
+
+
+class StatusResponseEvaluatorTest(TestCase):
+
+    UP = {'name': 'devytc97', 'state': 'up', 'session': 'monitor-enabled'}
+    DOWN = {'name': 'devytc97', 'state': 'user-down', 'session': 'user-disabled'}
+
+    def setUp(self):
+        self.deferreds = [Deferred(), Deferred(), Deferred()]
+        self.results = []
+        StatusResponseEvaluator(self.deferreds).evaluate().addCallback(self.results.append)
+
+    def test_should_return_0_when_all_lbs_report_enabled_node(self):
+        for d in self.deferreds:
+            d.callback(dict(self.UP))
+
+        self.assertEqual([0], self.results)
+
+    def test_should_return_3_when_all_lbs_report_disabled_node(self):
+        for d in reversed(self.deferreds):
+            d.callback(dict(self.DOWN))
+
+        self.assertEqual([3], self.results)
+
+    @patch('yadtshell_plugins.f5rest.logger')
+    def test_should_return_None_and_cancel_remaining_requests_on_first_divergence(self, _):
+        self.deferreds[2].callback(dict(self.UP))
+        self.deferreds[0].callback(dict(self.DOWN, lb_ip='1.2.3.4'))
+
+        self.assertEqual([None], self.results)
+        self.assertTrue(self.deferreds[1].called)
+
+    @patch('yadtshell_plugins.f5rest.logger')
+    def test_should_return_None_on_first_failure(self, _):
+        failure = Failure(RuntimeError('connection refused'))
+        failure.lb_ip = '192.168.0.1'
+
+        self.deferreds[1].errback(failure)
+
+        self.assertEqual([None], self.results)
+        self.assertTrue(all(d.called for d in self.deferreds))
+
+
+class NodeCollectionSnapshotTest(TestCase):
+
+    COLLECTION = {'items': [{'name': 'devytc97', 'state': 'up', 'session': 'monitor-enabled'},
+                            {'name': 'devytc98', 'state': 'user-down', 'session': 'user-disabled'}]}
+
+    def test_should_filter_collection_by_partition(self):
+        self.assertEqual('https://1.2.3.4/mgmt/tm/ltm/node?$filter=partition%20eq%20Common',
+                         collection_url('1.2.3.4', '~Common~'))
+
+    @patch('yadtshell_plugins.f5rest.rest_call')
+    def test_should_fetch_collection_once_for_all_hosts(self, mock_rest_call):
+        collection = Deferred()
+        mock_rest_call.return_value = collection
+        snapshot = NodeCollectionSnapshot(F5RestClient('user', 'password', '~Common~'))
+        results = []
+
+        snapshot.node('1.2.3.4', 'devytc97').addCallback(results.append)
+        snapshot.node('1.2.3.4', 'devytc98').addCallback(results.append)
+        collection.callback(self.COLLECTION)
+        snapshot.node('1.2.3.4', 'devytc99').addCallback(results.append)
+
+        self.assertEqual(1, mock_rest_call.call_count)
+        self.assertEqual(['up', 'user-down', None], [node and node['state'] for node in results])
+
+    @patch('yadtshell_plugins.f5rest.rest_call')
+    def test_should_drop_only_changed_node(self, mock_rest_call):
+        mock_rest_call.return_value = succeed(self.COLLECTION)
+        snapshot = NodeCollectionSnapshot(F5RestClient('user', 'password', '~Common~'))
+        results = []
+
+        snapshot.node('1.2.3.4', 'devytc97')
+        snapshot.invalidate('1.2.3.4', 'devytc97')
+        snapshot.node('1.2.3.4', 'devytc97').addCallback(results.append)
+        snapshot.node('1.2.3.4', 'devytc98').addCallback(results.append)
+
+        self.assertEqual(1, mock_rest_call.call_count)
+        self.assertEqual([None, 'user-down'], [node and node['state'] for node in results])
+
+    @patch('yadtshell_plugins.f5rest.rest_call')
+    def test_should_drop_node_changed_while_collection_is_fetched(self, mock_rest_call):
+        collection = Deferred()
+        mock_rest_call.return_value = collection
+        snapshot = NodeCollectionSnapshot(F5RestClient('user', 'password', '~Common~'))
+        results = []
+
+        snapshot.node('1.2.3.4', 'devytc97').addCallback(results.append)
+        snapshot.invalidate('1.2.3.4', 'devytc97')
+        collection.callback(self.COLLECTION)
+
+        self.assertEqual([None], results)
+        self.assertEqual(['devytc98'], list(snapshot.nodes['1.2.3.4']))
+
+    @patch('yadtshell_plugins.f5rest.rest_call')
+    def test_should_not_cache_failed_fetch(self, mock_rest_call):
+        collection = Deferred()
+        mock_rest_call.return_value = collection
+        snapshot = NodeCollectionSnapshot(F5RestClient('user', 'password', '~Common~'))
+        failures = []
+
+        snapshot.node('1.2.3.4', 'devytc97').addErrback(failures.append)
+        collection.errback(RuntimeError('connection refused'))
+
+        self.assertEqual(1, len(failures))
+        self.assertEqual({}, snapshot.nodes)
+        self.assertEqual({}, snapshot.pending)
+
+    @patch('yadtshell_plugins.f5rest.rest_call')
+    def test_should_answer_node_from_prefetched_collection(self, mock_rest_call):
+        collection = Deferred()
+        mock_rest_call.return_value = collection
+        snapshot = NodeCollectionSnapshot(F5RestClient('user', 'password', '~Common~'))
+        results = []
+
+        snapshot.prefetch('1.2.3.4')
+        snapshot.prefetch('1.2.3.4')
+        snapshot.node('1.2.3.4', 'devytc97').addCallback(results.append)
+        collection.callback(self.COLLECTION)
+
+        self.assertEqual(1, mock_rest_call.call_count)
+        self.assertEqual(['up'], [node['state'] for node in results])
+
+    @patch('yadtshell_plugins.f5rest.logger')
+    @patch('yadtshell_plugins.f5rest.rest_call')
+    def test_should_fetch_again_when_prefetch_failed(self, mock_rest_call, _):
+        failed_collection = Deferred()
+        mock_rest_call.side_effect = [failed_collection, succeed(self.COLLECTION)]
+        snapshot = NodeCollectionSnapshot(F5RestClient('user', 'password', '~Common~'))
+        results = []
+
+        snapshot.prefetch('1.2.3.4')
+        failed_collection.errback(RuntimeError('connection refused'))
+        snapshot.node('1.2.3.4', 'devytc97').addCallback(results.append)
+
+        self.assertEqual(2, mock_rest_call.call_count)
+        self.assertEqual(['up'], [node['state'] for node in results])
+
+
+class ConfigureTest(TestCase):
+
+    def config(self, **settings):
+        return Mock(spec=['RESTAPI_USERNAME', 'RESTAPI_PASSWORD', 'CLUSTERS'] + list(settings),
+                    RESTAPI_USERNAME='user', RESTAPI_PASSWORD='password', CLUSTERS={'one': ['1.2.3.4']}, **settings)
+
+    def test_should_create_one_client_per_credentials_and_partition(self):
+        config = self.config()
+
+        client = configure(config, '~ConfigureTest~')
+
+        self.assertTrue(client is configure(config, '~ConfigureTest~'))
+        self.assertFalse(client is configure(config, '~OtherConfigureTest~'))
+        self.assertEqual('~ConfigureTest~', client.ltm_partition)
+
+    def test_should_prebuild_contexts_of_all_clusters(self):
+        client = configure(self.config(), '~ClustersConfigureTest~')
+
+        self.assertEqual(['1.2.3.4'], list(client.contexts))
+
+    def test_should_fail_without_partition(self):
+        self.assertRaises(RuntimeError, configure, self.config(), None)
+
+
+class RequestContextTest(TestCase):
+
+    def setUp(self):
+        self.context = RequestContext('1.2.3.4', '~Common~', 'Basic dXNlcjpwYXNzd29yZA==')
+
+    def test_should_build_urls_once(self):
+        self.assertEqual('https://1.2.3.4/mgmt/tm/ltm/node/~Common~devytc97', self.context.node_url('devytc97'))
+        self.assertEqual('https://1.2.3.4/mgmt/tm/ltm/node?$filter=partition%20eq%20Common', self.context.collection_url)
+        self.assertEqual('https://1.2.3.4/mgmt/tm/transaction', self.context.transaction_url)
+
+    def test_should_prebuild_headers(self):
+        self.assertEqual(['Basic dXNlcjpwYXNzd29yZA=='], self.context.headers.getRawHeaders('Authorization'))
+        self.assertEqual(['application/json'], self.context.headers.getRawHeaders('Content-Type'))
+
+    def test_transaction_headers_should_not_modify_shared_headers(self):
+        headers = self.context.transaction_headers(42)
+
+        self.assertEqual(['42'], headers.getRawHeaders('X-F5-REST-Coordination-Id'))
+        self.assertFalse(self.context.headers.hasHeader('X-F5-REST-Coordination-Id'))
+
+    def test_should_be_immutable(self):
+        self.assertRaises(AttributeError, setattr, self.context, 'lb_ip', '5.6.7.8')
+
+    def test_payload_templates_should_match_state(self):
+        self.assertEqual('{"name": "devytc97","session": "user-enabled","state": "user-up"}', State.up('devytc97'))
+        self.assertEqual('{"name": "devytc97","session": "user-disabled","state": "user-down"}', State.down('devytc97'))
+
+
+class SetStatusManyTest(TestCase):
+
+    @patch('yadtshell_plugins.f5rest.rest_call')
+    def test_should_change_state_of_all_hosts_in_one_transaction(self, mock_rest_call):
+        mock_rest_call.side_effect = [succeed({'transId': 42}),
+                                      succeed({'transId': 42, 'commandId': 1}),
+                                      succeed({'transId': 42, 'commandId': 2}),
+                                      succeed({'transId': 42, 'state': 'COMPLETED'})]
+        results = []
+
+        F5RestClient('user', 'password', '~Common~').set_status_down_many(['devytc97', 'devytc98'], ['1.2.3.4']).addCallback(results.append)
+
+        self.assertEqual([{'devytc97': 0, 'devytc98': 0}], results)
+        urls = [call_args[0][0] for call_args in mock_rest_call.call_args_list]
+        self.assertEqual(['https://1.2.3.4/mgmt/tm/transaction',
+                          'https://1.2.3.4/mgmt/tm/ltm/node/~Common~devytc97',
+                          'https://1.2.3.4/mgmt/tm/ltm/node/~Common~devytc98',
+                          'https://1.2.3.4/mgmt/tm/transaction/42'], urls)
+        self.assertEqual(['42'], mock_rest_call.call_args_list[1][1]['headers'].getRawHeaders('X-F5-REST-Coordination-Id'))
+
+    @patch('yadtshell_plugins.f5rest.logger')
+    @patch('yadtshell_plugins.f5rest.rest_call')
+    def test_should_report_failed_node_only(self, mock_rest_call, _):
+        mock_rest_call.side_effect = [succeed({'transId': 42}),
+                                      succeed({'transId': 42, 'commandId': 1}),
+                                      succeed({'code': 400, 'errorStack': []}),
+                                      succeed({'transId': 42, 'state': 'COMPLETED'})]
+        results = []
+
+        F5RestClient('user', 'password', '~Common~').set_status_down_many(['devytc97', 'devytc98'], ['1.2.3.4']).addCallback(results.append)
+
+        self.assertEqual([{'devytc97': 0, 'devytc98': 1}], results)
+
+    @patch('yadtshell_plugins.f5rest.logger')
+    @patch('yadtshell_plugins.f5rest.rest_call')
+    def test_should_report_all_nodes_when_commit_fails(self, mock_rest_call, _):
+        mock_rest_call.side_effect = [succeed({'transId': 42}),
+                                      succeed({'transId': 42, 'commandId': 1}),
+                                      succeed({'transId': 42, 'commandId': 2}),
+                                      succeed({'transId': 42, 'state': 'FAILED', 'failureReason': 'boom'})]
+        results = []
+
+        F5RestClient('user', 'password', '~Common~').set_status_down_many(['devytc97', 'devytc98'], ['1.2.3.4']).addCallback(results.append)
+
+        self.assertEqual([{'devytc97': 1, 'devytc98': 1}], results)
+
+    @patch('yadtshell_plugins.f5rest.reactor')
+    def test_batcher_should_fan_out_results_per_host(self, _):
+        client = Mock(F5RestClient)
+        client.set_state_many.return_value = succeed({'devytc97': 0, 'devytc98': 1})
+        batcher = StateChangeBatcher()
+        results = {}
+
+        batcher.set_state(client, 'devytc98', ['1.2.3.4'], State.down).addCallback(lambda result: results.update(devytc98=result))
+        batcher.set_state(client, 'devytc97', ['1.2.3.4'], State.down).addCallback(lambda result: results.update(devytc97=result))
+        batcher.flush((client, State.down, ('1.2.3.4',)))
+
+        client.set_state_many.assert_called_once_with(['devytc97', 'devytc98'], ('1.2.3.4',), State.down)
+        self.assertEqual({'devytc97': 0, 'devytc98': 1}, results)
+
+    @patch('yadtshell_plugins.f5rest.reactor')
+    def test_batcher_should_not_mix_clients(self, _):
+        batcher = StateChangeBatcher()
+
+        batcher.set_state(Mock(F5RestClient), 'devytc97', ['1.2.3.4'], State.down)
+        batcher.set_state(Mock(F5RestClient), 'devytc98', ['1.2.3.4'], State.down)
+
+        self.assertEqual(2, len(batcher.pending))
+
+
+class ConvergenceWaiterTest(TestCase):
+
+    UP = {'name': 'devytc97', 'state': 'up', 'session': 'monitor-enabled'}
+    DOWN = {'name': 'devytc97', 'state': 'user-down', 'session': 'user-disabled'}
+
+    @patch('yadtshell_plugins.f5rest.F5RestClient.query_status_from_single_lb')
+    def test_should_poll_only_lbs_which_did_not_converge(self, mock_query):
+        clock = Clock()
+        mock_query.side_effect = lambda host, lb_ip, from_snapshot: succeed(dict(self.DOWN if lb_ip == '1.1.1.1' else self.UP, lb_ip=lb_ip))
+        results = []
+
+        ConvergenceWaiter(F5RestClient('user', 'password', '~Common~'), 'devytc97', ['1.1.1.1', '2.2.2.2'], False, 30, clock).wait().addCallback(results.append)
+        self.assertEqual(2, mock_query.call_count)
+
+        mock_query.side_effect = lambda host, lb_ip, from_snapshot: succeed(dict(self.DOWN, lb_ip=lb_ip))
+        clock.advance(1)
+
+        self.assertEqual(3, mock_query.call_count)
+        self.assertEqual('2.2.2.2', mock_query.call_args[0][1])
+        self.assertEqual([True], results)
+
+    @patch('yadtshell_plugins.f5rest.F5RestClient.query_status_from_single_lb')
+    def test_should_give_up_after_timeout(self, mock_query):
+        clock = Clock()
+        mock_query.side_effect = lambda host, lb_ip, from_snapshot: succeed(dict(self.UP, lb_ip=lb_ip))
+        results = []
+
+        ConvergenceWaiter(F5RestClient('user', 'password', '~Common~'), 'devytc97', ['1.1.1.1'], False, 10, clock).wait().addCallback(results.append)
+        clock.pump([1] * 10)
+
+        self.assertEqual([False], results)
+        self.assertTrue(mock_query.call_count < 10)
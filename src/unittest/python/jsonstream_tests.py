@@ -0,0 +1,68 @@
+#   YADT - an Augmented Deployment Tool
+#   Copyright (C) 2010-2014  Immobilien Scout GmbH
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from unittest import TestCase
+
+from yadtshell_plugins.jsonstream import IncrementalObjectDecoder
+
+NODE = b'{"name": "devytc97", "fqdn": {"tmName": "x", "list": [1, {"a": "}"}]}, "description": "say \\"hi\\", {ok}", "session": "monitor-enabled", "state": "up"}'
+
+
+class IncrementalObjectDecoderTest(TestCase):
+
+    def feed_in_chunks(self, data, chunk_size):
+        decoder = IncrementalObjectDecoder()
+        for start in range(0, len(data), chunk_size):
+            decoder.feed(data[start:start + chunk_size])
+        return decoder
+
+    def test_should_decode_whole_document(self):
+        decoder = self.feed_in_chunks(NODE, len(NODE))
+
+        self.assertTrue(decoder.finished)
+        self.assertEqual({'name': 'devytc97',
+                          'fqdn': {'tmName': 'x', 'list': [1, {'a': '}'}]},
+                          'description': 'say "hi", {ok}',
+                          'session': 'monitor-enabled',
+                          'state': 'up'}, decoder.members)
+
+    def test_should_decode_document_fed_in_arbitrary_chunks(self):
+        for chunk_size in range(1, 12):
+            decoder = self.feed_in_chunks(NODE, chunk_size)
+
+            self.assertTrue(decoder.finished)
+            self.assertEqual('say "hi", {ok}', decoder.members['description'])
+            self.assertEqual('up', decoder.members['state'])
+
+    def test_should_decode_members_before_document_is_complete(self):
+        decoder = IncrementalObjectDecoder()
+
+        decoder.feed(b'{"name": "devytc97", "state": "up", "sess')
+
+        self.assertFalse(decoder.finished)
+        self.assertTrue(decoder.has_members(['name', 'state']))
+        self.assertFalse(decoder.has_members(['name', 'state', 'session']))
+
+    def test_should_decode_empty_object(self):
+        decoder = self.feed_in_chunks(b' {} ', 1)
+
+        self.assertTrue(decoder.finished)
+        self.assertEqual({}, decoder.members)
+
+    def test_should_refuse_documents_other_than_objects(self):
+        decoder = IncrementalObjectDecoder()
+
+        self.assertRaises(ValueError, decoder.feed, b'[1, 2]')
@@ -14,16 +14,30 @@
 #   You should have received a copy of the GNU General Public License
 #   along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import json
 import unittest
-from mock import patch
+from mock import Mock, patch
+from twisted.internet import defer, task
+from twisted.internet.error import TimeoutError
+from twisted.web.iweb import UNKNOWN_LENGTH
+from yadtshell_plugins import livestatus_service
+from yadtshell_plugins.circuitbreaker import CircuitBreakers
+from yadtshell_plugins.metrics import RESPONSE_SIZE, Metrics
 from yadtshell_plugins.livestatus_service import (LivestatusServiceHandler,
-                                                  LivestatusServiceStatusResponse)
+                                                  LivestatusServiceStatusResponse,
+                                                  NotificationStateSubscription,
+                                                  StatusPage,
+                                                  StatusPageConsumer,
+                                                  StatusQueryCoalescer,
+                                                  read_status_page)
+from yadtshell_plugins.rest import ResponseTooLargeError
 
 
 class LivestatusServiceHandlerTests(unittest.TestCase):
 
     @patch('yadtshell_plugins.livestatus_service.LivestatusServiceHandler._get_page')
     def test_should_call_correct_url_when_building_deferred_livestatus_command(self, mock_get_page):
+        mock_get_page.return_value = defer.Deferred()
         livestatus = LivestatusServiceHandler('livestatus_server', 'host')
 
         livestatus.build_deferred_livestatus_command('command', lambda: None)
@@ -33,6 +47,7 @@ class LivestatusServiceHandlerTests(unittest.TestCase):
 
     @patch('yadtshell_plugins.livestatus_service.LivestatusServiceHandler._get_page')
     def test_should_call_correct_url_when_building_deferred_service_notifications_status(self, mock_get_page):
+        mock_get_page.return_value = defer.Deferred()
         livestatus = LivestatusServiceHandler('livestatus_server', 'host')
 
         livestatus.build_deferred_for_service_notification_status(lambda: None)
@@ -42,34 +57,419 @@ class LivestatusServiceHandlerTests(unittest.TestCase):
 
     @patch('yadtshell_plugins.livestatus_service.LivestatusServiceHandler._get_page')
     def test_should_call_correct_url_when_building_deferred_host_notifications_service_wait(self, mock_get_page):
+        mock_get_page.return_value = defer.Deferred()
         livestatus = LivestatusServiceHandler('livestatus_server', 'host')
 
         livestatus.build_deferred_livestatus_wait_for_notifications_state(
             lambda: None)
 
-        mock_get_page.assert_called_with(
+        mock_get_page.assert_any_call(
             'http://livestatus_server:8080/query?q=GET%20hosts\\nColumns:%20host_name%20notifications_enabled\\nFilter:%20host_name%20=%20host\\nWaitObject:%20host\\nWaitCondition:%20notifications_enabled%20=%200\\nWaitTimeout:%2020000')
 
     @patch('yadtshell_plugins.livestatus_service.LivestatusServiceHandler._get_page')
     def test_should_wait_for_notifications_enabled_to_be_1_when_host_notifications_were_enabled(self, mock_get_page):
+        mock_get_page.return_value = defer.Deferred()
         livestatus = LivestatusServiceHandler('livestatus_server', 'host')
         livestatus.is_starting = True
         livestatus.build_deferred_livestatus_wait_for_notifications_state(
             lambda: None)
 
-        mock_get_page.assert_called_with(
+        mock_get_page.assert_any_call(
             'http://livestatus_server:8080/query?q=GET%20hosts\\nColumns:%20host_name%20notifications_enabled\\nFilter:%20host_name%20=%20host\\nWaitObject:%20host\\nWaitCondition:%20notifications_enabled%20=%201\\nWaitTimeout:%2020000')
 
     @patch('yadtshell_plugins.livestatus_service.LivestatusServiceHandler._get_page')
     def test_should_wait_for_notifications_enabled_to_be_0_when_host_notifications_were_disabled(self, mock_get_page):
+        mock_get_page.return_value = defer.Deferred()
         livestatus = LivestatusServiceHandler('livestatus_server', 'host')
         livestatus.is_starting = False
         livestatus.build_deferred_livestatus_wait_for_notifications_state(
             lambda: None)
 
-        mock_get_page.assert_called_with(
+        mock_get_page.assert_any_call(
             'http://livestatus_server:8080/query?q=GET%20hosts\\nColumns:%20host_name%20notifications_enabled\\nFilter:%20host_name%20=%20host\\nWaitObject:%20host\\nWaitCondition:%20notifications_enabled%20=%200\\nWaitTimeout:%2020000')
 
+    @patch('yadtshell_plugins.livestatus_service.LivestatusServiceHandler._get_page')
+    def test_should_wait_until_no_service_has_a_different_notification_state(self, mock_get_page):
+        service_pages = ['[["host", "http", 1]]', '[]']
+        urls = []
+
+        def get_page(url):
+            urls.append(url)
+            if 'GET%20services' in url:
+                return defer.succeed(response_with_body(service_pages.pop(0)))
+            return defer.succeed(response_with_body('[["host", 0]]'))
+
+        mock_get_page.side_effect = get_page
+        livestatus = LivestatusServiceHandler('livestatus_server', 'host')
+        livestatus.is_starting = False
+        results = []
+
+        livestatus.build_deferred_livestatus_wait_for_notifications_state(results.append)
+
+        self.assertEqual(['[["host", 0]]'], results)
+        self.assertEqual(3, len(urls))
+        self.assertEqual('http://livestatus_server:8080/query?q=GET%20services\\nColumns:%20host_name%20description%20notifications_enabled'
+                         '\\nFilter:%20host_name%20=%20host\\nFilter:%20notifications_enabled%20!=%200\\nAnd:%202', urls[1])
+        self.assertTrue(urls[2].startswith(urls[1] + '\\nWaitObject:%20host;http\\nWaitCondition:%20notifications_enabled%20=%200'
+                                                     '\\nWaitTimeout:%20'))
+
+    @patch('yadtshell_plugins.livestatus_service.LivestatusServiceHandler._get_page')
+    def test_should_query_pending_services_of_several_hosts_at_once(self, mock_get_page):
+        mock_get_page.return_value = defer.Deferred()
+        livestatus = LivestatusServiceHandler('livestatus_server', None)
+
+        livestatus.build_deferred_for_pending_services({'host1': 0, 'host2': 1})
+
+        mock_get_page.assert_called_with(
+            'http://livestatus_server:8080/query?q=GET%20services\\nColumns:%20host_name%20description%20notifications_enabled'
+            '\\nFilter:%20host_name%20=%20host1\\nFilter:%20notifications_enabled%20!=%200\\nAnd:%202'
+            '\\nFilter:%20host_name%20=%20host2\\nFilter:%20notifications_enabled%20!=%201\\nAnd:%202\\nOr:%202')
+
+
+class StatusQueryCoalescerTests(unittest.TestCase):
+
+    @patch('yadtshell_plugins.livestatus_service.LivestatusServiceHandler._get_page')
+    def test_should_call_correct_url_when_building_deferred_for_multiple_hosts(self, mock_get_page):
+        livestatus = LivestatusServiceHandler('livestatus_server', None)
+
+        livestatus.build_deferred_for_hosts_notification_status(['host1', 'host2'])
+
+        mock_get_page.assert_called_with(
+            'http://livestatus_server:8080/query?q=GET%20hosts\\nColumns:%20alias%20notifications_enabled\\nFilter:%20alias%20=%20host1\\nFilter:%20alias%20=%20host2\\nOr:%202&key=alias')
+
+    @patch('yadtshell_plugins.livestatus_service.reactor')
+    @patch('yadtshell_plugins.livestatus_service.LivestatusServiceHandler.build_deferred_for_hosts_notification_status')
+    def test_should_merge_queries_of_one_reactor_iteration(self, mock_build_deferred, mock_reactor):
+        mock_build_deferred.return_value = defer.Deferred()
+        coalescer = StatusQueryCoalescer('livestatus_server')
+
+        coalescer.query('host2')
+        coalescer.query('host1')
+        coalescer.query('host1')
+        coalescer.flush()
+
+        mock_reactor.callLater.assert_called_once_with(0, coalescer.flush)
+        self.assertEqual(1, mock_build_deferred.call_count)
+        self.assertEqual(['host1', 'host2'], mock_build_deferred.call_args[0][0])
+
+    @patch('yadtshell_plugins.livestatus_service.reactor')
+    @patch('yadtshell_plugins.livestatus_service.LivestatusServiceHandler.build_deferred_for_hosts_notification_status')
+    def test_should_fan_out_responses_to_each_waiting_host(self, mock_build_deferred, _):
+        page = defer.Deferred()
+        mock_build_deferred.return_value = page
+        coalescer = StatusQueryCoalescer('livestatus_server')
+        results = []
+
+        coalescer.query('host1').addCallback(results.append)
+        coalescer.query('host2').addCallback(results.append)
+        coalescer.flush()
+        page.callback(StatusPage(json.loads('{"host1":{"notifications_enabled":1},"host2":{"notifications_enabled":0}}')))
+
+        self.assertEqual(['host1', 'host2'], [response.host for response in results])
+        self.assertEqual([True, False], [response.notifications_are_enabled() for response in results])
+
+    @patch('yadtshell_plugins.livestatus_service.reactor')
+    @patch('yadtshell_plugins.livestatus_service.LivestatusServiceHandler.build_deferred_for_hosts_notification_status')
+    def test_should_fan_out_failure_to_each_waiting_host(self, mock_build_deferred, _):
+        page = defer.Deferred()
+        mock_build_deferred.return_value = page
+        coalescer = StatusQueryCoalescer('livestatus_server')
+        failures = []
+
+        coalescer.query('host1').addErrback(failures.append)
+        coalescer.query('host2').addErrback(failures.append)
+        coalescer.flush()
+        page.errback(RuntimeError('connection refused'))
+
+        self.assertEqual(2, len(failures))
+
+
+class NotificationStateSubscriptionTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.subscription = NotificationStateSubscription('livestatus_server', self.clock)
+        self.queries = []
+
+        def build_deferred_for_hosts_notification_status(handler, hosts, wait_timeout=None):
+            d = defer.Deferred()
+            self.queries.append((hosts, wait_timeout, d))
+            return d
+
+        patcher = patch.object(LivestatusServiceHandler, 'build_deferred_for_hosts_notification_status',
+                               build_deferred_for_hosts_notification_status)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.services_waits = []
+
+        def wait_for_services_notifications_state(handler, targets):
+            self.services_waits.append(targets)
+            return defer.succeed([])
+
+        patcher = patch.object(LivestatusServiceHandler, 'wait_for_services_notifications_state',
+                               wait_for_services_notifications_state)
+        self.wait_for_services = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def answer(self, page):
+        self.queries[-1][2].callback(StatusPage(json.loads(page)))
+
+    def test_should_wait_for_all_hosts_with_one_long_polling_query(self):
+        results = []
+
+        self.subscription.wait_for('host1', 0).addCallback(results.append)
+        self.subscription.wait_for('host2', 0).addCallback(results.append)
+        self.clock.advance(0)
+        self.answer('{"host1":{"notifications_enabled":0},"host2":{"notifications_enabled":1}}')
+        self.answer('{"host2":{"notifications_enabled":0}}')
+
+        self.assertEqual([(['host1', 'host2'], None), (['host2'], livestatus_service.SUBSCRIPTION_WAIT_TIMEOUT_IN_SECONDS)],
+                         [(hosts, wait_timeout) for hosts, wait_timeout, _ in self.queries[:2]])
+        self.assertEqual(['host1', 'host2'], [response.host for response in results])
+        self.assertEqual([False, False], [response.notifications_are_enabled() for response in results])
+        self.assertEqual(2, len(self.queries))
+        self.assertFalse(self.subscription.polling)
+
+    def test_should_resolve_host_once_its_services_reached_the_state(self):
+        services_wait = defer.Deferred()
+        self.wait_for_services = Mock(return_value=services_wait)
+        results = []
+
+        with patch.object(LivestatusServiceHandler, 'wait_for_services_notifications_state', self.wait_for_services):
+            self.subscription.wait_for('host1', 0).addCallback(results.append)
+            self.subscription.wait_for('host2', 0).addCallback(results.append)
+            self.clock.advance(0)
+            self.answer('{"host1":{"notifications_enabled":0},"host2":{"notifications_enabled":0}}')
+
+        self.wait_for_services.assert_called_once_with({'host1': 0, 'host2': 0})
+        self.assertEqual([], results)
+
+        services_wait.callback([])
+
+        self.assertEqual(['host1', 'host2'], sorted(response.host for response in results))
+
+    @patch('yadtshell_plugins.livestatus_service.logger')
+    def test_should_resolve_with_last_known_state_when_wait_times_out(self, _):
+        results = []
+
+        self.subscription.wait_for('host1', 1).addCallback(results.append)
+        self.clock.advance(0)
+        self.answer('{"host1":{"notifications_enabled":0}}')
+        self.clock.advance(livestatus_service.NOTIFICATIONS_WAIT_TIMEOUT_IN_SECONDS)
+
+        self.assertFalse(results[0].notifications_are_enabled())
+        self.assertEqual({}, self.subscription.waiting)
+
+    @patch('yadtshell_plugins.livestatus_service.logger')
+    def test_should_fail_with_timeout_when_host_was_never_observed(self, _):
+        failures = []
+
+        self.subscription.wait_for('host1', 1).addErrback(failures.append)
+        self.clock.advance(livestatus_service.NOTIFICATIONS_WAIT_TIMEOUT_IN_SECONDS)
+
+        self.assertTrue(failures[0].check(TimeoutError))
+        self.assertEqual({}, self.subscription.waiting)
+
+    def test_should_fail_waiting_hosts_when_query_fails(self):
+        failures = []
+
+        self.subscription.wait_for('host1', 1).addErrback(failures.append)
+        self.clock.advance(0)
+        self.queries[-1][2].errback(RuntimeError('connection refused'))
+
+        self.assertTrue(failures[0].check(RuntimeError))
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    @patch('yadtshell_plugins.livestatus_service.MAX_HOSTS_PER_STATUS_QUERY', 1)
+    def test_should_fail_only_hosts_of_failed_query(self):
+        failures = []
+        results = []
+
+        self.subscription.wait_for('host1', 1).addErrback(failures.append)
+        self.subscription.wait_for('host2', 1).addCallback(results.append)
+        self.clock.advance(0)
+        self.queries[0][2].errback(RuntimeError('connection refused'))
+        self.queries[1][2].callback(StatusPage({'host2': {'notifications_enabled': 1}}))
+
+        self.assertTrue(failures[0].check(RuntimeError))
+        self.assertEqual(['host2'], [response.host for response in results])
+
+    @patch('yadtshell_plugins.livestatus_service.SUBSCRIBE_NOTIFICATION_STATE', True)
+    @patch('yadtshell_plugins.livestatus_service.subscription')
+    def test_handler_should_wait_on_subscription_when_subscribed(self, mock_subscription):
+        mock_subscription.return_value.wait_for.return_value = defer.succeed('response')
+        livestatus = LivestatusServiceHandler('livestatus_server', 'host')
+        livestatus.is_starting = True
+
+        livestatus.build_deferred_livestatus_wait_for_notifications_state(lambda response: None)
+
+        mock_subscription.return_value.wait_for.assert_called_with('host', 1)
+
+
+class StatusPageConsumerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.finished = defer.Deferred()
+        self.results = []
+        self.failures = []
+        self.finished.addCallbacks(self.results.append, self.failures.append)
+
+    def test_should_decode_page_delivered_in_chunks(self):
+        consumer = StatusPageConsumer(self.finished, max_size=1024)
+
+        for chunk in ['{"host1":{"notifi', 'cations_enabled":1},', '"host2":{"notifications_enabled":0}}']:
+            consumer.dataReceived(chunk)
+        consumer.connectionLost(None)
+
+        page = self.results[0]
+        self.assertEqual({'notifications_enabled': 1}, page.row('host1'))
+        self.assertEqual(None, page.row('host3'))
+        self.assertFalse(page.response_for('host2').notifications_are_enabled())
+
+    def test_should_abort_response_exceeding_max_size(self):
+        consumer = StatusPageConsumer(self.finished, max_size=10)
+        consumer.transport = Mock()
+
+        consumer.dataReceived('{"host1":{"notifications_enabled":1}}')
+        consumer.connectionLost(None)
+
+        consumer.transport.stopProducing.assert_called_once_with()
+        self.assertTrue(self.failures[0].check(ResponseTooLargeError))
+
+    def test_should_fail_with_head_of_unexpected_response(self):
+        consumer = StatusPageConsumer(self.finished, max_size=1024)
+        consumer.transport = Mock()
+
+        consumer.dataReceived('Internal Server Error')
+        consumer.connectionLost(None)
+
+        consumer.transport.stopProducing.assert_called_once_with()
+        self.assertTrue(self.failures[0].check(ValueError))
+        self.assertTrue('Internal Server Error' in str(self.failures[0].value))
+
+    def test_should_stop_receiving_page_when_read_is_cancelled(self):
+        response = Mock()
+        d = read_status_page(response)
+        consumer = response.deliverBody.call_args[0][0]
+        consumer.transport = Mock()
+        d.addErrback(lambda failure: None)
+
+        d.cancel()
+        consumer.dataReceived('{"host1":{"notifications_enabled":1}}')
+
+        consumer.transport.stopProducing.assert_called_once_with()
+        self.assertEqual(0, consumer.size)
+
+
+def response_with_body(body):
+    response = Mock(length=len(body))
+
+    def deliver_body(consumer):
+        consumer.makeConnection(Mock())
+        consumer.dataReceived(body)
+        consumer.connectionLost(None)
+
+    response.deliverBody.side_effect = deliver_body
+    return response
+
+
+class LivestatusServiceConnectionLimitTests(unittest.TestCase):
+
+    def setUp(self):
+        self.max_connections = livestatus_service.HTTP_MAX_CONNECTIONS_PER_SERVER
+        livestatus_service.CONNECTION_LIMITS.clear()
+        livestatus_service.LONG_POLL_LIMITS.clear()
+
+    def tearDown(self):
+        livestatus_service.HTTP_MAX_CONNECTIONS_PER_SERVER = self.max_connections
+        livestatus_service.CONNECTION_LIMITS.clear()
+        livestatus_service.LONG_POLL_LIMITS.clear()
+
+    def limit_connections(self, limit):
+        livestatus_service.connection_limit('livestatus_server').limit = limit
+        livestatus_service.connection_limit('livestatus_server').tokens = limit
+
+    @patch('yadtshell_plugins.livestatus_service.reactor')
+    @patch('yadtshell_plugins.livestatus_service.LivestatusServiceHandler._get_page')
+    def test_should_queue_requests_exceeding_connection_limit(self, mock_get_page, _):
+        pending = [defer.Deferred(), defer.Deferred(), defer.Deferred()]
+        mock_get_page.side_effect = pending
+        livestatus = LivestatusServiceHandler('livestatus_server', 'host')
+        self.limit_connections(2)
+
+        for command in ('first', 'second', 'third'):
+            livestatus.build_deferred_livestatus_command(command, lambda page: page)
+        self.assertEqual(2, mock_get_page.call_count)
+
+        pending[0].callback(response_with_body('OK'))
+        self.assertEqual(3, mock_get_page.call_count)
+
+    @patch('yadtshell_plugins.livestatus_service.reactor')
+    @patch('yadtshell_plugins.livestatus_service.LivestatusServiceHandler._get_page')
+    def test_should_release_connection_before_calling_back(self, mock_get_page, _):
+        mock_get_page.side_effect = lambda url: defer.succeed(response_with_body('OK'))
+        livestatus = LivestatusServiceHandler('livestatus_server', 'host')
+        self.limit_connections(1)
+        pages = []
+
+        livestatus.build_deferred_livestatus_command(
+            'first', lambda page: livestatus.build_deferred_livestatus_command('second', pages.append))
+
+        self.assertEqual(['OK'], pages)
+
+    @patch('yadtshell_plugins.livestatus_service.reactor')
+    @patch('yadtshell_plugins.livestatus_service.LivestatusServiceHandler._get_page')
+    def test_should_not_hold_connection_slots_while_long_polling(self, mock_get_page, _):
+        mock_get_page.side_effect = lambda url: (defer.succeed(response_with_body('[]'))
+                                                 if 'GET%20services' in url else defer.Deferred())
+        livestatus = LivestatusServiceHandler('livestatus_server', 'host')
+        self.limit_connections(1)
+
+        livestatus.build_deferred_livestatus_wait_for_notifications_state(lambda page: page)
+        livestatus.build_deferred_livestatus_command('command', lambda page: page)
+
+        self.assertEqual(3, mock_get_page.call_count)
+        self.assertEqual(livestatus_service.HTTP_MAX_LONG_POLLS_PER_SERVER - 1,
+                         livestatus_service.long_poll_limit('livestatus_server').tokens)
+
+    @patch('yadtshell_plugins.livestatus_service.reactor')
+    @patch('yadtshell_plugins.livestatus_service.LivestatusServiceHandler._get_page')
+    def test_should_count_only_failures_to_answer_as_breaker_failures(self, mock_get_page, _):
+        mock_get_page.side_effect = [defer.succeed(response_with_body('Internal Server Error')),
+                                     defer.fail(RuntimeError('connection refused'))]
+        livestatus = LivestatusServiceHandler('livestatus_server', None)
+        failures = []
+
+        with patch('yadtshell_plugins.livestatus_service.BREAKERS', CircuitBreakers()) as breakers:
+            livestatus.build_deferred_for_hosts_notification_status(['host1']).addErrback(failures.append)
+            self.assertEqual(0, breakers.breaker('livestatus', 'livestatus_server').failures)
+            livestatus.build_deferred_for_hosts_notification_status(['host1']).addErrback(failures.append)
+            self.assertEqual(1, breakers.breaker('livestatus', 'livestatus_server').failures)
+
+        self.assertEqual([ValueError, RuntimeError], [failure.type for failure in failures])
+
+    @patch('yadtshell_plugins.livestatus_service.METRICS', new_callable=Metrics)
+    @patch('yadtshell_plugins.livestatus_service.LivestatusServiceHandler._get_page')
+    def test_should_record_bytes_of_chunked_responses(self, mock_get_page, metrics):
+        body = '{"host":{"notifications_enabled":1}}'
+        mock_get_page.return_value = defer.succeed(response_with_body(body))
+        mock_get_page.return_value.result.length = UNKNOWN_LENGTH
+        livestatus = LivestatusServiceHandler('livestatus_server', 'host')
+
+        livestatus.build_deferred_for_service_notification_status(lambda response: response)
+
+        self.assertEqual(len(body), metrics.histogram('livestatus', RESPONSE_SIZE, 'livestatus_server').sum)
+
+    def test_configure_should_raise_limit_of_existing_servers(self):
+        limit = livestatus_service.connection_limit('livestatus_server')
+        tokens = limit.tokens
+
+        livestatus_service.configure(Mock(spec=['MAX_CONNECTIONS_PER_SERVER', 'CONNECTION_IDLE_TIMEOUT_IN_SECONDS'],
+                                          MAX_CONNECTIONS_PER_SERVER=limit.limit + 5,
+                                          CONNECTION_IDLE_TIMEOUT_IN_SECONDS=None))
+
+        self.assertEqual(tokens + 5, limit.tokens)
+
 
 class LivestatusServiceStatusResponseTests(unittest.TestCase):
 
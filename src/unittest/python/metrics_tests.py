@@ -0,0 +1,112 @@
+#   YADT - an Augmented Deployment Tool
+#   Copyright (C) 2010-2014  Immobilien Scout GmbH
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+from unittest import TestCase
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+from twisted.web.client import ResponseNeverReceived
+
+from yadtshell_plugins.metrics import Histogram, Metrics, LATENCY, TIME_TO_FIRST_BYTE
+
+
+class HistogramTest(TestCase):
+
+    def test_should_count_values_in_cumulative_buckets(self):
+        histogram = Histogram((1, 5, 10))
+
+        for value in (0.5, 3, 7, 20):
+            histogram.observe(value)
+
+        self.assertEqual([1, 2, 3], histogram.counts)
+        self.assertEqual(4, histogram.count)
+        self.assertEqual(30.5, histogram.sum)
+
+    def test_should_compute_percentiles_of_recent_samples(self):
+        histogram = Histogram((1, 5, 10))
+
+        for value in range(1, 101):
+            histogram.observe(value)
+
+        self.assertEqual(50, histogram.percentile(50))
+        self.assertEqual(99, histogram.percentile(99))
+
+    def test_should_return_no_percentile_without_samples(self):
+        self.assertEqual(None, Histogram((1, 5, 10)).percentile(99))
+
+
+class MetricsTest(TestCase):
+
+    def setUp(self):
+        self.now = 100.0
+        self.metrics = Metrics(clock=lambda: self.now)
+
+    def test_should_record_latency_and_outcome_of_tracked_call(self):
+        d = defer.Deferred()
+        timer = self.metrics.call('rest', '1.3.3.7')
+        timer.track(d)
+
+        self.now += 0.25
+        timer.first_byte()
+        self.now += 0.25
+        d.callback('response')
+
+        self.assertEqual([0.5], list(self.metrics.histogram('rest', LATENCY, '1.3.3.7').recent))
+        self.assertEqual([0.25], list(self.metrics.histogram('rest', TIME_TO_FIRST_BYTE, '1.3.3.7').recent))
+        self.assertEqual({('rest', '1.3.3.7', 'success'): 1}, self.metrics.outcomes)
+
+    def test_should_record_failure_type_as_outcome(self):
+        d = defer.Deferred()
+        self.metrics.call('livestatus', 'icinga').track(d)
+        d.addErrback(lambda failure: None)
+
+        d.errback(RuntimeError('connection refused'))
+
+        self.assertEqual({('livestatus', 'icinga', 'RuntimeError'): 1}, self.metrics.outcomes)
+
+    def test_should_not_record_latency_of_cancelled_http_request(self):
+        d = defer.Deferred()
+        self.metrics.call('rest', '1.3.3.7').track(d)
+        d.addErrback(lambda failure: None)
+
+        d.errback(ResponseNeverReceived([Failure(defer.CancelledError())]))
+
+        self.assertEqual([], list(self.metrics.histogram('rest', LATENCY, '1.3.3.7').recent))
+        self.assertEqual({('rest', '1.3.3.7', 'ResponseNeverReceived'): 1}, self.metrics.outcomes)
+
+    def test_should_dump_metrics_as_prometheus_text(self):
+        self.metrics.observe('rest', LATENCY, '1.3.3.7', 0.2)
+        self.metrics.count_outcome('rest', '1.3.3.7', 'success')
+        self.metrics.add_statistics_provider('pool', lambda: {'reused': 3, 'per_endpoint': {}})
+
+        text = self.metrics.to_prometheus()
+
+        self.assertTrue('yadtshell_plugins_latency_seconds_bucket{backend="rest",endpoint="1.3.3.7",le="0.25"} 1' in text)
+        self.assertTrue('yadtshell_plugins_latency_seconds_bucket{backend="rest",endpoint="1.3.3.7",le="0.1"} 0' in text)
+        self.assertTrue('yadtshell_plugins_latency_seconds_count{backend="rest",endpoint="1.3.3.7"} 1' in text)
+        self.assertTrue('yadtshell_plugins_calls_total{backend="rest",endpoint="1.3.3.7",outcome="success"} 1' in text)
+        self.assertTrue('yadtshell_plugins_pool_reused 3' in text)
+
+    def test_should_dump_metrics_as_json(self):
+        self.metrics.observe('rest', LATENCY, '1.3.3.7', 0.2)
+        self.metrics.add_statistics_provider('pool', lambda: {'reused': 3})
+
+        dumped = json.loads(self.metrics.to_json())
+
+        self.assertEqual(1, dumped['histograms'][0]['count'])
+        self.assertEqual('1.3.3.7', dumped['histograms'][0]['endpoint'])
+        self.assertEqual({'pool': {'reused': 3}}, dumped['statistics'])
@@ -14,10 +14,18 @@
 #   You should have received a copy of the GNU General Public License
 #   along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import shlex
+import time
 import unittest
+import mock
+import yadtshell.components
 from mock import Mock, call, patch
+from twisted.internet import defer
 
-from yadtshell_plugins.services import (LivestatusService,
+from yadtshell_plugins import services
+from yadtshell_plugins.services import (GuardChecker,
+                                        LivestatusService,
+                                        chain_remote_calls,
                                         handle_connection_error)
 
 
@@ -47,13 +55,46 @@ class LivestatusServiceTests(unittest.TestCase):
             livestatus=Mock()
         )
         mock_deferred = Mock()
-        mock_service.livestatus.build_deferred_for_service_notification_status.return_value = mock_deferred
+        mock_service.livestatus.build_deferred_for_batched_service_notification_status.return_value = mock_deferred
         mock_service.uri = 'service://host/monitoring'
 
         deferred_status = LivestatusService.status(mock_service)
 
         self.assertEqual(deferred_status, mock_deferred)
 
+    def test_disable_should_send_both_commands_before_waiting(self):
+        mock_service = Mock(LivestatusService, host='any.host', livestatus_server='any.icinga.server',
+                            livestatus=Mock())
+        commands = [defer.Deferred(), defer.Deferred()]
+        mock_service.livestatus.build_deferred_livestatus_command.side_effect = commands
+        mock_service.livestatus.build_deferred_livestatus_wait_for_notifications_state.return_value = 'waited'
+        results = []
+
+        LivestatusService._guarded_service_call(mock_service, None, 'disable').addCallback(results.append)
+
+        self.assertEqual(['DISABLE_HOST_SVC_NOTIFICATIONS', 'DISABLE_HOST_NOTIFICATIONS'],
+                         [args[0][0] for args in mock_service.livestatus.build_deferred_livestatus_command.call_args_list])
+        self.assertFalse(mock_service.livestatus.build_deferred_livestatus_wait_for_notifications_state.called)
+
+        commands[1].callback(None)
+        commands[0].callback(None)
+
+        self.assertEqual(['waited'], results)
+
+    @patch('yadtshell_plugins.services.logger')
+    def test_enable_should_fail_when_a_command_fails(self, _):
+        mock_service = Mock(LivestatusService, host='any.host', livestatus_server='any.icinga.server',
+                            livestatus=Mock())
+        mock_service.livestatus.build_deferred_livestatus_command.side_effect = [
+            defer.fail(RuntimeError('connection refused')), defer.Deferred()]
+        failures = []
+
+        LivestatusService._guarded_service_call(mock_service, None, 'enable').addErrback(failures.append)
+
+        self.assertTrue(failures[0].check(RuntimeError))
+        self.assertTrue('connection refused' in failures[0].getErrorMessage())
+        self.assertFalse(mock_service.livestatus.build_deferred_livestatus_wait_for_notifications_state.called)
+
     @patch('yadtshell_plugins.services.logger')
     def test_should_return_status_unknown_when_connection_failure_occurs(self, _):
         self.assertEqual(
@@ -69,10 +110,227 @@ class LivestatusServiceTests(unittest.TestCase):
             livestatus=Mock()
         )
         mock_deferred = Mock()
-        mock_service.livestatus.build_deferred_for_service_notification_status.return_value = mock_deferred
+        mock_service.livestatus.build_deferred_for_batched_service_notification_status.return_value = mock_deferred
         mock_service.uri = 'service://host/monitoring'
 
         deferred_status = LivestatusService.status(mock_service)
 
         errback_function = deferred_status.addErrback
         errback_function.assert_called_with(handle_connection_error, 'any.host', 'any.icinga.server')
+
+
+class LivestatusServiceStatusCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.mock_service = Mock(LivestatusService, livestatus=Mock(), uri='service://host/monitoring')
+        self.mock_service._status_cache_key.return_value = ('LivestatusService', 'any.host', 'any.icinga.server')
+
+    def tearDown(self):
+        services.STATUS_CACHE.entries.clear()
+        services.STATUS_CACHE.expected.clear()
+
+    def test_status_should_be_answered_from_cache(self):
+        services.STATUS_CACHE.store(1, self.mock_service._status_cache_key(), 10)
+        results = []
+
+        LivestatusService.status(self.mock_service).addCallback(results.append)
+
+        self.assertEqual([1], results)
+        self.assertFalse(self.mock_service.livestatus.build_deferred_for_batched_service_notification_status.called)
+
+    def test_start_should_invalidate_cached_status(self):
+        services.STATUS_CACHE.store(1, self.mock_service._status_cache_key(), 10)
+
+        LivestatusService.start(self.mock_service)
+
+        self.assertEqual(None, services.STATUS_CACHE.get(self.mock_service._status_cache_key()))
+
+
+class SnapshotTests(unittest.TestCase):
+
+    def setUp(self):
+        services.SNAPSHOT.configure('status-snapshot', 60)
+        services.SNAPSHOT.records = {}
+        services.SNAPSHOT._append = lambda *args: None
+
+    def tearDown(self):
+        del services.SNAPSHOT._append
+        services.SNAPSHOT.configure(None, 0)
+
+    @patch('yadtshell_plugins.services.logger')
+    def test_status_should_be_answered_from_snapshot_and_refreshed(self, mock_logger):
+        mock_lb = Mock(services.LB, host='any.host', loadbalancer_ips=('1.1.1.1',), uri='service://any.host/lb',
+                       status_cache_ttl=0)
+        mock_lb._status_cache_key.return_value = ('LB', 'any.host', ('1.1.1.1',), None)
+        services.SNAPSHOT.records['["LB", "any.host", ["1.1.1.1"], null]'] = {'status': 0, 'time': time.time()}
+        refreshed = defer.Deferred()
+        mock_lb._client.return_value.query_status.return_value = refreshed
+        results = []
+
+        services.LB.status(mock_lb).addCallback(results.append)
+        refreshed.callback(3)
+
+        self.assertEqual([0], results)
+        mock_logger.info.assert_called_with(
+            'status of service://any.host/lb changed from 0 to 3 since the last snapshot')
+
+
+class PrefetchTests(unittest.TestCase):
+
+    def tearDown(self):
+        services.PREFETCHED_STATUS.clear()
+        services.PREFETCHED_CLIENTS.clear()
+
+    def test_status_should_be_answered_from_prefetched_query(self):
+        mock_service = Mock(LivestatusService, host='any.host', livestatus_server='any.icinga.server',
+                            livestatus=Mock(), uri='service://host/monitoring', status_cache_ttl=0)
+        mock_service._status_cache_key.return_value = ('LivestatusService', 'any.host', 'any.icinga.server')
+        mock_service.livestatus.build_deferred_for_batched_service_notification_status.return_value = \
+            defer.succeed(Mock(notifications_are_enabled=lambda: False))
+        results = []
+
+        LivestatusService._prefetch_status(mock_service)
+        LivestatusService.status(mock_service).addCallback(results.append)
+        LivestatusService.status(mock_service)
+
+        self.assertEqual([1], results)
+        self.assertEqual(2, mock_service.livestatus.build_deferred_for_batched_service_notification_status.call_count)
+
+    def test_should_prefetch_all_clusters_once_per_client(self):
+        mock_lb = Mock(services.LB, config=Mock(CLUSTERS={'one': ['1.1.1.1', '1.1.1.2'], 'two': ['2.2.2.2']}))
+        client = mock_lb._client.return_value
+
+        services.LB._prefetch_status(mock_lb)
+        services.LB._prefetch_status(mock_lb)
+
+        client.prefetch_status.assert_called_once_with(mock.ANY)
+        self.assertEqual(['1.1.1.1', '1.1.1.2', '2.2.2.2'], sorted(client.prefetch_status.call_args[0][0]))
+
+
+class ResolveClustersTests(unittest.TestCase):
+
+    CLUSTERS = {'one': ['1.1.1.1', '1.1.1.2'], 'two': ['1.1.1.2', '2.2.2.2']}
+
+    def tearDown(self):
+        services.RESOLVED_CLUSTERS.clear()
+
+    def test_should_deduplicate_ips_of_overlapping_clusters(self):
+        self.assertEqual(('1.1.1.1', '1.1.1.2', '2.2.2.2'), services.resolve_clusters(['one', 'two'], self.CLUSTERS))
+
+    def test_should_share_resolved_ips(self):
+        first = services.resolve_clusters(['one', 'two'], self.CLUSTERS)
+
+        self.assertTrue(first is services.resolve_clusters(['one', 'two'], self.CLUSTERS))
+
+    def test_prepare_should_resolve_clusters(self):
+        mock_lb = Mock(services.LB, loadbalancer_clusters=['one', 'two'], config=Mock(CLUSTERS=self.CLUSTERS),
+                       uri='service://any.host/lb', host='any.host', ip_list=['10.0.0.1'])
+
+        services.LB.prepare(mock_lb, Mock(interface={'eth0': '10.0.0.1', 'eth1': None}))
+
+        self.assertEqual(('1.1.1.1', '1.1.1.2', '2.2.2.2'), mock_lb.loadbalancer_ips)
+
+
+class LBClientTests(unittest.TestCase):
+
+    def test_should_configure_client_once(self):
+        mock_lb = Mock(services.LB, ltm_partition='~Common~', implementation=Mock(), config=Mock(), client=None)
+
+        first = services.LB._client(mock_lb)
+        second = services.LB._client(mock_lb)
+
+        self.assertEqual(first, second)
+        mock_lb.implementation.configure.assert_called_once_with(mock_lb.config, '~Common~')
+
+    def test_should_use_implementation_without_clients(self):
+        mock_lb = Mock(services.LB, ltm_partition='~Common~', implementation=Mock(), config=Mock(), client=None)
+        mock_lb.implementation.configure.return_value = None
+
+        self.assertEqual(mock_lb.implementation, services.LB._client(mock_lb))
+
+
+class GuardCheckerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.guard = GuardChecker()
+        self.guard._run_guard = Mock()
+        self.lb = Mock(host='any.host', uri='service://any.host/lb')
+        self.lb.name = 'lb'
+        self.monitoring = Mock(host='any.host', uri='service://any.host/monitoring')
+        self.monitoring.name = 'monitoring'
+        self.guard.register(self.lb)
+        self.guard.register(self.monitoring)
+
+    def test_should_answer_second_check_from_cache(self):
+        self.guard._run_guard.return_value = defer.succeed('granted')
+
+        self.guard.check(self.lb, ttl=10)
+        self.guard.check(self.lb, ttl=10)
+
+        self.assertEqual(1, self.guard._run_guard.call_count)
+
+    def test_should_not_cache_without_ttl(self):
+        self.guard._run_guard.return_value = defer.succeed('granted')
+
+        self.guard.check(self.lb)
+        self.guard.check(self.lb)
+
+        self.assertEqual(2, self.guard._run_guard.call_count)
+
+    def test_should_check_all_services_of_host_in_one_remote_call(self):
+        self.guard._run_guard.return_value = defer.succeed('granted')
+
+        self.guard.check(self.lb, ttl=10, batch=True)
+        self.guard.check(self.monitoring, ttl=10, batch=True)
+
+        self.guard._run_guard.assert_called_once_with(
+            self.lb, [('yadt-service-checkaccess', 'lb'), ('yadt-service-checkaccess', 'monitoring')])
+
+    def test_should_not_batch_without_ttl(self):
+        self.guard._run_guard.return_value = defer.succeed('granted')
+
+        self.guard.check(self.lb, batch=True)
+        self.guard.check(self.monitoring, batch=True)
+
+        self.assertEqual([call(self.lb, [('yadt-service-checkaccess', 'lb')]),
+                          call(self.monitoring, [('yadt-service-checkaccess', 'monitoring')])],
+                         self.guard._run_guard.call_args_list)
+
+    def test_should_check_separately_when_combined_check_fails(self):
+        self.guard._run_guard.side_effect = [defer.fail(RuntimeError('locked')),
+                                             defer.succeed('granted')]
+        results = []
+
+        self.guard.check(self.lb, ttl=10, batch=True).addCallback(results.append)
+
+        self.assertEqual(['granted'], results)
+        self.assertEqual(call(self.lb, [('yadt-service-checkaccess', 'lb')]), self.guard._run_guard.call_args)
+
+
+class ChainRemoteCallsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.service = Mock(yadtshell.components.Service, fqdn='any.host')
+        self.service.name = 'lb'
+        self.service.create_remote_log_filename.return_value = '/var/log/yadt.log'
+        self.service.remote_call.side_effect = lambda cmd: yadtshell.components.Service.remote_call.__func__(self.service, cmd)
+        user_info = patch('yadtshell.components.get_user_info', return_value={'owner': 'owner'})
+        user_info.start()
+        self.addCleanup(user_info.stop)
+
+    def remote_command(self, commands):
+        arguments = chain_remote_calls(self.service, commands)
+        self.assertEqual(['ssh', 'any.host'], arguments[:2])
+        return shlex.split(' '.join(arguments[2:]))
+
+    def test_should_run_every_command_with_owner_and_log_file(self):
+        self.assertEqual(['WHO=owner', 'YADT_LOG_FILE=/var/log/yadt.log', 'yadt-command', 'yadt-service-checkaccess', 'lb', '&&',
+                          'WHO=owner', 'YADT_LOG_FILE=/var/log/yadt.log', 'yadt-command', 'yadt-service-checkaccess', 'monitoring'],
+                         self.remote_command([('yadt-service-checkaccess', 'lb'),
+                                              ('yadt-service-checkaccess', 'monitoring')]))
+
+    def test_should_quote_arguments_of_each_command(self):
+        remote_command = self.remote_command([('yadt-service-checkaccess', 'lb; reboot'),
+                                              ('yadt-service-checkaccess', 'say "hi"')])
+
+        self.assertEqual(['lb; reboot', 'say "hi"'], [remote_command[4], remote_command[10]])
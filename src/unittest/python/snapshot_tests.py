@@ -0,0 +1,120 @@
+#   YADT - an Augmented Deployment Tool
+#   Copyright (C) 2010-2014  Immobilien Scout GmbH
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from mock import patch
+
+from yadtshell_plugins.snapshot import SnapshotStore
+
+KEY = ('LB', 'any.host', ('1.1.1.1', '1.1.1.2'), None)
+
+
+class SnapshotStoreTest(TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'snapshots', 'status-snapshot')
+        self.store = self.new_store()
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.directory)
+
+    def new_store(self, max_age=60):
+        store = SnapshotStore(clock=lambda: self.now)
+        store.configure(self.path, max_age)
+        return store
+
+    def lines(self):
+        with open(self.path) as snapshot_file:
+            return [json.loads(line) for line in snapshot_file]
+
+    def test_should_answer_status_recorded_by_previous_run(self):
+        self.assertEqual(3, self.store.record(3, KEY))
+        self.store.close()
+
+        self.assertEqual(3, self.new_store().get(KEY))
+
+    def test_should_not_answer_status_older_than_max_age(self):
+        self.store.record(0, KEY)
+        self.now += 61
+
+        self.assertEqual(None, self.new_store().get(KEY))
+
+    def test_should_not_record_without_max_age(self):
+        store = self.new_store(max_age=0)
+
+        store.record(0, KEY)
+
+        self.assertEqual(None, store.get(KEY))
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_should_not_record_unknown_status(self):
+        self.store.record('unknown', KEY)
+
+        self.assertEqual(None, self.store.get(KEY))
+
+    def test_should_increase_generation_only_when_status_changes(self):
+        self.store.record(0, KEY)
+        self.store.record(0, KEY)
+        self.store.record(3, KEY)
+
+        self.assertEqual([1, 1, 2], [record['generation'] for record in self.lines()])
+
+    def test_should_forget_status_when_invalidated(self):
+        self.store.record(0, KEY)
+        self.store.invalidate(KEY)
+        self.store.close()
+
+        self.assertEqual(None, self.new_store().get(KEY))
+
+    def test_should_ignore_truncated_lines(self):
+        self.store.record(0, KEY)
+        self.store.close()
+        with open(self.path, 'a') as snapshot_file:
+            snapshot_file.write('{"key": "[\\"LB\\", "sta')
+
+        self.assertEqual(0, self.new_store().get(KEY))
+
+    @patch('yadtshell_plugins.snapshot.COMPACT_THRESHOLD', 2)
+    def test_should_compact_superseded_lines_when_loading(self):
+        for status in [0, 3, 0, 3]:
+            self.store.record(status, KEY)
+        self.store.close()
+
+        self.assertEqual(3, self.new_store().get(KEY))
+        self.assertEqual(1, len(self.lines()))
+
+    @patch('yadtshell_plugins.snapshot.COMPACT_THRESHOLD', 2)
+    def test_should_not_lose_records_appended_after_compaction_by_another_run(self):
+        other_store = self.new_store()
+        other_store.record(0, KEY)
+        for status in [0, 3, 0, 3]:
+            self.store.record(status, ('LB', 'other.host', None, None))
+        self.store.close()
+
+        self.new_store().get(KEY)
+        other_store.record(3, KEY)
+        other_store.close()
+
+        self.assertEqual(3, self.new_store().get(KEY))
+        self.assertEqual(3, len(self.lines()))
@@ -0,0 +1,99 @@
+#   YADT - an Augmented Deployment Tool
+#   Copyright (C) 2010-2014  Immobilien Scout GmbH
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from unittest import TestCase
+
+from mock import Mock, patch
+from twisted.internet import defer, task
+from twisted.internet.error import TimeoutError
+
+from yadtshell_plugins import timeouts
+from yadtshell_plugins.metrics import CONNECT, LATENCY, TIME_TO_FIRST_BYTE, Metrics
+from yadtshell_plugins.timeouts import AdaptiveTimeouts
+
+
+class AdaptiveTimeoutsTest(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.metrics = Metrics()
+        self.timeouts = AdaptiveTimeouts(metrics=self.metrics, clock=self.clock)
+        self.timeouts.configure('rest', timeouts={CONNECT: 30, LATENCY: 60}, factor=3, floor=1)
+
+    def observe(self, phase, latency, count=timeouts.MIN_SAMPLES, kind='rest'):
+        for _ in range(count):
+            self.metrics.observe(kind, phase, '1.3.3.7', latency)
+
+    def test_should_use_configured_timeouts_when_not_adaptive(self):
+        self.observe(LATENCY, 0.1)
+
+        self.assertEqual(60, self.timeouts.timeout('rest', LATENCY, '1.3.3.7'))
+        self.assertEqual(None, self.timeouts.timeout('rest', TIME_TO_FIRST_BYTE, '1.3.3.7'))
+
+    def test_should_derive_timeout_from_p99_of_endpoint(self):
+        self.timeouts.configure('rest', adaptive=True)
+        self.observe(LATENCY, 0.5)
+        self.observe(LATENCY, 2.0, count=1)
+
+        self.assertEqual(6.0, self.timeouts.timeout('rest', LATENCY, '1.3.3.7'))
+        self.assertEqual(60, self.timeouts.timeout('rest', LATENCY, '1.3.3.8'))
+
+    def test_should_bound_derived_timeout_by_floor_and_configured_timeout(self):
+        self.timeouts.configure('rest', adaptive=True)
+        self.observe(CONNECT, 0.01)
+        self.observe(LATENCY, 50)
+
+        self.assertEqual(1, self.timeouts.timeout('rest', CONNECT, '1.3.3.7'))
+        self.assertEqual(60, self.timeouts.timeout('rest', LATENCY, '1.3.3.7'))
+
+    def test_should_derive_timeout_from_latencies_of_same_kind_of_call(self):
+        self.timeouts.configure('rest', adaptive=True)
+        self.observe(LATENCY, 0.1)
+        self.observe(LATENCY, 5, kind='rest-collection')
+
+        self.assertEqual(1, self.timeouts.timeout('rest', LATENCY, '1.3.3.7'))
+        self.assertEqual(15, self.timeouts.timeout('rest', LATENCY, '1.3.3.7', kind='rest-collection'))
+        self.assertEqual(60, self.timeouts.timeout('rest', LATENCY, '1.3.3.7', kind='rest-mutation'))
+
+    @patch('yadtshell_plugins.timeouts.logger')
+    def test_should_fail_call_with_timeout_error_when_expired(self, _):
+        d = defer.Deferred()
+        failures = []
+
+        self.timeouts.expire(d, 'rest', LATENCY, '1.3.3.7').addErrback(failures.append)
+        self.clock.advance(60)
+
+        self.assertTrue(failures[0].check(TimeoutError))
+        self.assertEqual(1, self.timeouts.statistics()['expired'])
+
+    def test_should_not_expire_call_finished_in_time(self):
+        d = defer.Deferred()
+
+        self.timeouts.expire(d, 'rest', LATENCY, '1.3.3.7')
+        d.callback('response')
+
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_configure_should_read_settings_of_configuration_module(self):
+        config = Mock(spec=['ADAPTIVE_TIMEOUTS', 'FIRST_BYTE_TIMEOUT_IN_SECONDS'],
+                      ADAPTIVE_TIMEOUTS=True, FIRST_BYTE_TIMEOUT_IN_SECONDS=10)
+
+        with patch('yadtshell_plugins.timeouts.TIMEOUTS', self.timeouts):
+            timeouts.configure('rest', config)
+
+        self.assertEqual(10, self.timeouts.timeout('rest', TIME_TO_FIRST_BYTE, '1.3.3.7'))
+        self.assertEqual(30, self.timeouts.timeout('rest', CONNECT, '1.3.3.7'))
+        self.assertTrue(self.timeouts.settings['rest']['adaptive'])